@@ -0,0 +1,62 @@
+"""Launch overhead benchmarks, run with `make benchmark`
+
+Docker is replaced by a stub executable on PATH which records its argv
+and exits immediately, so measurements include only doh's own overhead
+and no daemon is needed.
+"""
+
+from typing import Iterator
+
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+from doh.config import Context
+from doh.env import Env
+
+if importlib.util.find_spec("pytest_benchmark") is None:
+    collect_ignore_glob = ["test_*.py"]
+
+FAKE_DOCKER = """#!/bin/sh
+printf '%s\\n' "$*" >> "$FAKE_DOCKER_LOG"
+case "$1 $2" in
+    "image inspect") echo '[{"Id": "sha256:fake", "Config": {"Labels": {}}}]' ;;
+esac
+"""
+
+
+@pytest.fixture(autouse=True)
+def env(tmp_path: Path, monkeypatch) -> Iterator[Env]:
+    monkeypatch.setenv("HOME", str(tmp_path))
+    yield Env.get()
+
+
+@pytest.fixture()
+def fake_docker(tmp_path: Path, monkeypatch) -> Path:
+    """Log of docker invocations, one argv per line"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    docker = bin_dir / "docker"
+    docker.write_text(FAKE_DOCKER)
+    docker.chmod(0o755)
+    log = tmp_path / "docker.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_DOCKER_LOG", str(log))
+    monkeypatch.setenv("DOH_DOCKER_BACKEND", "cli")
+    return log
+
+
+@pytest.fixture()
+def project(tmp_path: Path) -> Context:
+    root = tmp_path / "project"
+    root.mkdir()
+    (root / "Dockerfile").write_text("FROM python:3.10\n")
+    (root / "dohrc.toml").write_text(
+        'ssh_port = 22222\n\n[environment]\nHOME = "$HOME"\n\n'
+        "[hosts.all]\nbind_paths = []\n"
+    )
+    for i in range(200):
+        (root / f"module_{i}.py").write_text("x = 1\n")
+    return Context.create_for_path(root)
@@ -0,0 +1,103 @@
+"""Round trip latency of kernel execute requests per `kernel_network` mode
+
+Starts a kernel of the project with `doh kernel-run` in every mode and
+measures time from sending an empty execute request till its reply, and
+counts docker-proxy processes while the kernel is running. Needs docker
+and jupyter_client:
+
+    python benchmarks/kernel_latency.py path/to/project --requests 500
+"""
+
+from typing import Dict, List
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from doh.trace import percentile
+
+MODES = ["publish", "host"]
+
+
+def docker_proxy_count() -> int:
+    count = 0
+    for cmdline in Path("/proc").glob("[0-9]*/cmdline"):
+        try:
+            if b"docker-proxy" in cmdline.read_bytes().split(b"\0")[0]:
+                count += 1
+        except OSError:
+            continue
+    return count
+
+
+def measure(project: Path, mode: str, requests: int) -> Dict[str, float]:
+    from jupyter_client import BlockingKernelClient
+    from jupyter_client.connect import write_connection_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn_file, _ = write_connection_file(
+            str(Path(tmp) / "kernel.json"), ip="127.0.0.1"
+        )
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "doh",
+                "kernel-run",
+                str(project),
+                conn_file,
+            ],
+            env={**os.environ, "DOH_KERNEL_NETWORK": mode},
+        )
+        client = BlockingKernelClient(connection_file=conn_file)
+        client.load_connection_file()
+        client.start_channels()
+        try:
+            client.wait_for_ready(timeout=300)
+            proxies = docker_proxy_count()
+            latencies: List[float] = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                msg_id = client.execute("pass", silent=True)
+                while (
+                    client.get_shell_msg()["parent_header"]["msg_id"] != msg_id
+                ):
+                    pass
+                latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            client.shutdown()
+            client.stop_channels()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.terminate()
+                proc.wait()
+
+    return {
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "docker_proxies": proxies,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("project", type=Path)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mode", choices=MODES, action="append")
+    args = parser.parse_args()
+
+    results = {
+        mode: measure(args.project.resolve(), mode, args.requests)
+        for mode in args.mode or MODES
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
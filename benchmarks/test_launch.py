@@ -0,0 +1,77 @@
+import copy
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import doh
+from doh import config as config_module
+from doh.config import Context, dict_merge, load_final_config
+from doh.docker import docker_run_args_from_project
+
+# Subprocesses import doh from this tree even if it isn't installed
+PYTHONPATH = os.pathsep.join(
+    filter(None, [str(Path(doh.__file__).parents[1]), os.getenv("PYTHONPATH")])
+)
+
+
+def _python(*args: str, **kwargs) -> None:
+    env = {**os.environ, "PYTHONPATH": PYTHONPATH}
+    subprocess.run([sys.executable, *args], check=True, env=env, **kwargs)
+
+
+def _large_config(width: int, depth: int, tag: str):
+    if depth == 0:
+        return tag
+    return {f"k{i}": _large_config(width, depth - 1, tag) for i in range(width)}
+
+
+def test_load_final_config_cached(benchmark, project: Context) -> None:
+    load_final_config(project)
+
+    def load():
+        config_module._compiled_configs.clear()
+        return load_final_config(project)
+
+    benchmark(load)
+
+
+def test_load_final_config_cold(benchmark, project: Context) -> None:
+    def load():
+        config_module._compiled_configs.clear()
+        config_module.compiled_config_path(project).unlink(missing_ok=True)
+        return load_final_config(project)
+
+    benchmark(load)
+
+
+def test_dict_merge_large(benchmark) -> None:
+    layers = [_large_config(10, 4, tag) for tag in ("a", "b", "c")]
+
+    benchmark(lambda: dict_merge(*map(copy.deepcopy, layers)))
+
+
+def test_docker_run_args(benchmark, project: Context, monkeypatch) -> None:
+    monkeypatch.chdir(project.project_dir)
+    benchmark(lambda: docker_run_args_from_project(project))
+
+
+def test_cli_import(benchmark) -> None:
+    benchmark.pedantic(
+        _python, args=("-c", "import doh.__main__"), rounds=10, warmup_rounds=1
+    )
+
+
+def test_exec_true(benchmark, project: Context, fake_docker) -> None:
+    runs = []
+
+    def run():
+        _python("-m", "doh", "exec", "true", cwd=project.project_dir)
+        runs.append(1)
+
+    benchmark.pedantic(run, rounds=10, warmup_rounds=1)
+
+    calls = fake_docker.read_text().splitlines()
+    # Image is built once, then only started
+    assert sum(c.startswith("build") for c in calls) == 1
+    assert sum(c.startswith("run") for c in calls) == len(runs)
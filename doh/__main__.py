@@ -1,26 +1,47 @@
-from typing import List
+"""doh CLI
+
+Command implementations and their dependencies are imported inside command
+functions: `kernel-run` is spawned by jupyter for every kernel start, so
+import time of this module is a part of kernel startup latency.
+"""
+from typing import List, Optional
 
 import logging
-import shlex
-import subprocess
+import sys
 from pathlib import Path
 
-import typer
-from doh.agent import ensure_agent_present
-from doh.commands import kernel
-from doh.commands.init import init
-from doh.commands.ssh import run_ssh_server
-from doh.utils import setup_logging
-
-from .config import Context, load_final_config
-from .docker import build_image, docker_run_args_from_project, run_docker_run
+from doh import trace
+from doh.utils import rich_hidden, setup_logging
 
-setup_logging()
+with rich_hidden():
+    import typer
 
 LOG = logging.getLogger(__file__)
 app = typer.Typer()
 
 
+def _exit_status() -> str:
+    exc = sys.exc_info()[1]
+    if exc is None:
+        return "ok"
+    code = getattr(exc, "exit_code", getattr(exc, "code", 1))
+    return "ok" if code in (0, None) else f"error: {type(exc).__name__}"
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    trace_path: Optional[Path] = typer.Option(
+        None,
+        "--trace",
+        help="Write Chrome trace of the command phases to this file",
+    ),
+) -> None:
+    setup_logging()
+    trace.start(ctx.invoked_subcommand or "", trace_path)
+    ctx.call_on_close(lambda: trace.finish(_exit_status()))
+
+
 @app.command(
     name="exec",
     context_settings={"ignore_unknown_options": True},
@@ -29,21 +50,55 @@ app = typer.Typer()
 def exec_cmd(
     cmd: List[str],
     build: bool = True,
+    force_build: bool = False,
+    projects: Optional[str] = typer.Option(
+        None,
+        "--projects",
+        help="Run in every doh project matching the glob, e.g. 'repos/*'",
+    ),
+    jobs: Optional[int] = typer.Option(
+        None, "--jobs", help="Parallel builds and runs with --projects"
+    ),
 ) -> None:
-    context = Context.create_for_cwd()
-    config = load_final_config(context)
-    if build:
-        build_image(config, context)
+    import shlex
+    import subprocess
+
+    from .config import Context
+
+    if projects is not None:
+        from .fanout import fan_out, format_summary
 
-    if context.config.before_command:
-        subprocess.run(shlex.split(context.config.before_command), check=True)
+        results = fan_out(projects, cmd, build, force_build, jobs)
+        if not results:
+            typer.secho(f"No doh projects match {projects}", fg="red")
+            raise typer.Exit(1)
+        typer.echo(format_summary(results, Path.cwd()))
+        raise typer.Exit(0 if all(r.ok for r in results) else 1)
+    from .docker import handoff_docker_run, run_docker_run
+    from .plan import launch_plan, prepare_launch
+    from .warm import run_warm
 
-    run_docker_run(
-        docker_run_args_from_project(context), context.image_name, cmd
+    context = Context.create_for_cwd()
+    config = context.config
+    run_args = prepare_launch(
+        context, build, force_build, request_tty=config.warm is None
     )
 
-    if context.config.after_command:
-        subprocess.run(shlex.split(context.config.after_command), check=True)
+    if config.warm is not None:
+        run_warm(context, cmd)
+    else:
+        plan = launch_plan(context, cmd, run_args=run_args)
+        trace.mark_launched()
+        if config.exec_handoff:
+            handoff_docker_run(
+                plan.run_args, plan.image, plan.cmd, config.after_command
+            )
+        with trace.span("container"):
+            run_docker_run(plan.run_args, plan.image, plan.cmd)
+
+    if config.after_command:
+        with trace.span("after_command"):
+            subprocess.run(shlex.split(config.after_command), check=True)
 
 
 @app.command(
@@ -51,27 +106,120 @@ def exec_cmd(
     help="Creates dohrc.toml if doesn't exist yet, populates it with global and current host section",
 )
 def init_cmd():
+    from .commands.init import init
+    from .config import Context
+
     init(Context.create_for_cwd())
 
 
 @app.command()
-def sh():
-    config = load_final_config(Context.create_for_cwd())
-    exec_cmd([config.sh_cmd])
+def sh(build: bool = True, force_build: bool = False) -> None:
+    from .config import Context
+
+    config = Context.create_for_cwd().config
+    exec_cmd([config.sh_cmd], build, force_build, projects=None, jobs=None)
+
+
+@app.command(
+    context_settings={"ignore_unknown_options": True},
+    help="Prints resolved docker invocation for a command, doesn't build image",
+)
+def plan(
+    cmd: List[str] = typer.Argument(None),
+    json: bool = typer.Option(False, "--json", help="Print plan as JSON"),
+    tty: bool = True,
+) -> None:
+    import shlex
+
+    from .config import Context
+    from .plan import launch_plan
+
+    launch = launch_plan(Context.create_for_cwd(), cmd or [], request_tty=tty)
+    if json:
+        typer.echo(launch.json_with_argv())
+    else:
+        typer.echo(shlex.join(launch.argv))
+
+
+config_app = typer.Typer(help="Inspects doh configuration")
+app.add_typer(config_app, name="config")
+
+
+@config_app.command(help="Shows final config values and layers they came from")
+def explain() -> None:
+    import json
+
+    from .config import Context, explain_config, resolve_config
+
+    context = Context.create_for_cwd()
+    for path, value, layer in explain_config(context, resolve_config(context)):
+        typer.echo(f"{path} = {json.dumps(value, default=str)}  # {layer}")
+
+
+cache_app = typer.Typer(help="Manages persistent cache volumes")
+app.add_typer(cache_app, name="cache")
+
+
+@cache_app.command("ls", help="Lists cache volumes of all projects")
+def cache_ls() -> None:
+    from .docker import CACHE_SCOPE_LABEL
+    from .volumes import cache_volumes
+
+    volumes = cache_volumes()
+    if not volumes:
+        typer.echo("No cache volumes")
+        return
+    typer.echo(f"{'VOLUME':<48} {'SCOPE':<8} {'SIZE':>9} {'IN USE':>6}")
+    for v in volumes:
+        size = f"{v['Size'] / 2**20:.0f}M" if v["Size"] >= 0 else "?"
+        in_use = str(v["RefCount"]) if v["RefCount"] >= 0 else "?"
+        scope = v["Labels"].get(CACHE_SCOPE_LABEL, "?")
+        typer.echo(f"{v['Name']:<48} {scope:<8} {size:>9} {in_use:>6}")
+
+
+@cache_app.command("prune", help="Removes unused cache volumes of the project")
+def cache_prune(
+    shared: bool = typer.Option(False, help="Also remove shared volumes"),
+    all_projects: bool = typer.Option(
+        False, "--all", help="Remove volumes of all projects"
+    ),
+) -> None:
+    from .config import Context
+    from .volumes import prune_cache_volumes
+
+    context = Context.create_for_cwd()
+    for name in prune_cache_volumes(context, shared, all_projects):
+        typer.echo(f"Removed {name}")
+
+
+@app.command(help="Stops warm container of the current project")
+def warm_stop() -> None:
+    from .config import Context
+    from .warm import stop_warm_container
+
+    stop_warm_container(Context.create_for_cwd())
 
 
 @app.command(hidden=True)
 def download_ssh():
+    from .agent import ensure_agent_present
+
     ensure_agent_present()
 
 
 @app.command()
-def ssh(build: bool = True) -> None:
-    run_ssh_server(Context.create_for_cwd(), build)
+def ssh(build: bool = True, force_build: bool = False) -> None:
+    from .commands.ssh import run_ssh_server
+    from .config import Context
+
+    run_ssh_server(Context.create_for_cwd(), build, force_build)
 
 
 @app.command()
 def kernel_install(language: str = "python") -> None:
+    from .commands import kernel
+    from .config import Context
+
     project = Context.create_for_cwd()
     kernel.install(project, language)
 
@@ -81,10 +229,119 @@ def kernel_run(
     project_root: Path = typer.Argument(..., dir_okay=True),
     kernel_conn_spec_path: Path = typer.Argument(..., file_okay=True),
     build: bool = True,
+    force_build: bool = False,
 ) -> None:
+    from .commands import kernel
+    from .config import Context
+
     kernel.run_kernel(
-        Context.create_for_path(project_root), kernel_conn_spec_path, build
+        Context.create_for_path(project_root),
+        kernel_conn_spec_path,
+        build,
+        force_build,
+    )
+
+
+@app.command(hidden=True)
+def kernel_pool_fill(
+    project_root: Path = typer.Argument(..., dir_okay=True)
+) -> None:
+    from .commands.kernel.pool import fill_pool
+    from .config import Context
+
+    fill_pool(Context.create_for_path(project_root))
+
+
+@app.command(help="Removes idle kernel containers of the current project")
+def kernel_pool_drain() -> None:
+    from .commands.kernel.pool import drain_pool
+    from .config import Context
+
+    drain_pool(Context.create_for_cwd())
+
+
+@app.command(help="Mirrors the project to the configured sync target")
+def sync(
+    watch: bool = typer.Option(False, help="Keep syncing on changes"),
+    interval: float = typer.Option(1.0, help="Seconds between change scans"),
+    full: bool = typer.Option(False, help="Recheck every file"),
+) -> None:
+    from . import sync as project_sync
+    from .config import Context
+
+    context = Context.create_for_cwd()
+    if context.config.sync is None:
+        typer.echo("sync.target isn't configured", err=True)
+        raise typer.Exit(1)
+    stats = project_sync.sync_project(context, full)
+    typer.echo(
+        f"Synced {stats.files} files ({stats.literal_bytes} bytes sent),"
+        f" removed {stats.removed}, {stats.unchanged} unchanged"
+    )
+    if watch:
+        project_sync.watch(context, interval)
+
+
+@app.command(help="Re-resolves digest of the prebuilt `image` from config")
+def pull() -> None:
+    from .config import Context
+    from .prebuilt import pinned_image
+
+    config = Context.create_for_cwd().config
+    if config.image is None:
+        typer.echo("`image` isn't configured, project image is built", err=True)
+        raise typer.Exit(1)
+    typer.echo(f"{config.image} -> {pinned_image(config, refresh=True)}")
+
+
+@app.command(help="Removes least recently used doh images over disk budget")
+def gc(
+    max_size: Optional[str] = typer.Option(
+        None, help="Disk budget, e.g. 50g. Default is gc.max_size from config"
+    ),
+    dry_run: bool = typer.Option(False, help="Only show what would be removed"),
+) -> None:
+    from .config import Context, GCParameters
+    from .gc import collect_garbage
+    from .utils import parse_size
+
+    if max_size is None:
+        params = Context.create_for_cwd().config.gc or GCParameters()
+        max_size = params.max_size
+    result = collect_garbage(parse_size(max_size), dry_run=dry_run)
+    for name in result.removed:
+        typer.echo(f"{'Would remove' if dry_run else 'Removed'} {name}")
+    typer.echo(
+        f"Freed {result.freed / 2**30:.1f}GiB,"
+        f" {(result.total - result.freed) / 2**30:.1f}GiB of images left"
+    )
+
+
+@app.command(help="Shows launch latency percentiles of recent commands")
+def stats(
+    command: Optional[str] = typer.Option(None, help="Only this command"),
+    json: bool = typer.Option(False, "--json", help="Print stats as JSON"),
+) -> None:
+    import json as json_lib
+
+    rows = trace.launch_stats(trace.load_history(trace.history_path()))
+    if command is not None:
+        rows = [r for r in rows if r["command"] == command]
+
+    if json:
+        typer.echo(json_lib.dumps(rows, indent=2))
+        return
+    if not rows:
+        typer.echo("No launches recorded yet")
+        return
+    typer.echo(
+        f"{'COMMAND':<12} {'RUNS':>5} {'P50 MS':>9} {'P95 MS':>9}  PROJECT"
     )
+    for r in rows:
+        typer.echo(
+            f"{r['command']:<12} {r['runs']:>5} {r['p50_ms']:>9.1f}"
+            f" {r['p95_ms']:>9.1f}  {r['project']}"
+        )
 
 
 if __name__ == "__main__":
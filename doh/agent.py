@@ -1,51 +1,246 @@
+"""Content-addressed store of the ssh server binary
+
+Binary is extracted from the layers of the `okteto/remote` image streamed
+by `docker image save` (or the Engine API), no container is started.
+Objects are stored by sha256 of the binary and never modified, tag files
+map image tag to image digest and object. Both are written to temp paths
+and renamed into place, so concurrent doh invocations (of any user, when
+the store is in `DOH_SHARED_CACHE_DIR`) never see partial files.
+"""
+
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+import contextlib
 import hashlib
+import json
+import logging
+import os
 import shutil
+import subprocess
+import tarfile
+import tempfile
 from pathlib import Path
 
-from .docker import run_docker_run, user_args
+from . import trace
+from .docker import engine_client, inspect_image
 from .env import Env
+from .pipeline import run_command
+from .utils import make_shared_dir, shared_file_lock
 
 SSH_SERVER_IMAGE_TAG = "okteto/remote:0.4.2"
 SSH_SERVER_EXECUTABLE_PATH = "/usr/local/bin/remote"
+SSH_SERVER_FILE_NAME = "ssh-server"
 CACHE_KEY = hashlib.md5(
     f"doh-okteto-cache-{SSH_SERVER_IMAGE_TAG}".encode()
 ).hexdigest()
+WHITEOUT_PREFIX = ".wh."
+
+LOG = logging.getLogger(__name__)
+
+
+def agent_path() -> Path:
+    return Env.get().shared_cache_path / "agent"
 
 
 def build_cache_key_path() -> Path:
-    return agent_path() / CACHE_KEY
+    """Tag file pointing to the binary extracted from SSH_SERVER_IMAGE_TAG"""
+    return agent_path() / "tags" / CACHE_KEY
 
 
-def agent_path() -> Path:
-    return Env.get().cache_path / "agent"
+def object_path(sha256: str) -> Path:
+    return agent_path() / "objects" / sha256
+
+
+def cached_object() -> Optional[Path]:
+    try:
+        tag = json.loads(build_cache_key_path().read_text())
+    except (OSError, ValueError):
+        return None
+    path = object_path(tag["sha256"])
+    if not (path / SSH_SERVER_FILE_NAME).is_file():
+        return None
+    return path
 
 
 def is_cache_valid():
-    return build_cache_key_path().is_file()
+    return cached_object() is not None
+
+
+def _copy_layer_file(layer: IO[bytes], path: str, out: IO[bytes]) -> bool:
+    """Copy `path` from layer tar stream to `out`
+
+    Returns True if layer has the file and False if the layer deletes it.
+    Raises KeyError if layer doesn't touch the file.
+    """
+    dirname, basename = os.path.split(path)
+    whiteout = os.path.join(dirname, WHITEOUT_PREFIX + basename)
+    with tarfile.open(fileobj=layer, mode="r|*") as tar:
+        for member in tar:
+            name = os.path.normpath(member.name.lstrip("/"))
+            if name == whiteout:
+                return False
+            if name == path and member.isfile():
+                shutil.copyfileobj(tar.extractfile(member), out)  # type: ignore
+                return True
+    raise KeyError(path)
+
 
+def extract_from_image_tarball(
+    stream: IO[bytes], path: str, out: IO[bytes]
+) -> None:
+    """Extract file from `docker image save` tar stream in a single pass
 
-def download_ssh_server() -> None:
-    key = build_cache_key_path()
+    Supports both legacy (`<id>/layer.tar`) and OCI (`blobs/sha256/<id>`)
+    layouts. Layer order is only known from manifest.json, which may come
+    after the layers, so every layer version of the file is kept until the
+    stream ends.
+    """
+    path = os.path.normpath(path.lstrip("/"))
+    versions: Dict[str, Optional[Path]] = {}
+    manifest: List[Dict[str, Any]] = []
 
-    shutil.rmtree(key.parent, ignore_errors=True)
-    key.parent.mkdir(exist_ok=True, parents=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with tarfile.open(fileobj=stream, mode="r|") as image:
+            for member in image:
+                f = image.extractfile(member) if member.isfile() else None
+                if f is None:
+                    continue
+                if member.name == "manifest.json":
+                    manifest = json.load(f)
+                    continue
+                if not (
+                    member.name.endswith("/layer.tar")
+                    or member.name.startswith("blobs/")
+                ):
+                    continue
 
-    run_args = [
-        "--rm",
-        *user_args(),
-        "--volume",
-        f"{key.parent}:/doh",
-    ]
+                version = Path(tmp_dir) / str(len(versions))
+                try:
+                    with version.open("wb") as version_f:
+                        present = _copy_layer_file(f, path, version_f)
+                except (KeyError, tarfile.ReadError):
+                    # ReadError: config or manifest blob in OCI layout
+                    continue
+                versions[member.name] = version if present else None
 
-    run_docker_run(
-        run_args,
-        SSH_SERVER_IMAGE_TAG,
-        ["cp", SSH_SERVER_EXECUTABLE_PATH, "/doh/ssh-server"],
+        if not manifest:
+            raise ValueError("Image tarball has no manifest.json")
+        for layer in reversed(manifest[0]["Layers"]):
+            if layer not in versions:
+                continue
+            layer_version = versions[layer]
+            if layer_version is None:
+                break
+            with layer_version.open("rb") as version_f:
+                shutil.copyfileobj(version_f, out)
+            return
+    raise FileNotFoundError(f"{path} not found in image")
+
+
+@contextlib.contextmanager
+def image_tarball(image_name: str) -> Iterator[IO[bytes]]:
+    """Stream of `docker image save` tarball of the image"""
+    client = engine_client()
+    if client is not None:
+        resp = client.export_image(image_name)
+        try:
+            yield resp
+            # Keep-alive connection is reusable only after the whole response
+            while resp.read(1 << 16):
+                pass
+        finally:
+            resp.close()
+        return
+
+    proc = subprocess.Popen(
+        ["docker", "image", "save", image_name], stdout=subprocess.PIPE
     )
-    key.touch()
+    assert proc.stdout is not None
+    try:
+        yield proc.stdout
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+
+
+def _write_tag(image_id: str, sha256: str) -> None:
+    tag_path = build_cache_key_path()
+    make_shared_dir(tag_path.parent)
+    tmp_path = tag_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(
+        json.dumps(
+            {
+                "image": SSH_SERVER_IMAGE_TAG,
+                "image_id": image_id,
+                "sha256": sha256,
+            }
+        )
+    )
+    tmp_path.chmod(0o644)
+    try:
+        tmp_path.replace(tag_path)
+    except PermissionError as e:
+        # Stale tag of another user, the object is still usable by path
+        LOG.debug(f"Can't update agent tag: {e}")
+        tmp_path.unlink()
+
 
+def download_ssh_server() -> Path:
+    """Extract ssh server binary from its image into the store"""
+    image = inspect_image(SSH_SERVER_IMAGE_TAG)
+    if image is None:
+        run_command(["docker", "pull", SSH_SERVER_IMAGE_TAG], check=True)
+        image = inspect_image(SSH_SERVER_IMAGE_TAG)
+    image_id = image["Id"] if image is not None else ""
 
+    objects = agent_path() / "objects"
+    make_shared_dir(objects)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=objects))
+    try:
+        binary = tmp_dir / SSH_SERVER_FILE_NAME
+        with binary.open("wb") as out, image_tarball(SSH_SERVER_IMAGE_TAG) as s:
+            extract_from_image_tarball(s, SSH_SERVER_EXECUTABLE_PATH, out)
+        binary.chmod(0o755)
+        tmp_dir.chmod(0o755)
+
+        sha256 = hashlib.sha256(binary.read_bytes()).hexdigest()
+        try:
+            tmp_dir.rename(object_path(sha256))
+        except OSError:
+            # Object is already there, objects with the same name are equal
+            if not (object_path(sha256) / SSH_SERVER_FILE_NAME).is_file():
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _write_tag(image_id, sha256)
+    return object_path(sha256)
+
+
+@contextlib.contextmanager
+def store_lock() -> Iterator[None]:
+    """Serializes extractions, lock file is shared by all users of the store"""
+    # If store dir isn't writable for us, rely on atomic renames only
+    with shared_file_lock(agent_path() / "locks" / f"{CACHE_KEY}.lock"):
+        yield
+
+
+@trace.traced("agent")
 def ensure_agent_present() -> Path:
-    if not is_cache_valid():
-        download_ssh_server()
-    return agent_path()
+    """Dir with the ssh server binary, to be mounted as /doh"""
+    path = cached_object()
+    if path is not None:
+        return path
+
+    with store_lock():
+        # Concurrent invocation may have done it while we waited for lock
+        path = cached_object()
+        if path is None:
+            LOG.info(f"Extracting ssh server from {SSH_SERVER_IMAGE_TAG}")
+            path = download_ssh_server()
+        return path
@@ -0,0 +1,230 @@
+"""Local BuildKit layer cache of project images
+
+With `build_cache` configured, images are built by `docker buildx build`
+with `--cache-to type=local` into a per-project dir under
+`cache_path/buildcache`, so layers survive `docker system prune`. Builds
+also import caches of other projects with the same base images. Export
+goes to a fresh dir which is swapped in after a successful build, total
+size of caches is bounded by evicting least recently used ones.
+"""
+
+from typing import Iterator, List, Optional
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from .config import BuildCacheParameters, Context
+from .env import Env
+from .fingerprint import dockerfile_path
+from .utils import parse_size
+
+BUILDER_NAME = "doh"
+META_SUFFIX = ".meta.json"
+# Leftovers of interrupted builds older than that are removed on prune
+STALE_TMP_SECONDS = 24 * 3600
+
+FROM_RE = re.compile(
+    r"^\s*FROM\s+(?:--platform=\S+\s+)?(\S+)(?:\s+AS\s+(\S+))?",
+    re.IGNORECASE,
+)
+
+LOG = logging.getLogger(__name__)
+
+
+def cache_root() -> Path:
+    return Env.get().cache_path / "buildcache"
+
+
+def cache_dir(context: Context) -> Path:
+    return cache_root() / context.image_name.replace("/", "_")
+
+
+def meta_path(cache: Path) -> Path:
+    return cache.with_name(cache.name + META_SUFFIX)
+
+
+def base_images(dockerfile: Path) -> List[str]:
+    """Images the Dockerfile stages start from, stage references excluded"""
+    stages = set()
+    bases = []
+    for line in dockerfile.read_text().splitlines():
+        match = FROM_RE.match(line)
+        if match is None:
+            continue
+        image, stage = match.groups()
+        if image.lower() not in stages:
+            bases.append(image)
+        if stage:
+            stages.add(stage.lower())
+    return bases
+
+
+def base_key(bases: List[str]) -> str:
+    return hashlib.sha256(json.dumps(bases).encode()).hexdigest()[:16]
+
+
+def peer_caches(key: str, own: Path) -> List[Path]:
+    """Caches of other projects with the same base images"""
+    peers = []
+    for meta in cache_root().glob(f"*{META_SUFFIX}"):
+        cache = meta.with_name(meta.name[: -len(META_SUFFIX)])
+        if cache == own:
+            continue
+        try:
+            if json.loads(meta.read_text())["base_key"] != key:
+                continue
+        except (OSError, ValueError, KeyError):
+            continue
+        if (cache / "index.json").is_file():
+            peers.append(cache)
+    return peers
+
+
+def ensure_builder() -> str:
+    """Buildx builder with docker-container driver, required for cache export"""
+    res = subprocess.run(
+        ["docker", "buildx", "inspect", BUILDER_NAME], capture_output=True
+    )
+    if res.returncode != 0:
+        LOG.info(f"Creating buildx builder {BUILDER_NAME}")
+        subprocess.run(
+            [
+                "docker",
+                "buildx",
+                "create",
+                "--name",
+                BUILDER_NAME,
+                "--driver",
+                "docker-container",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    return BUILDER_NAME
+
+
+def buildx_argv(build_argv: List[str], args: List[str]) -> Optional[List[str]]:
+    """Turn `docker [buildx] build ...` to `docker buildx build <args> ...`"""
+    if build_argv[:2] == ["docker", "build"]:
+        rest = build_argv[2:]
+    elif build_argv[:3] == ["docker", "buildx", "build"]:
+        rest = build_argv[3:]
+    else:
+        return None
+    return ["docker", "buildx", "build", *args, *rest]
+
+
+def swap_in(new_cache: Path, cache: Path) -> None:
+    old = cache.with_name(f".{cache.name}.old-{os.getpid()}")
+    try:
+        cache.rename(old)
+    except FileNotFoundError:
+        pass
+    try:
+        new_cache.rename(cache)
+    except OSError:
+        # Concurrent build has swapped in its cache, it is as good as ours
+        shutil.rmtree(new_cache, ignore_errors=True)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            with contextlib.suppress(OSError):
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+
+def last_used(cache: Path) -> float:
+    for path in (meta_path(cache), cache):
+        with contextlib.suppress(OSError):
+            return path.stat().st_mtime
+    return 0
+
+
+def prune_caches(max_size: int, keep: Optional[Path] = None) -> None:
+    """Evict least recently used caches until total size fits `max_size`"""
+    root = cache_root()
+    caches = []
+    for path in root.iterdir():
+        if path.name.startswith("."):
+            if time.time() - last_used(path) > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        elif path.is_dir():
+            caches.append((last_used(path), path, dir_size(path)))
+
+    total = sum(size for _, _, size in caches)
+    for _, path, size in sorted(caches):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        LOG.debug(f"Evicting build cache {path.name}")
+        shutil.rmtree(path, ignore_errors=True)
+        meta_path(path).unlink(missing_ok=True)
+        total -= size
+
+
+@contextlib.contextmanager
+def local_build_cache(
+    params: BuildCacheParameters, context: Context, build_argv: List[str]
+) -> Iterator[List[str]]:
+    """Build command with local cache import/export
+
+    Cache is saved only if the body (the build) succeeds.
+    """
+    cache = cache_dir(context)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        dockerfile = dockerfile_path(context.project_dir, build_argv)
+        bases = base_images(dockerfile)
+    except OSError:
+        bases = []
+    key = base_key(bases)
+
+    sources = [cache] if (cache / "index.json").is_file() else []
+    sources += peer_caches(key, cache)
+    new_cache = Path(
+        tempfile.mkdtemp(prefix=f".{cache.name}.new-", dir=cache.parent)
+    )
+    args = [
+        "--builder",
+        params.builder or ensure_builder(),
+        "--load",
+        "--cache-to",
+        f"type=local,dest={new_cache},mode=max",
+    ]
+    for source in sources:
+        args += ["--cache-from", f"type=local,src={source}"]
+
+    argv = buildx_argv(build_argv, args)
+    if argv is None:
+        LOG.warning("build_cache works only with docker build commands")
+        shutil.rmtree(new_cache)
+        yield build_argv
+        return
+
+    try:
+        yield argv
+    except BaseException:
+        shutil.rmtree(new_cache, ignore_errors=True)
+        raise
+
+    swap_in(new_cache, cache)
+    meta_path(cache).write_text(json.dumps({"base_key": key, "bases": bases}))
+    for source in sources:
+        # Mark imported caches as recently used
+        with contextlib.suppress(OSError):
+            os.utime(meta_path(source))
+    prune_caches(parse_size(params.max_size), keep=cache)
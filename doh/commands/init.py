@@ -1,4 +1,3 @@
-import random
 from pathlib import Path
 
 from doh.config import (
@@ -10,6 +9,7 @@ from doh.config import (
     merge_models,
     save_config,
 )
+from doh.ports import allocate_port
 
 
 def init(context: Context) -> None:
@@ -19,7 +19,7 @@ def init(context: Context) -> None:
         update_config = Config.construct()
     else:
         current_config = Config(
-            ssh_port=random.randint(22_000, 23_000),
+            ssh_port=allocate_port(context),
             environment={"HOME": "$HOME"},
             hosts={"all": Parameters()},
         )
@@ -29,7 +29,7 @@ def init(context: Context) -> None:
         update_config.hosts[context.hostname] = Parameters()
 
     if current_config.ssh_port == 0:
-        update_config.ssh_port = random.randint(22_000, 23_000)
+        update_config.ssh_port = allocate_port(context)
 
     if current_config.use_local_config:
         if (
@@ -0,0 +1,258 @@
+"""Pool of pre-started kernel containers
+
+Every pool container gets its own slot dir mounted at SLOT_CONTAINER_PATH.
+Container process imports ipykernel, marks the slot ready and waits for
+connection file to appear in it. `kernel-run` claims a ready slot by
+atomically creating `claimed` dir in it and writes connection file there,
+so kernel start costs neither container creation nor ipykernel import.
+
+Jupyter picks kernel ports itself after the container has been started,
+so pool containers use host network.
+"""
+
+from typing import Any, Dict, List, Optional, cast
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from doh import trace
+from doh.config import Context
+from doh.docker import (
+    container_memory_usage,
+    container_name,
+    inspect_image,
+    list_containers,
+    remove_container,
+    run_docker_cli,
+)
+from doh.env import Env
+from doh.placement import placement_args
+from doh.plan import resolve_run_args
+from doh.prebuilt import launch_image
+from doh.utils import file_lock, parse_size
+
+from .run import parse_conn_spec, patch_connection_ip
+
+POOL_LABEL = "doh.kernel-pool"
+RUN_ARGS_HASH_LABEL = "doh.run-args-hash"
+SLOT_CONTAINER_PATH = "/doh-kernel"
+READY_MARKER = "ready"
+CLAIMED_DIR = "claimed"
+OWNER_FILE = "owner"
+CONNECTION_FILE = "connection.json"
+
+POOL_WAITER = f"""
+import os, sys, time
+from ipykernel.kernelapp import IPKernelApp
+slot = sys.argv[1]
+open(os.path.join(slot, "{READY_MARKER}"), "w").close()
+connection_file = os.path.join(slot, "{CONNECTION_FILE}")
+while not os.path.exists(connection_file):
+    time.sleep(0.02)
+IPKernelApp.launch_instance(argv=["-f", connection_file])
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+def pool_dir(context: Context) -> Path:
+    return (
+        Env.get().cache_path / "kernel-pool" / container_name("kernel", context)
+    )
+
+
+def pool_run_args_hash(context: Context, run_args: List[str]) -> str:
+    image = inspect_image(launch_image(context))
+    image_id = image["Id"] if image is not None else ""
+    key = json.dumps([image_id, run_args, POOL_WAITER])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def pool_containers(context: Context) -> List[Dict[str, Any]]:
+    return list_containers(
+        filters={"label": [f"{POOL_LABEL}={context.environment_id}"]}
+    )
+
+
+def _name(container: Dict[str, Any]) -> str:
+    return cast(str, container["Names"][0].lstrip("/"))
+
+
+def _is_claimed(slot: Path) -> bool:
+    return (slot / CLAIMED_DIR).is_dir()
+
+
+def _owner_alive(slot: Path) -> bool:
+    try:
+        os.kill(int((slot / CLAIMED_DIR / OWNER_FILE).read_text()), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def start_pool_container(
+    context: Context, run_args: List[str], args_hash: str
+) -> None:
+    name = f"{container_name('kernel', context)}-{uuid.uuid4().hex[:8]}"
+    slot = pool_dir(context) / name
+    slot.mkdir(parents=True)
+
+    config = context.config
+    assert config.kernel_pool is not None
+    argv = [
+        "docker",
+        "run",
+        *run_args,
+        "--detach",
+        "--name",
+        name,
+        "--network",
+        "host",
+        *placement_args(context),
+        "--label",
+        f"{POOL_LABEL}={context.environment_id}",
+        "--label",
+        f"{RUN_ARGS_HASH_LABEL}={args_hash}",
+        "--volume",
+        f"{slot}:{SLOT_CONTAINER_PATH}",
+        launch_image(context),
+        "/usr/bin/env",
+        "python",
+        "-c",
+        POOL_WAITER,
+        SLOT_CONTAINER_PATH,
+    ]
+    LOG.debug(f"Starting pool container {name}")
+    subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+
+
+def fill_pool(context: Context) -> None:
+    """Remove stale pool containers and start new ones up to the pool size"""
+    config = context.config
+    if config.kernel_pool is None:
+        return
+    memory_cap = (
+        parse_size(config.kernel_pool.memory_cap)
+        if config.kernel_pool.memory_cap
+        else None
+    )
+
+    with file_lock(pool_dir(context) / ".lock"):
+        run_args = resolve_run_args(context, request_tty=False)
+        args_hash = pool_run_args_hash(context, run_args)
+
+        idle = []
+        for container in pool_containers(context):
+            name = _name(container)
+            slot = pool_dir(context) / name
+            if _is_claimed(slot):
+                if not _owner_alive(slot):
+                    LOG.debug(f"Removing orphaned kernel container {name}")
+                    remove_container(name)
+            elif container["Labels"].get(RUN_ARGS_HASH_LABEL) != args_hash:
+                LOG.debug(f"Removing outdated pool container {name}")
+                remove_container(name)
+            else:
+                idle.append(name)
+
+        alive = {_name(c) for c in pool_containers(context)}
+        for slot in pool_dir(context).iterdir():
+            if slot.is_dir() and slot.name not in alive:
+                shutil.rmtree(slot, ignore_errors=True)
+
+        used_memory = sum(container_memory_usage(n) for n in idle)
+        per_container = used_memory // len(idle) if idle else 0
+        while len(idle) < config.kernel_pool.size:
+            if (
+                memory_cap is not None
+                and used_memory + per_container > memory_cap
+            ):
+                LOG.info("Kernel pool reached its memory cap")
+                break
+            if memory_cap is not None and not per_container and idle:
+                # Footprint is unknown until a ready container is measured
+                break
+            start_pool_container(context, run_args, args_hash)
+            idle.append("")
+            used_memory += per_container
+
+
+def spawn_pool_fill(context: Context) -> None:
+    """Refill the pool in a detached background process"""
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "doh",
+            "kernel-pool-fill",
+            str(context.project_dir),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+@trace.traced("kernel_pool_claim")
+def claim_slot(context: Context) -> Optional[Path]:
+    """Claim a ready pool container, return its slot dir"""
+    run_args = resolve_run_args(context, request_tty=False)
+    args_hash = pool_run_args_hash(context, run_args)
+
+    for container in pool_containers(context):
+        if container["Labels"].get(RUN_ARGS_HASH_LABEL) != args_hash:
+            continue
+        slot = pool_dir(context) / _name(container)
+        if not (slot / READY_MARKER).is_file():
+            continue
+        try:
+            (slot / CLAIMED_DIR).mkdir()
+        except OSError:
+            continue  # Claimed by a concurrent kernel-run
+        (slot / CLAIMED_DIR / OWNER_FILE).write_text(str(os.getpid()))
+        return slot
+    return None
+
+
+def hand_connection_file(slot: Path, kernel_conn_spec_path: Path) -> None:
+    ip, _ = parse_conn_spec(kernel_conn_spec_path)
+    with NamedTemporaryFile("w", dir=slot, suffix=".tmp", delete=False) as f:
+        # Kernel shares host network, so it listens exactly where jupyter expects
+        patch_connection_ip(kernel_conn_spec_path, f, ip)
+    # Container waits for the file to appear, it must appear complete
+    os.replace(f.name, slot / CONNECTION_FILE)
+
+
+def run_pooled_kernel(context: Context, kernel_conn_spec_path: Path) -> bool:
+    """Run kernel in a pool container, False if there is no ready one"""
+    slot = claim_slot(context)
+    spawn_pool_fill(context)
+    if slot is None:
+        LOG.info("No ready containers in kernel pool, starting a new one")
+        return False
+
+    name = slot.name
+    LOG.debug(f"Using pool container {name}")
+    hand_connection_file(slot, kernel_conn_spec_path)
+    trace.mark_launched()
+    try:
+        with trace.span("container"):
+            run_docker_cli(f"attach --no-stdin {name}")
+    finally:
+        remove_container(name)
+        shutil.rmtree(slot, ignore_errors=True)
+    return True
+
+
+def drain_pool(context: Context) -> None:
+    for container in pool_containers(context):
+        remove_container(_name(container))
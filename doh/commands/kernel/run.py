@@ -5,12 +5,15 @@ import os
 import shlex
 import subprocess
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 
+from doh import trace
 from doh.config import Context
-from doh.docker import build_image, docker_run_args_from_project, run_docker_run
+from doh.docker import handoff_docker_run, run_docker_run
+from doh.plan import prepare_launch
+from doh.prebuilt import launch_image
 
 KERNEL_CONN_SPEC_CONTAINER_PATH = "/kernel-connection-spec.json"
+PATCHED_SPEC_PREFIX = "doh-patched-"
 IPYKERNEL_CMD = (
     f"/usr/bin/env python -m ipykernel -f {KERNEL_CONN_SPEC_CONTAINER_PATH}"
 )
@@ -26,12 +29,31 @@ def patch_connection_ip(
     file.flush()
 
 
+def port_ranges(ports: List[int]) -> List[Tuple[int, int]]:
+    """Contiguous (first, last) runs of ports"""
+    res: List[Tuple[int, int]] = []
+    for port in sorted(set(ports)):
+        if res and res[-1][1] == port - 1:
+            res[-1] = (res[-1][0], port)
+        else:
+            res.append((port, port))
+    return res
+
+
 def docker_run_args_for_kernel(
-    orig_conn_spec_path: Path, patched_conn_spec_path: str
+    orig_conn_spec_path: Path,
+    patched_conn_spec_path: str,
+    network: str = "publish",
 ) -> List[str]:
     ip, ports = parse_conn_spec(orig_conn_spec_path)
 
-    args: List[str] = sum((["--publish", f"{ip}:{p}:{p}"] for p in ports), [])
+    if network == "host":
+        args = ["--network", "host"]
+    else:
+        args = []
+        for first, last in port_ranges(ports):
+            spec = str(first) if first == last else f"{first}-{last}"
+            args += ["--publish", f"{ip}:{spec}:{spec}"]
     args += [
         "--volume",
         f"{patched_conn_spec_path}:{KERNEL_CONN_SPEC_CONTAINER_PATH}",
@@ -39,6 +61,20 @@ def docker_run_args_for_kernel(
     return args
 
 
+def patched_spec_path(conn_spec_path: Path) -> Path:
+    return conn_spec_path.with_name(
+        f"{PATCHED_SPEC_PREFIX}{conn_spec_path.name}"
+    )
+
+
+def remove_stale_patched_specs(runtime_dir: Path) -> None:
+    """Remove patched specs of kernels whose connection file is gone"""
+    for path in runtime_dir.glob(f"{PATCHED_SPEC_PREFIX}*.json"):
+        original = path.with_name(path.name[len(PATCHED_SPEC_PREFIX) :])
+        if not original.exists():
+            path.unlink(missing_ok=True)
+
+
 def parse_conn_spec(path: Path) -> Tuple[str, List[int]]:
     conn_spec = json.loads(path.read_text())
     return conn_spec.get("ip", "127.0.0.1"), [
@@ -49,28 +85,56 @@ def parse_conn_spec(path: Path) -> Tuple[str, List[int]]:
 
 
 def run_kernel(
-    project: Context, kernel_conn_spec_path: Path, build: bool
+    project: Context,
+    kernel_conn_spec_path: Path,
+    build: bool,
+    force_build: bool = False,
 ) -> None:
     os.chdir(project.project_dir)
-    if build:
-        build_image(project.config, project)
-
-    if project.config.before_command:
-        subprocess.run(shlex.split(project.config.before_command), check=True)
-
-    run_args = docker_run_args_from_project(project, request_tty=False)
-
-    if project.config.after_command:
-        subprocess.run(shlex.split(project.config.after_command), check=True)
-
-    with NamedTemporaryFile(
-        "w",
-        prefix="doh-kernel_",
-        suffix=".json",
-        dir=kernel_conn_spec_path.parent,
-    ) as patched_conn_spec:
-        patch_connection_ip(kernel_conn_spec_path, patched_conn_spec)
-        run_args += docker_run_args_for_kernel(
-            kernel_conn_spec_path, patched_conn_spec.name
+    run_args = prepare_launch(project, build, force_build, request_tty=False)
+    after_command = project.config.after_command
+    try:
+        run_kernel_container(project, kernel_conn_spec_path, run_args)
+    finally:
+        if after_command:
+            with trace.span("after_command"):
+                subprocess.run(shlex.split(after_command), check=True)
+
+
+def run_kernel_container(
+    project: Context, kernel_conn_spec_path: Path, run_args: List[str]
+) -> None:
+    if project.config.kernel_pool is not None:
+        from .pool import run_pooled_kernel
+
+        if run_pooled_kernel(project, kernel_conn_spec_path):
+            return
+
+    remove_stale_patched_specs(kernel_conn_spec_path.parent)
+    patched_path = patched_spec_path(kernel_conn_spec_path)
+    network = project.config.kernel_network
+    with patched_path.open("w") as patched_conn_spec:
+        if network == "host":
+            ip, _ = parse_conn_spec(kernel_conn_spec_path)
+            patch_connection_ip(kernel_conn_spec_path, patched_conn_spec, ip)
+        else:
+            patch_connection_ip(kernel_conn_spec_path, patched_conn_spec)
+    run_args = run_args + docker_run_args_for_kernel(
+        kernel_conn_spec_path, str(patched_path), network
+    )
+    trace.mark_launched()
+    if project.config.exec_handoff:
+        # Patched spec outlives doh, it's removed by a later kernel start
+        # once jupyter removes the original one. after_command is run by
+        # the supervisor doh is replaced with
+        handoff_docker_run(
+            run_args,
+            launch_image(project),
+            IPYKERNEL_CMD,
+            project.config.after_command,
         )
-        run_docker_run(run_args, project.image_name, IPYKERNEL_CMD)
+    try:
+        with trace.span("container"):
+            run_docker_run(run_args, launch_image(project), IPYKERNEL_CMD)
+    finally:
+        patched_path.unlink(missing_ok=True)
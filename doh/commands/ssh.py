@@ -1,22 +1,29 @@
 from typing import List
 
+import contextlib
 import shlex
 import subprocess
 from pathlib import Path
 
 import typer
+from doh import trace
 from doh.agent import ensure_agent_present
 from doh.config import Config, Context
-from doh.docker import build_image, docker_run_args_from_project, run_docker_run
+from doh.docker import handoff_docker_run, run_docker_run
+from doh.pipeline import Step
+from doh.plan import prepare_launch
+from doh.ports import PORT_LABEL, PortUnavailableError, lease_port
+from doh.prebuilt import launch_image
 
 SSH_SERVER_KEYS_PATH = "/var/okteto/remote/authorized_keys"
 SSH_SERVER_DEFAULT_PORT = 2222
 
 
-def run_ssh_server(context: Context, build: bool) -> None:
+def run_ssh_server(
+    context: Context, build: bool, force_build: bool = False
+) -> None:
     config = context.config
-    if build:
-        build_image(config, context)
+    check_ssh_port(config)
 
     typer.secho(
         "Your SSH config is below. Append it to your ~/.ssh/config\n\n",
@@ -35,25 +42,47 @@ def run_ssh_server(context: Context, build: bool) -> None:
     )
     cmd = ["/doh/ssh-server"]
 
-    if config.before_command:
-        subprocess.run(shlex.split(config.before_command), check=True)
-
-    run_args = docker_run_args_from_project(context)
-    run_args += prepare_run_args_for_ssh_server(config, context)
-    run_docker_run(run_args, context.image_name, cmd)
+    with contextlib.ExitStack() as stack:
+        # Port is checked and held before the build, a collision fails fast
+        try:
+            stack.enter_context(lease_port(context, config.ssh_port))
+        except PortUnavailableError as e:
+            typer.secho(str(e), fg=typer.colors.RED)
+            raise typer.Exit(1)
+
+        run_args = prepare_launch(
+            context,
+            build,
+            force_build,
+            extra_steps=[Step("agent", ensure_agent_present)],
+        )
+        run_args += prepare_run_args_for_ssh_server(config, context)
+        trace.mark_launched()
+        if config.exec_handoff:
+            # Pid is kept, so the port lease stays valid until docker exits
+            handoff_docker_run(
+                run_args, launch_image(context), cmd, config.after_command
+            )
+        with trace.span("container"):
+            run_docker_run(run_args, launch_image(context), cmd)
 
     if config.after_command:
-        subprocess.run(shlex.split(config.after_command), check=True)
+        with trace.span("after_command"):
+            subprocess.run(shlex.split(config.after_command), check=True)
 
 
-def prepare_run_args_for_ssh_server(
-    config: Config, context: Context
-) -> List[str]:
+def check_ssh_port(config: Config) -> None:
     if config.ssh_port == 0:
         typer.secho(
             "SSH port is not configured. Run `doh init`", fg=typer.colors.RED
         )
         raise typer.Exit()
+
+
+def prepare_run_args_for_ssh_server(
+    config: Config, context: Context
+) -> List[str]:
+    check_ssh_port(config)
     agent_path = ensure_agent_present()
     bin_mount_arg = ["--volume", f"{agent_path}:/doh:ro"]
 
@@ -63,6 +92,7 @@ def prepare_run_args_for_ssh_server(
     ]
 
     res = bin_mount_arg + port_share_arg
+    res += ["--label", f"{PORT_LABEL}={config.ssh_port}"]
 
     auth_keys_path = Path.home() / ".ssh/authorized_keys"
 
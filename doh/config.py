@@ -1,50 +1,131 @@
-from typing import Dict, List, Optional, TypeVar
+from typing import (
+    Any,
+    Dict,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import collections.abc
 import dataclasses
 import getpass
+import hashlib
+import json
 import logging
+import os
+import re
 import socket
 from enum import Enum
 from functools import cached_property
 from pathlib import Path
 
-import envtoml
 import pydantic
-import toml
 from pydantic import BaseModel, Field
-from toml import TomlPathlibEncoder
+
+from . import trace
+from .env import Env
+
+# Same pattern envtoml uses for interpolation
+ENV_VAR_RE = re.compile(r"\$([A-Z_][A-Z0-9_]+)")
+CONFIG_CACHE_VERSION = 2
 
 LOG = logging.getLogger(__name__)
 
 
+def _item_key(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return ("json", json.dumps(value, sort_keys=True, default=str))
+    return (type(value).__name__, value)
+
+
+# Lists of command line arguments, repeated items are meaningful there
+ARGV_LIST_PATHS = {"run_extra_args"}
+
+
+class LayerMerger:
+    """Merges nested dicts layer by layer in time linear to their size
+
+    Later layers win for scalars, dicts are merged recursively. A list is
+    kept as the layer wrote it, items of later layers are appended unless
+    an earlier layer already has them (argv lists are just concatenated).
+    Origin layer of every leaf and list item is recorded in `sources` by
+    dotted path (`hosts.all.bind_paths[2]`).
+    """
+
+    def __init__(self) -> None:
+        self.values: Dict[str, Any] = {}
+        self.sources: Dict[str, str] = {}
+        self._list_keys: Dict[str, Set[Any]] = {}
+
+    def merge(
+        self,
+        layer: str,
+        new: Mapping[str, Any],
+        into: Optional[Dict[str, Any]] = None,
+        prefix: str = "",
+    ) -> None:
+        target = self.values if into is None else into
+        for k, v in new.items():
+            path = f"{prefix}{k}"
+            current = target.get(k)
+            if isinstance(v, collections.abc.Mapping) and isinstance(
+                current, dict
+            ):
+                self.merge(layer, v, current, f"{path}.")
+            elif isinstance(v, list) and isinstance(current, list):
+                keys = self._list_keys[path]
+                new_keys = set()
+                for item in v:
+                    key = _item_key(item)
+                    if path in ARGV_LIST_PATHS or key not in keys:
+                        new_keys.add(key)
+                        self.sources[f"{path}[{len(current)}]"] = layer
+                        current.append(item)
+                keys |= new_keys
+            else:
+                if isinstance(current, (dict, list)):
+                    self._forget(path)
+                target[k] = self._own(layer, v, path)
+
+    def _own(self, layer: str, value: Any, path: str) -> Any:
+        """Copy value recording its origin"""
+        if isinstance(value, collections.abc.Mapping):
+            return {
+                k: self._own(layer, v, f"{path}.{k}") for k, v in value.items()
+            }
+        if isinstance(value, list):
+            for i in range(len(value)):
+                self.sources[f"{path}[{i}]"] = layer
+            self._list_keys[path] = set(map(_item_key, value))
+            return list(value)
+        self.sources[path] = layer
+        return value
+
+    def _forget(self, path: str) -> None:
+        prefixes = (f"{path}.", f"{path}[")
+        for mapping in (self.sources, self._list_keys):
+            for key in [k for k in mapping if k.startswith(prefixes)]:
+                del mapping[key]
+        self._list_keys.pop(path, None)
+
+
 def dict_merge(*args, add_keys=True):
-    """Stolen from https://gist.github.com/angstwad/bf22d1822c38a92ec0a9#gistcomment-3305932"""
     assert len(args) >= 2, "dict_merge requires at least two dicts to merge"
-    rtn_dct = args[0].copy()
-    merge_dicts = args[1:]
-    for merge_dct in merge_dicts:
+    merger = LayerMerger()
+    merger.merge("0", args[0])
+    for i, merge_dct in enumerate(args[1:], start=1):
         if add_keys is False:
             merge_dct = {
                 key: merge_dct[key]
-                for key in set(rtn_dct).intersection(set(merge_dct))
+                for key in set(merger.values).intersection(set(merge_dct))
             }
-        for k, v in merge_dct.items():
-            if not rtn_dct.get(k):
-                rtn_dct[k] = v
-            elif isinstance(rtn_dct[k], dict) and isinstance(
-                merge_dct[k], collections.abc.Mapping
-            ):
-                rtn_dct[k] = dict_merge(
-                    rtn_dct[k], merge_dct[k], add_keys=add_keys
-                )
-            elif isinstance(v, list):
-                for list_value in v:
-                    if list_value not in rtn_dct[k]:
-                        rtn_dct[k].append(list_value)
-            else:
-                rtn_dct[k] = v
-    return rtn_dct
+        merger.merge(str(i), merge_dct)
+    return merger.values
 
 
 _ModelType = TypeVar("_ModelType", bound=BaseModel)
@@ -58,13 +139,77 @@ def merge_models(m1: _ModelType, m2: _ModelType) -> _ModelType:
     return m1.construct(**dm)
 
 
+class PlacementParameters(BaseModel):
+    # Number of NUMA nodes a container is pinned to
+    max_nodes: int = 1
+    # Limit of CPUs of a container, all CPUs of its nodes by default
+    max_cpus: Optional[int] = None
+
+
 class Parameters(pydantic.BaseModel):
     bind_paths: List[str] = []
+    # Pin containers to the least loaded NUMA nodes of the host
+    placement: Optional[PlacementParameters] = None
 
 
 class FakeHomeParameters(BaseModel):
     root: Path = Path(".doh/home")
     real_paths: List[str] = []
+    # "mount" bind mounts every real path, "snapshot" copies them into root
+    mode: Literal["mount", "snapshot"] = "mount"
+
+
+class WarmParameters(BaseModel):
+    # Seconds without commands before warm container is stopped
+    idle_timeout: int = 600
+
+
+class KernelPoolParameters(BaseModel):
+    # Number of idle pre-started kernel containers to keep
+    size: int = 2
+    # Limit of memory used by idle containers of the pool, e.g. "8g"
+    memory_cap: Optional[str] = None
+
+
+class BuildCacheParameters(BaseModel):
+    # Limit of total size of local build caches of all projects, e.g. "20g"
+    max_size: str = "20g"
+    # Buildx builder, local cache export needs a docker-container driver one.
+    # By default doh creates such builder named "doh"
+    builder: Optional[str] = None
+
+
+# Container paths of caches which `cache_volumes` can refer to by name only
+WELL_KNOWN_CACHES = {
+    "pip": "~/.cache/pip",
+    "uv": "~/.cache/uv",
+    "poetry": "~/.cache/pypoetry",
+    "conda": "~/.conda/pkgs",
+    "npm": "~/.npm",
+    "torch": "~/.cache/torch",
+    "huggingface": "~/.cache/huggingface",
+}
+
+
+class CacheVolumeParameters(BaseModel):
+    # Container path, "~" is the home dir. Defaults to the path of the
+    # well-known cache with the same name
+    path: Optional[str] = None
+    # "project" volume per project and user, "shared" by all projects
+    scope: Literal["project", "shared"] = "project"
+
+
+class GCParameters(BaseModel):
+    # Disk budget of doh and dangling images, e.g. "50g"
+    max_size: str = "50g"
+    # Collect garbage when a build starts
+    auto: bool = True
+
+
+class SyncParameters(BaseModel):
+    # Mirror of the project on the docker host, "ssh://[user@]host/path"
+    # or a local path (e.g. NFS share). Mirror is mounted at the project path
+    target: str
 
 
 class Config(pydantic.BaseModel):
@@ -72,6 +217,10 @@ class Config(pydantic.BaseModel):
     workdir_from_host: bool = True
     ssh_port: int = 0
     image_build_command: str = "docker build . -t {image_name}"
+    # Prebuilt image to use as is instead of building, e.g. "team/base:1.2"
+    image: Optional[str] = None
+    # Seconds the digest `image` tag resolved to is reused before re-pulling
+    image_ttl: int = 86400
     use_local_config: bool = False
     environment: Dict[str, str] = {}
     sh_cmd: str = "bash"
@@ -81,6 +230,30 @@ class Config(pydantic.BaseModel):
     run_extra_args: List[str] = Field(default_factory=list)
     before_command: Optional[str] = None
     after_command: Optional[str] = None
+    # before_command runs after image build, disable to run them concurrently
+    before_command_needs_image: bool = True
+    warm: Optional[WarmParameters] = None
+    kernel_pool: Optional[KernelPoolParameters] = None
+    build_cache: Optional[BuildCacheParameters] = None
+    # Concurrent doh processes wait for a running build of the image instead
+    # of starting their own, a build running for longer is considered hung
+    build_lock_timeout: int = 3600
+    # Build into a host-wide image named by the build fingerprint, users with
+    # identical build inputs reuse it instead of building their own copy
+    shared_images: bool = False
+    sync: Optional[SyncParameters] = None
+    gc: Optional[GCParameters] = None
+    # Docker named volumes outliving containers, e.g. `cache_volumes.pip = {}`
+    cache_volumes: Dict[str, CacheVolumeParameters] = {}
+    # Scratch tmpfs mounts, container path -> size limit, e.g. {"/tmp": "8g"}
+    tmpfs: Dict[str, str] = {}
+    # How kernel ports are exposed: "publish" publishes each port of the
+    # connection file (a docker-proxy process per port), "host" runs kernel
+    # in the host network, it listens on the connection file ip directly
+    kernel_network: Literal["publish", "host"] = "publish"
+    # Replace doh process with `docker run` (or a minimal supervisor if
+    # after_command is set) instead of waiting for the container
+    exec_handoff: bool = True
 
     def is_nontrivial(self):
         return len(self.dict(exclude_unset=True)) > 0
@@ -94,20 +267,25 @@ class Context:
     username: str = getpass.getuser()
 
     @property
-    def image_name(self):
+    def image_name(self) -> str:
         return f"{self.project_name}-{self.username}"
 
     @property
-    def environment_id(self):
+    def environment_id(self) -> str:
         return f"{self.project_name}__{self.hostname}"
 
     @cached_property
     def config(self):
         return load_final_config(self)
 
+    def project_path(self, path: Union[str, Path]) -> Path:
+        """Config path, relative ones are relative to the project dir"""
+        return self.project_dir / path
+
     @classmethod
     def create_for_path(cls, path: Path) -> "Context":
         path = path.resolve()
+        trace.annotate(project=str(path))
         return cls(project_dir=path, project_name=path.name.lower())
 
     @classmethod
@@ -129,68 +307,281 @@ class ConfigType(Enum):
         raise NotImplemented
 
 
+USER_CONFIG_FILE_NAME = "dohrc.toml"
+# DOH_SSH_PORT=2222 or DOH_FAKE_HOME__ROOT=/tmp/home override config values
+ENV_OVERRIDE_PREFIX = "DOH_"
+ENV_OVERRIDE_SEPARATOR = "__"
+
+
+@dataclasses.dataclass
+class ConfigLayer:
+    name: str
+    values: Dict[str, Any]
+
+
+def user_config_path() -> Path:
+    return Env.get().config_path / USER_CONFIG_FILE_NAME
+
+
+def config_file_paths(context: Context) -> List[Path]:
+    return [
+        user_config_path(),
+        context.project_dir / ConfigType.GLOBAL.file_name(),
+        context.project_dir / ConfigType.LOCAL.file_name(),
+    ]
+
+
+def env_overrides() -> Dict[str, str]:
+    return {
+        k: v for k, v in os.environ.items() if k.startswith(ENV_OVERRIDE_PREFIX)
+    }
+
+
+def env_override_values() -> Dict[str, Any]:
+    import toml
+
+    values: Dict[str, Any] = {}
+    for name, raw in sorted(env_overrides().items()):
+        path = name[len(ENV_OVERRIDE_PREFIX) :].lower()
+        keys = path.split(ENV_OVERRIDE_SEPARATOR)
+        if keys[0] not in Config.__fields__:
+            continue
+        try:
+            value = toml.loads(f"value = {raw}")["value"]
+        except toml.TomlDecodeError:
+            value = raw
+        target = values
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return values
+
+
+def config_layers(
+    context: Context, interpolate_env: bool = True
+) -> List[ConfigLayer]:
+    """Config layers from the least to the most specific"""
+    import envtoml
+    import toml
+
+    load_fn = envtoml.load if interpolate_env else toml.load
+
+    user_path, project_path, local_path = config_file_paths(context)
+    layers = [
+        ConfigLayer(name, load_fn(path))
+        for name, path in [("user", user_path), ("project", project_path)]
+        if path.is_file()
+    ]
+    env_layer = ConfigLayer("env", env_override_values())
+
+    use_local_config = False
+    for layer in layers + [env_layer]:
+        use_local_config = layer.values.get(
+            "use_local_config", use_local_config
+        )
+    if use_local_config and local_path.is_file():
+        layers.append(ConfigLayer("local", load_fn(local_path)))
+
+    return layers + [env_layer]
+
+
+@dataclasses.dataclass
+class ResolvedConfig:
+    config: Config
+    # Dotted value path -> name of the layer value came from
+    sources: Dict[str, str]
+
+
+def merge_config_layers(
+    context: Context, interpolate_env: bool = True
+) -> LayerMerger:
+    merger = LayerMerger()
+    for layer in config_layers(context, interpolate_env):
+        merger.merge(layer.name, layer.values)
+    return merger
+
+
+def resolve_config(context: Context) -> ResolvedConfig:
+    """Merge all config layers and apply section of the current host
+
+    Host section goes on top of the file layers, env overrides are the most
+    specific layer and are merged last.
+    """
+    *file_layers, env_layer = config_layers(context)
+    merger = LayerMerger()
+    for layer in file_layers:
+        merger.merge(layer.name, layer.values)
+
+    hosts = merger.values.setdefault("hosts", {})
+    all_hosts = hosts.get("all")
+    if not isinstance(all_hosts, dict):
+        merger.merge("default", {"all": {}}, hosts, "hosts.")
+        all_hosts = hosts["all"]
+    host = hosts.get(context.hostname)
+    if context.hostname != "all" and isinstance(host, dict):
+        merger.merge(f"host:{context.hostname}", host, all_hosts, "hosts.all.")
+
+    merger.merge(env_layer.name, env_layer.values)
+    # Env var names are case-insensitive, so are their host names
+    env_host = next(
+        (
+            values
+            for name, values in env_layer.values.get("hosts", {}).items()
+            if name.lower() == context.hostname.lower()
+        ),
+        None,
+    )
+    if context.hostname != "all" and isinstance(env_host, dict):
+        merger.merge(env_layer.name, env_host, hosts["all"], "hosts.all.")
+
+    config = Config.parse_obj(merger.values)
+    config.hosts[context.hostname] = config.hosts["all"]
+    return ResolvedConfig(config, merger.sources)
+
+
+def explain_config(
+    context: Context, resolved: ResolvedConfig
+) -> List[Tuple[str, Any, str]]:
+    """(path, value, layer) of every final config value"""
+    res: List[Tuple[str, Any, str]] = []
+
+    def walk(value: Any, path: str) -> None:
+        if isinstance(value, dict) and value:
+            for k, v in value.items():
+                walk(v, f"{path}.{k}" if path else k)
+        elif isinstance(value, list) and value:
+            for i, v in enumerate(value):
+                walk(v, f"{path}[{i}]")
+        else:
+            res.append((path, value, resolved.sources.get(path, "default")))
+
+    dct = resolved.config.dict()
+    if context.hostname != "all":
+        # Host section is an alias of resolved `hosts.all`
+        dct["hosts"].pop(context.hostname, None)
+    walk(dct, "")
+    return res
+
+
 def load_config(
     context: Context,
     type: ConfigType = ConfigType.FULL,
     interpolate_env: bool = True,
 ) -> Config:
-    if interpolate_env:
-        load_fn = envtoml.load
-    else:
-        load_fn = toml.load
+    # Imported lazily to keep CLI start fast
+    import envtoml
+    import toml
 
-    if type in [ConfigType.FULL, ConfigType.GLOBAL]:
-        conf_path = context.project_dir / ConfigType.GLOBAL.file_name()
+    if type == ConfigType.FULL:
+        merger = merge_config_layers(context, interpolate_env)
+        config = Config.parse_obj(merger.values)
+    else:
+        load_fn = envtoml.load if interpolate_env else toml.load
+        conf_path = context.project_dir / type.file_name()
         if conf_path.is_file():
             config = Config.construct(**load_fn(conf_path))
         else:
             config = Config()
 
-    if (
-        type == ConfigType.FULL and config.use_local_config
-    ) or type == ConfigType.LOCAL:
-        conf_path = context.project_dir / ConfigType.LOCAL.file_name()
-        if conf_path.is_file():
-            local_config = Config.construct(**load_fn(conf_path))
-        else:
-            local_config = Config()
+    LOG.debug(config)
 
-        if type == ConfigType.LOCAL:
-            config = local_config
-        else:
-            config = merge_models(config, local_config)
+    return config
 
-    if type == ConfigType.FULL:
-        config = Config.parse_obj(config.dict(exclude_unset=True))
 
-    LOG.debug(config)
+class CompiledConfig(BaseModel):
+    """Final config together with everything it was computed from"""
 
-    return config
+    key: str
+    env: Dict[str, Optional[str]]
+    config: Config
+
+
+# Single final config instance per project in this process
+_compiled_configs: Dict[Tuple[Path, str], CompiledConfig] = {}
 
 
+def config_files_key(context: Context) -> str:
+    parts: List[Any] = [
+        CONFIG_CACHE_VERSION,
+        context.hostname,
+        sorted(env_overrides().items()),
+    ]
+    for path in config_file_paths(context):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            parts.append([str(path)])
+            continue
+        parts.append([str(path), st.st_mtime_ns, st.st_size, st.st_ino])
+    return json.dumps(parts)
+
+
+def referenced_env(context: Context) -> Dict[str, Optional[str]]:
+    names = set()
+    for path in config_file_paths(context):
+        if path.is_file():
+            names.update(ENV_VAR_RE.findall(path.read_text()))
+    return {name: os.environ.get(name) for name in sorted(names)}
+
+
+def is_compiled_config_valid(compiled: CompiledConfig, key: str) -> bool:
+    return compiled.key == key and all(
+        os.environ.get(name) == value for name, value in compiled.env.items()
+    )
+
+
+def compiled_config_path(context: Context) -> Path:
+    key = f"{context.project_dir}\0{context.hostname}".encode()
+    name = hashlib.sha256(key).hexdigest()[:32]
+    return Env.get().cache_path / "config" / f"{name}.json"
+
+
+@trace.traced("config")
 def load_final_config(
     context: Context,
 ) -> Config:
-    config = load_config(context)
-
-    if "all" not in config.hosts:
-        config.hosts["all"] = Parameters()
-
-    if context.hostname in config.hosts:
-        config.hosts["all"] = merge_models(
-            config.hosts["all"], config.hosts[context.hostname]
+    """Load config from cache if files and interpolated env vars are unchanged"""
+    key = config_files_key(context)
+    memo_key = (context.project_dir, context.hostname)
+
+    compiled = _compiled_configs.get(memo_key)
+    if compiled is not None and is_compiled_config_valid(compiled, key):
+        return compiled.config
+
+    cache_path = compiled_config_path(context)
+    try:
+        compiled = CompiledConfig.parse_file(cache_path)
+    except (OSError, ValueError):
+        compiled = None
+
+    if compiled is None or not is_compiled_config_valid(compiled, key):
+        LOG.debug(f"Compiling config of {context.project_dir}")
+        compiled = CompiledConfig(
+            key=key,
+            env=referenced_env(context),
+            config=compile_final_config(context),
         )
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(compiled.json())
+            tmp_path.replace(cache_path)
+        except OSError as e:
+            LOG.debug(f"Can't save compiled config: {e}")
 
-    config.hosts[context.hostname] = config.hosts["all"]
-
-    return config
+    _compiled_configs[memo_key] = compiled
+    return compiled.config
 
 
-class TomlConfigEncoder(TomlPathlibEncoder):  # type: ignore
-    pass
+def compile_final_config(
+    context: Context,
+) -> Config:
+    return resolve_config(context).config
 
 
 def save_config(context: Context, config: Config, type: ConfigType) -> None:
+    import toml
+
     conf_path = context.project_dir / type.file_name()
 
     if type == ConfigType.GLOBAL:
@@ -199,4 +590,4 @@ def save_config(context: Context, config: Config, type: ConfigType) -> None:
         dct = config.dict(exclude_defaults=True)
 
     with conf_path.open("w") as f:
-        toml.dump(dct, f, encoder=TomlConfigEncoder())
+        toml.dump(dct, f, encoder=toml.TomlPathlibEncoder())
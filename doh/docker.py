@@ -1,20 +1,61 @@
-from typing import Any, List, NamedTuple, Sequence, Union
-
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    NoReturn,
+    Optional,
+    Sequence,
+    Union,
+    cast,
+)
+
+import functools
+import json
 import logging
 import os
+import re
 import shlex
 import subprocess
+import sys
 from pathlib import Path
 
 import typer
 from click.exceptions import Exit
-from doh.config import Config, Context
+from doh import trace
+from doh.buildcache import local_build_cache
+from doh.config import WELL_KNOWN_CACHES, CacheVolumeParameters, Config, Context
+from doh.engine import EngineClient, EngineError, socket_path_from_env
+from doh.fingerprint import (
+    FINGERPRINT_LABEL,
+    BuildState,
+    build_lock_path,
+    compute_fingerprint,
+    load_build_state,
+    save_build_state,
+    shared_build_lock_path,
+)
+from doh.pipeline import run_command
+from doh.snapshot import sync_snapshot
+from doh.sync import target_path
+from doh.utils import file_lock, parse_size, shared_file_lock
 
 IMAGE_NAME_PLACEHOLDER = "{image_name}"
+SHARED_IMAGE_REPO = "doh-shared"
+# Set to "cli" to always shell out to the docker CLI
+BACKEND_ENV_VAR = "DOH_DOCKER_BACKEND"
+CACHE_LABEL = "doh.cache"
+CACHE_SCOPE_LABEL = "doh.cache.scope"
+SUPERVISOR_PATH = str(Path(__file__).with_name("supervisor.py"))
 
 LOG = logging.getLogger(__name__)
 
 
+def container_name(kind: str, context: Context) -> str:
+    environment_id = re.sub(r"[^a-zA-Z0-9_.-]", "-", context.environment_id)
+    return f"doh-{kind}-{environment_id}"
+
+
 def user_args():
     uid = os.getuid()
     gid = os.getgid()
@@ -27,15 +68,76 @@ def volume_args(config: Config, context: Context) -> List[str]:
     if context.hostname in config.hosts:
         host_bind_paths = config.hosts[context.hostname].bind_paths
         resolved_paths_volumes = [
-            f"{os.path.realpath(source)}:{target}"
+            f"{os.path.realpath(context.project_path(source))}:{target}"
             for source, target in map(lambda s: s.split(":"), host_bind_paths)
         ]
         volumes += sum((["--volume", v] for v in resolved_paths_volumes), [])
-    volumes += ["--volume", f"{context.project_dir}:{context.project_dir}"]
+    source = str(context.project_dir)
+    if config.sync is not None:
+        source = target_path(config.sync.target)
+    volumes += ["--volume", f"{source}:{context.project_dir}"]
 
     return volumes
 
 
+def cache_volume_name(
+    context: Context, name: str, params: CacheVolumeParameters
+) -> str:
+    if params.scope == "shared":
+        return f"doh-cache-{name}"
+    owner = re.sub(r"[^a-zA-Z0-9_.-]", "-", context.image_name)
+    return f"doh-cache-{owner}-{name}"
+
+
+def cache_volume_path(name: str, params: CacheVolumeParameters) -> str:
+    path = params.path or WELL_KNOWN_CACHES.get(name)
+    if path is None:
+        typer.secho(
+            f"Cache volume {name} needs a path, it's not a well-known cache",
+            fg=typer.colors.RED,
+        )
+        raise Exit(1)
+    if path.startswith("~"):
+        path = f"{Path.home()}{path[1:]}"
+    return path
+
+
+def cache_volume_labels(
+    name: str, params: CacheVolumeParameters
+) -> Dict[str, str]:
+    return {CACHE_LABEL: name, CACHE_SCOPE_LABEL: params.scope}
+
+
+def cache_volume_mount(
+    volume: str, target: str, name: str, params: CacheVolumeParameters
+) -> str:
+    # Labels are applied by docker when it creates the volume
+    labels = cache_volume_labels(name, params)
+    return f"type=volume,source={volume},target={target}," + ",".join(
+        f"volume-label={k}={v}" for k, v in labels.items()
+    )
+
+
+def cache_volume_args(config: Config, context: Context) -> List[str]:
+    res: List[str] = []
+    for name, params in sorted(config.cache_volumes.items()):
+        volume = cache_volume_name(context, name, params)
+        target = cache_volume_path(name, params)
+        res += ["--mount", cache_volume_mount(volume, target, name, params)]
+    return res
+
+
+def tmpfs_args(config: Config) -> List[str]:
+    res: List[str] = []
+    for path, size in sorted(config.tmpfs.items()):
+        res += [
+            "--mount",
+            f"type=tmpfs,destination={path},"
+            f"tmpfs-size={parse_size(size)},tmpfs-mode=1777",
+        ]
+    return res
+
+
 def get_default_args(config: Config, context: Context) -> List[str]:
     res = ["--ipc=host", "--pid=host", "--hostname", context.environment_id]
 
@@ -51,11 +153,12 @@ def env_args(config: Config, context: Context) -> List[str]:
     )
 
 
+@trace.traced("prepare_home")
 def prepare_home_args(config: Config, context: Context) -> List[str]:
     res: List[str] = []
     if config.fake_home is None:
         return res
-    fake_home_path = config.fake_home.root.resolve()
+    fake_home_path = context.project_path(config.fake_home.root).resolve()
     real_home_path = Path.home()
 
     if not fake_home_path.is_dir():
@@ -65,6 +168,12 @@ def prepare_home_args(config: Config, context: Context) -> List[str]:
     res += ["--volume", f"{fake_home_path}:{real_home_path}"]
     res += ["--env", f"HOME={real_home_path}"]
 
+    if config.fake_home.mode == "snapshot":
+        sync_snapshot(
+            real_home_path, fake_home_path, config.fake_home.real_paths
+        )
+        return res
+
     for f in config.fake_home.real_paths:
         full_f = real_home_path / f
 
@@ -95,6 +204,9 @@ def docker_run_args_from_project(
     run_args += volume_args(config, project)
     run_args += get_default_args(config, project)
     run_args += prepare_home_args(config, project)
+    # After the home mount, cache paths are usually inside the home
+    run_args += cache_volume_args(config, project)
+    run_args += tmpfs_args(config)
     run_args += env_args(config, project)
     run_args += config.run_extra_args
     return run_args
@@ -104,7 +216,7 @@ def run_docker_cli(args: str) -> None:
     LOG.debug(args)
     argv = ["docker"] + shlex.split(args)
 
-    subprocess.run(argv)
+    run_command(argv)
 
 
 def run_docker_run(
@@ -117,7 +229,365 @@ def run_docker_run(
     run_docker_cli(f"run {run_args_cat} {image_name} {cmd}")
 
 
-def build_image(config: Config, context: Context) -> None:
+def docker_run_argv(
+    run_args: List[str], image_name: str, cmd: Union[List[str], str]
+) -> List[str]:
+    cmd = shlex.split(cmd) if isinstance(cmd, str) else list(map(str, cmd))
+    return ["docker", "run", *map(str, run_args), image_name, *cmd]
+
+
+def handoff_docker_run(
+    run_args: List[str],
+    image_name: str,
+    cmd: Union[List[str], str],
+    after_command: Optional[str] = None,
+) -> NoReturn:
+    """Replace doh process with `docker run`, so doh doesn't stay in memory
+
+    Pid is kept, signals sent to doh reach docker, which proxies them to the
+    container. With `after_command` doh is replaced with a minimal supervisor
+    which runs it after the container exits.
+    """
+    argv = docker_run_argv(run_args, image_name, cmd)
+    LOG.debug(shlex.join(argv))
+    trace.finish("ok")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if after_command is None:
+        os.execvp(argv[0], argv)
+    os.execv(
+        sys.executable,
+        [sys.executable, "-S", SUPERVISOR_PATH, after_command] + argv,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def engine_client() -> Optional[EngineClient]:
+    """Engine API client if daemon socket is usable, None means use the CLI"""
+    if os.environ.get(BACKEND_ENV_VAR, "api") == "cli":
+        return None
+    socket_path = socket_path_from_env()
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+    client = EngineClient(socket_path)
+    if not client.ping():
+        LOG.debug(f"Docker Engine API at {socket_path} is unusable, use CLI")
+        return None
+    return client
+
+
+def _inspect_cli(kind: str, names: Sequence[str]) -> List[Dict[str, Any]]:
+    res = subprocess.run(
+        ["docker", kind, "inspect", *names],
+        capture_output=True,
+        text=True,
+    )
+    # Inspect returns found objects even if some of them are missing
+    return cast(List[Dict[str, Any]], json.loads(res.stdout or "[]"))
+
+
+def inspect_image(image_name: str) -> Optional[Dict[str, Any]]:
+    client = engine_client()
+    if client is not None:
+        return client.inspect_image(image_name)
+    found = _inspect_cli("image", [image_name])
+    return found[0] if found else None
+
+
+def inspect_container(container_name: str) -> Optional[Dict[str, Any]]:
+    client = engine_client()
+    if client is not None:
+        return client.inspect_container(container_name)
+    found = _inspect_cli("container", [container_name])
+    return found[0] if found else None
+
+
+def list_containers(
+    include_stopped: bool = False,
+    filters: Optional[Dict[str, List[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """List containers in Engine API format"""
+    client = engine_client()
+    if client is not None:
+        return client.list_containers(include_stopped, filters)
+
+    argv = ["docker", "container", "ls", "--quiet", "--no-trunc"]
+    if include_stopped:
+        argv.append("--all")
+    for key, values in (filters or {}).items():
+        argv += sum((["--filter", f"{key}={v}"] for v in values), [])
+    ids = subprocess.run(
+        argv, capture_output=True, text=True, check=True
+    ).stdout.split()
+    if not ids:
+        return []
+    return [
+        {
+            "Id": c["Id"],
+            "Names": [c["Name"]],
+            "Image": c["Config"]["Image"],
+            "ImageID": c["Image"],
+            "Labels": c["Config"].get("Labels") or {},
+            "State": c["State"]["Status"],
+        }
+        for c in _inspect_cli("container", ids)
+    ]
+
+
+def list_images(
+    filters: Optional[Dict[str, List[str]]] = None
+) -> List[Dict[str, Any]]:
+    """List images in Engine API format"""
+    client = engine_client()
+    if client is not None:
+        return client.list_images(filters)
+
+    argv = ["docker", "image", "ls", "--quiet", "--no-trunc"]
+    for key, values in (filters or {}).items():
+        argv += sum((["--filter", f"{key}={v}"] for v in values), [])
+    ids = subprocess.run(
+        argv, capture_output=True, text=True, check=True
+    ).stdout.split()
+    if not ids:
+        return []
+    return [
+        {
+            "Id": i["Id"],
+            "ParentId": i.get("Parent", ""),
+            "RepoTags": i.get("RepoTags") or [],
+            "Size": i["Size"],
+            "Labels": i["Config"].get("Labels") or {},
+        }
+        for i in _inspect_cli("image", list(dict.fromkeys(ids)))
+    ]
+
+
+def remove_image(name: str) -> bool:
+    """Untag/remove image, False if docker refused (e.g. it's in use)"""
+    client = engine_client()
+    if client is not None:
+        try:
+            client.remove_image(name)
+        except EngineError as e:
+            LOG.debug(f"Can't remove image {name}: {e}")
+            return False
+        return True
+    res = subprocess.run(
+        ["docker", "image", "rm", name], capture_output=True, text=True
+    )
+    if res.returncode != 0:
+        LOG.debug(f"Can't remove image {name}: {res.stderr.strip()}")
+    return res.returncode == 0
+
+
+def inspect_volume(volume_name: str) -> Optional[Dict[str, Any]]:
+    client = engine_client()
+    if client is not None:
+        return client.inspect_volume(volume_name)
+    found = _inspect_cli("volume", [volume_name])
+    return found[0] if found else None
+
+
+def list_volumes(label: str) -> List[Dict[str, Any]]:
+    """Volumes having the label, Size and RefCount are -1 if unknown"""
+    client = engine_client()
+    if client is not None:
+        return [
+            {
+                "Name": v["Name"],
+                "Labels": v.get("Labels") or {},
+                "Size": (v.get("UsageData") or {}).get("Size", -1),
+                "RefCount": (v.get("UsageData") or {}).get("RefCount", -1),
+            }
+            for v in client.volume_usage()
+            if label in (v.get("Labels") or {})
+        ]
+
+    # CLI doesn't report volume sizes without a full `docker system df`
+    res = subprocess.run(
+        [
+            "docker",
+            "volume",
+            "ls",
+            "--filter",
+            f"label={label}",
+            "--format",
+            "{{json .}}",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    volumes = []
+    for line in res.stdout.splitlines():
+        v = json.loads(line)
+        labels = dict(
+            kv.split("=", 1) for kv in v.get("Labels", "").split(",") if kv
+        )
+        volumes.append(
+            {"Name": v["Name"], "Labels": labels, "Size": -1, "RefCount": -1}
+        )
+    return volumes
+
+
+def remove_volume(name: str) -> bool:
+    """False if docker refused, e.g. volume is in use"""
+    client = engine_client()
+    if client is not None:
+        try:
+            client.remove_volume(name)
+        except EngineError as e:
+            LOG.debug(f"Can't remove volume {name}: {e}")
+            return False
+        return True
+    res = subprocess.run(
+        ["docker", "volume", "rm", name], capture_output=True, text=True
+    )
+    if res.returncode != 0:
+        LOG.debug(f"Can't remove volume {name}: {res.stderr.strip()}")
+    return res.returncode == 0
+
+
+def container_memory_usage(container_name: str) -> int:
+    """Current memory usage of a running container in bytes"""
+    client = engine_client()
+    if client is not None:
+        stats = client.request_json(
+            "GET", f"/containers/{container_name}/stats", {"stream": 0}
+        )
+        return cast(int, stats.get("memory_stats", {}).get("usage", 0))
+
+    res = subprocess.run(
+        [
+            "docker",
+            "stats",
+            "--no-stream",
+            "--format",
+            "{{.MemUsage}}",
+            container_name,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0 or not res.stdout.strip():
+        return 0
+    return parse_size(res.stdout.split("/")[0])
+
+
+def remove_container(container_name: str) -> None:
+    client = engine_client()
+    if client is not None:
+        try:
+            client.remove_container(container_name, force=True)
+        except EngineError as e:
+            if e.status != 404:
+                raise
+        return
+    subprocess.run(
+        ["docker", "rm", "--force", container_name],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def with_build_label(build_argv: List[str], key: str, value: str) -> List[str]:
+    """Add label to `docker build` and `docker buildx build` commands"""
+    if build_argv[:1] != ["docker"]:
+        return build_argv
+    for i, arg in enumerate(build_argv[1:3], start=1):
+        if arg == "build":
+            return [
+                *build_argv[: i + 1],
+                "--label",
+                f"{key}={value}",
+                *build_argv[i + 1 :],
+            ]
+    return build_argv
+
+
+def rebuild_reason(
+    fingerprint: str,
+    cached_fingerprint: str,
+    cached_image_id: str,
+    image_name: str,
+) -> Optional[str]:
+    if not cached_fingerprint:
+        return "no cached fingerprint"
+    if cached_fingerprint != fingerprint:
+        return f"fingerprint changed {cached_fingerprint[:12]} -> {fingerprint[:12]}"
+
+    image = inspect_image(image_name)
+    if image is None:
+        return f"image {image_name} doesn't exist"
+    if image["Id"] != cached_image_id:
+        return f"image {image_name} was replaced outside of doh"
+    labels = image.get("Config", {}).get("Labels") or {}
+    if labels.get(FINGERPRINT_LABEL, fingerprint) != fingerprint:
+        return "image label doesn't match fingerprint"
+    return None
+
+
+def build_fingerprint(
+    config: Config, context: Context, state: Optional[BuildState] = None
+) -> str:
+    """Fingerprint of the image content, doesn't depend on the image name
+
+    So projects with identical build contexts get identical fingerprints.
+    """
+    build_cmd = config.image_build_command
+    build_argv = shlex.split(
+        build_cmd.replace(IMAGE_NAME_PLACEHOLDER, context.image_name)
+    )
+    return compute_fingerprint(context, build_cmd, build_argv, state)
+
+
+def pull_image(name: str) -> None:
+    run_command(["docker", "pull", name], check=True)
+
+
+def shared_image_name(fingerprint: str) -> str:
+    """Host-wide image built from inputs with the given fingerprint
+
+    The image has nothing user specific in it, `user_args` remaps the user
+    at run time, so one build serves every user of the host.
+    """
+    return f"{SHARED_IMAGE_REPO}:{fingerprint}"
+
+
+def tag_image(source: str, target: str) -> None:
+    client = engine_client()
+    if client is not None:
+        client.tag_image(source, target)
+        return
+    subprocess.run(["docker", "tag", source, target], check=True)
+
+
+def adopt_image(
+    context: Context, source_image: str, fingerprint: str, force: bool = False
+) -> None:
+    """Use image built for another project with the same build fingerprint"""
+    image_name = f"{context.image_name}:latest"
+    state = load_build_state(context)
+    reason = (
+        "source image was rebuilt"
+        if force
+        else rebuild_reason(
+            fingerprint, state.fingerprint, state.image_id, image_name
+        )
+    )
+    if reason is None:
+        return
+
+    LOG.debug(f"Tagging {source_image} as {image_name}: {reason}")
+    tag_image(source_image, image_name)
+    image = inspect_image(image_name)
+    state.fingerprint = fingerprint
+    state.image_id = image["Id"] if image is not None else ""
+    save_build_state(context, state)
+
+
+@trace.traced("build_image")
+def build_image(config: Config, context: Context, force: bool = False) -> None:
     image_name = f"{context.image_name}:latest"
 
     if IMAGE_NAME_PLACEHOLDER not in config.image_build_command:
@@ -125,8 +595,96 @@ def build_image(config: Config, context: Context) -> None:
             f"Image build command doesn't contain {IMAGE_NAME_PLACEHOLDER}, container launch will likely be incorrect"
         )
 
-    build_cmd = config.image_build_command.replace(
-        IMAGE_NAME_PLACEHOLDER, image_name
+    build_argv = shlex.split(
+        config.image_build_command.replace(IMAGE_NAME_PLACEHOLDER, image_name)
+    )
+
+    state = load_build_state(context)
+    cached_fingerprint = state.fingerprint
+    try:
+        fingerprint = build_fingerprint(config, context, state)
+    except OSError as e:
+        LOG.debug(f"Rebuilding {image_name}: can't fingerprint context ({e})")
+        run_command(build_argv, check=True, cwd=context.project_dir)
+        return
+
+    reason = (
+        "forced with --force-build"
+        if force
+        else rebuild_reason(
+            fingerprint, cached_fingerprint, state.image_id, image_name
+        )
+    )
+    if reason is None:
+        LOG.debug(f"Image {image_name} is up to date, skipping build")
+        return
+
+    cached_image_id = state.image_id
+    if config.shared_images:
+        # Other users and projects may build the same shared image
+        lock = shared_file_lock(
+            shared_build_lock_path(fingerprint),
+            timeout=config.build_lock_timeout,
+        )
+    else:
+        lock = file_lock(
+            build_lock_path(context), timeout=config.build_lock_timeout
+        )
+    with lock as locked:
+        if not locked:
+            LOG.warning(
+                f"Build of {image_name} by another doh process takes over"
+                f" {config.build_lock_timeout}s, building anyway"
+            )
+        current = load_build_state(context)
+        built_meanwhile = (current.fingerprint, current.image_id) != (
+            cached_fingerprint,
+            cached_image_id,
+        )
+        # Concurrent build we've waited for is likely the one we need
+        if built_meanwhile and not rebuild_reason(
+            fingerprint, current.fingerprint, current.image_id, image_name
+        ):
+            LOG.debug(f"Image {image_name} was built by another doh process")
+            return
+        _build_image(config, context, state, fingerprint, reason, force)
+
+
+def _build_image(
+    config: Config,
+    context: Context,
+    state: BuildState,
+    fingerprint: str,
+    reason: str,
+    force: bool,
+) -> None:
+    image_name = f"{context.image_name}:latest"
+    target = image_name
+    if config.shared_images:
+        target = shared_image_name(fingerprint)
+        if not force and inspect_image(target) is not None:
+            LOG.debug(f"Using shared image {target}")
+            adopt_image(context, target, fingerprint, force=True)
+            return
+    build_argv = shlex.split(
+        config.image_build_command.replace(IMAGE_NAME_PLACEHOLDER, target)
     )
 
-    subprocess.run(shlex.split(build_cmd), check=True)
+    LOG.debug(f"Rebuilding {image_name}: {reason}")
+    if config.gc is not None:
+        from doh.gc import auto_collect
+
+        auto_collect(context)
+    build_argv = with_build_label(build_argv, FINGERPRINT_LABEL, fingerprint)
+    if config.build_cache is not None:
+        with local_build_cache(config.build_cache, context, build_argv) as argv:
+            run_command(argv, check=True, cwd=context.project_dir)
+    else:
+        run_command(build_argv, check=True, cwd=context.project_dir)
+    if target != image_name:
+        tag_image(target, image_name)
+
+    image = inspect_image(image_name)
+    state.fingerprint = fingerprint
+    state.image_id = image["Id"] if image is not None else ""
+    save_build_state(context, state)
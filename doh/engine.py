@@ -0,0 +1,337 @@
+"""Minimal Docker Engine API client talking HTTP over the daemon unix socket
+
+Client keeps a keep-alive connection per thread (http.client connections
+aren't thread-safe), so any number of queries made by one doh process cost
+a connect per thread and no `docker` CLI spawns.
+See https://docs.docker.com/engine/api/ for the endpoint reference.
+"""
+
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple, Union, cast
+
+import http.client
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+from urllib.parse import quote, urlencode
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+UNIX_SCHEME = "unix://"
+
+STDIN, STDOUT, STDERR = 0, 1, 2
+_FRAME_HEADER = struct.Struct(">BxxxL")
+
+LOG = logging.getLogger(__name__)
+
+
+class EngineError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Docker Engine API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def socket_path_from_env() -> Optional[str]:
+    """Return daemon socket path, None if daemon isn't reachable via unix socket"""
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if not docker_host:
+        return DEFAULT_SOCKET_PATH
+    if docker_host.startswith(UNIX_SCHEME):
+        return docker_host[len(UNIX_SCHEME) :]
+    return None
+
+
+def demultiplex(stream: IO[bytes]) -> Iterator[Tuple[int, bytes]]:
+    """Split attach/logs stream of non-tty container into (fd, chunk) frames"""
+    while True:
+        header = stream.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return
+        fd, size = _FRAME_HEADER.unpack(header)
+        data = stream.read(size)
+        if not data:
+            return
+        yield fd, data
+
+
+class EngineClient:
+    def __init__(
+        self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 60
+    ):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns: List[UnixHTTPConnection] = []
+        self._conns_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> UnixHTTPConnection:
+        """Keep-alive connection of the calling thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path, self.timeout)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self) -> None:
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+
+    def _url(self, path: str, params: Optional[Dict[str, Any]] = None) -> str:
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+            return f"{path}?{urlencode(params)}"
+        return path
+
+    def _send(
+        self,
+        conn: http.client.HTTPConnection,
+        method: str,
+        url: str,
+        body: Union[bytes, IO[bytes], None],
+        headers: Dict[str, str],
+    ) -> http.client.HTTPResponse:
+        conn.request(
+            method,
+            url,
+            body=body,
+            headers=headers,
+            encode_chunked=headers.get("Transfer-Encoding") == "chunked",
+        )
+        return conn.getresponse()
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Union[bytes, IO[bytes], None] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> http.client.HTTPResponse:
+        url = self._url(path, params)
+        headers = dict(headers or {})
+        LOG.debug(f"{method} {url}")
+        try:
+            return self._send(self._conn, method, url, body, headers)
+        except (
+            http.client.RemoteDisconnected,
+            BrokenPipeError,
+            ConnectionResetError,
+        ):
+            # Daemon closed idle keep-alive connection, reconnect once
+            if body is not None and not isinstance(body, bytes):
+                raise
+            self._conn.close()
+            return self._send(self._conn, method, url, body, headers)
+
+    def _request_unbounded(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Union[bytes, IO[bytes], None] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Request on a dedicated connection without timeout
+
+        For calls that take arbitrary time or hijack the connection,
+        the caller closes returned connection.
+        """
+        url = self._url(path, params)
+        LOG.debug(f"{method} {url}")
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        try:
+            resp = self._send(conn, method, url, body, dict(headers or {}))
+        except BaseException:
+            conn.close()
+            raise
+        if resp.status >= 400:
+            conn.close()
+            raise EngineError(resp.status, _error_message(resp.read()))
+        return conn, resp
+
+    def request_json(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        payload: Any = None,
+    ) -> Any:
+        body = None
+        headers = {}
+        if payload is not None:
+            body = json.dumps(payload).encode()
+            headers["Content-Type"] = "application/json"
+        resp = self.request(method, path, params, body, headers)
+        data = resp.read()
+        if resp.status >= 400:
+            raise EngineError(resp.status, _error_message(data))
+        return json.loads(data) if data else None
+
+    def ping(self) -> bool:
+        try:
+            resp = self.request("GET", "/_ping")
+            resp.read()
+        except OSError:
+            return False
+        return resp.status == 200
+
+    def _inspect(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            return cast(Dict[str, Any], self.request_json("GET", path))
+        except EngineError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def inspect_image(self, name: str) -> Optional[Dict[str, Any]]:
+        return self._inspect(f"/images/{quote(name, safe='')}/json")
+
+    def inspect_container(self, name: str) -> Optional[Dict[str, Any]]:
+        return self._inspect(f"/containers/{quote(name, safe='')}/json")
+
+    def inspect_volume(self, name: str) -> Optional[Dict[str, Any]]:
+        return self._inspect(f"/volumes/{quote(name, safe='')}")
+
+    def list_containers(
+        self,
+        include_stopped: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None,
+    ) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {"all": int(include_stopped)}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        containers = self.request_json("GET", "/containers/json", params)
+        return cast(List[Dict[str, Any]], containers)
+
+    def list_images(
+        self, filters: Optional[Dict[str, List[str]]] = None
+    ) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        images = self.request_json("GET", "/images/json", params)
+        return cast(List[Dict[str, Any]], images)
+
+    def remove_image(self, name: str) -> None:
+        self.request_json("DELETE", f"/images/{quote(name, safe='')}")
+
+    def volume_usage(self) -> List[Dict[str, Any]]:
+        """Volumes with UsageData, computing sizes may take a while"""
+        data = self.request_json("GET", "/system/df", {"type": "volume"})
+        return data.get("Volumes") or []
+
+    def remove_volume(self, name: str) -> None:
+        self.request_json("DELETE", f"/volumes/{quote(name, safe='')}")
+
+    def create_container(
+        self, config: Dict[str, Any], name: Optional[str] = None
+    ) -> str:
+        res = self.request_json(
+            "POST", "/containers/create", {"name": name}, config
+        )
+        for warning in res.get("Warnings") or []:
+            LOG.warning(warning)
+        return cast(str, res["Id"])
+
+    def start_container(self, container_id: str) -> None:
+        self.request_json("POST", f"/containers/{container_id}/start")
+
+    def wait_container(self, container_id: str) -> int:
+        conn, resp = self._request_unbounded(
+            "POST", f"/containers/{container_id}/wait"
+        )
+        try:
+            return cast(int, json.loads(resp.read())["StatusCode"])
+        finally:
+            conn.close()
+
+    def remove_container(self, container_id: str, force: bool = False) -> None:
+        self.request_json(
+            "DELETE",
+            f"/containers/{container_id}",
+            {"force": int(force), "v": 1},
+        )
+
+    def tag_image(self, name: str, target: str) -> None:
+        repo, _, tag = target.rpartition(":")
+        if not repo or "/" in tag:
+            repo, tag = target, "latest"
+        self.request_json(
+            "POST",
+            f"/images/{quote(name, safe='')}/tag",
+            {"repo": repo, "tag": tag},
+        )
+
+    def attach(
+        self, container_id: str, logs: bool = False
+    ) -> Iterator[Tuple[int, bytes]]:
+        """Attach to stdout/stderr of a non-tty container
+
+        Attach hijacks the connection, so it uses a dedicated one.
+        """
+        conn, resp = self._request_unbounded(
+            "POST",
+            f"/containers/{container_id}/attach",
+            {"stream": 1, "stdout": 1, "stderr": 1, "logs": int(logs)},
+            headers={"Connection": "Upgrade", "Upgrade": "tcp"},
+        )
+
+        def frames() -> Iterator[Tuple[int, bytes]]:
+            try:
+                yield from demultiplex(resp.fp)
+            finally:
+                conn.close()
+
+        return frames()
+
+    def run_container(
+        self, config: Dict[str, Any], name: Optional[str] = None
+    ) -> int:
+        """Equivalent of non-interactive `docker run --rm`, returns exit code"""
+        container_id = self.create_container(config, name)
+        try:
+            output = self.attach(container_id)
+            self.start_container(container_id)
+            for fd, chunk in output:
+                out = sys.stderr if fd == STDERR else sys.stdout
+                out.buffer.write(chunk)
+                out.flush()
+            return self.wait_container(container_id)
+        finally:
+            self.remove_container(container_id, force=True)
+
+    def export_image(self, name: str) -> http.client.HTTPResponse:
+        """Stream of `docker image save` tarball
+
+        Response must be read completely before the next request.
+        """
+        resp = self.request("GET", f"/images/{quote(name, safe='')}/get")
+        if resp.status >= 400:
+            raise EngineError(resp.status, _error_message(resp.read()))
+        return resp
+
+
+def _error_message(data: bytes) -> str:
+    try:
+        return cast(str, json.loads(data)["message"])
+    except (ValueError, KeyError, TypeError):
+        return data.decode(errors="replace")
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pathlib import Path
 
 from platformdirs import PlatformDirs
@@ -7,6 +9,15 @@ from pydantic import BaseSettings
 class Env(BaseSettings):
     config_path: Path
     cache_path: Path
+    # Cache shared by all users of the host, e.g. /var/cache/doh
+    shared_cache_dir: Optional[Path] = None
+
+    class Config:
+        env_prefix = "DOH_"
+
+    @property
+    def shared_cache_path(self) -> Path:
+        return self.shared_cache_dir or self.cache_path
 
     @staticmethod
     def get() -> "Env":
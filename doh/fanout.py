@@ -0,0 +1,183 @@
+"""Fan-out: run one command in many doh projects
+
+Projects are discovered by glob, images are built with bounded
+parallelism and projects with identical build fingerprints share one
+build. Command runs in a project's container as soon as its image is
+ready, output lines are prefixed with the project path.
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+import dataclasses
+import glob
+import logging
+import os
+import shlex
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .config import ConfigType, Context
+from .docker import adopt_image, build_fingerprint, build_image
+from .fingerprint import load_build_state
+from .pipeline import output_prefix, run_command
+from .plan import launch_plan, prepare_launch
+from .prebuilt import pinned_image
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class ProjectResult:
+    context: Context
+    build_seconds: float = 0
+    run_seconds: float = 0
+    exit_code: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.exit_code == 0
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return self.error
+        return "ok" if self.exit_code == 0 else f"exit {self.exit_code}"
+
+
+def discover_projects(pattern: str, root: Optional[Path] = None) -> List[Path]:
+    """Dirs matching the glob which have doh config"""
+    root = root or Path.cwd()
+    pattern = os.path.join(str(root), os.path.expanduser(pattern))
+    dirs = {Path(p).resolve() for p in glob.glob(pattern, recursive=True)}
+    marker = ConfigType.GLOBAL.file_name()
+    return sorted(d for d in dirs if (d / marker).is_file())
+
+
+def project_label(context: Context, root: Path) -> str:
+    try:
+        return str(context.project_dir.relative_to(root))
+    except ValueError:
+        return str(context.project_dir)
+
+
+def group_by_fingerprint(contexts: Sequence[Context]) -> List[List[Context]]:
+    groups: Dict[str, List[Context]] = {}
+    for context in contexts:
+        if context.config.image is not None:
+            groups.setdefault(f"image:{context.config.image}", []).append(
+                context
+            )
+            continue
+        try:
+            key = build_fingerprint(
+                context.config, context, load_build_state(context)
+            )
+        except OSError as e:
+            LOG.debug(f"Can't fingerprint {context.project_dir}: {e}")
+            key = f"unique:{context.project_dir}"
+        groups.setdefault(key, []).append(context)
+    return list(groups.values())
+
+
+def fan_out(
+    pattern: str,
+    cmd: Sequence[str],
+    build: bool = True,
+    force_build: bool = False,
+    jobs: Optional[int] = None,
+) -> List[ProjectResult]:
+    root = Path.cwd()
+    contexts = [Context.create_for_path(p) for p in discover_projects(pattern)]
+    results = {c.project_dir: ProjectResult(c) for c in contexts}
+    labels = {c.project_dir: project_label(c, root) for c in contexts}
+
+    def build_group(group: List[Context]) -> None:
+        leader, *followers = group
+        start = time.monotonic()
+        try:
+            with output_prefix(labels[leader.project_dir]):
+                if leader.config.image is not None:
+                    # Same image reference, followers reuse the pinned digest
+                    pinned_image(leader.config, refresh=force_build)
+                    return
+                build_image(leader.config, leader, force=force_build)
+                fingerprint = load_build_state(leader).fingerprint
+                for follower in followers:
+                    adopt_image(
+                        follower,
+                        f"{leader.image_name}:latest",
+                        fingerprint,
+                        force=force_build,
+                    )
+        except Exception as e:
+            for context in group:
+                results[context.project_dir].error = f"build failed: {e}"
+        for context in group:
+            results[context.project_dir].build_seconds = (
+                time.monotonic() - start
+            )
+
+    def run_project(context: Context) -> None:
+        result = results[context.project_dir]
+        config = context.config
+        start = time.monotonic()
+        try:
+            with output_prefix(labels[context.project_dir]):
+                # Images are built by now, the rest of the launch
+                # preparation is the same as for a single project
+                run_args = prepare_launch(
+                    context, build=False, request_tty=False
+                )
+                plan = launch_plan(context, list(cmd), run_args=run_args)
+                result.exit_code = run_command(
+                    plan.argv, cwd=context.project_dir
+                ).returncode
+                if config.after_command:
+                    run_command(
+                        shlex.split(config.after_command),
+                        check=True,
+                        cwd=context.project_dir,
+                    )
+        except Exception as e:
+            result.error = f"failed: {e}"
+        result.run_seconds = time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        groups = group_by_fingerprint(contexts) if build else []
+        running: Dict["Future[None]", List[Context]] = {
+            pool.submit(build_group, g): g for g in groups
+        }
+        if not build:
+            for context in contexts:
+                pool.submit(run_project, context)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                for context in running.pop(future):
+                    if results[context.project_dir].error is None:
+                        pool.submit(run_project, context)
+
+    return [results[c.project_dir] for c in contexts]
+
+
+def format_summary(results: Sequence[ProjectResult], root: Path) -> str:
+    rows = [
+        (
+            project_label(r.context, root),
+            f"{r.build_seconds:.1f}s",
+            f"{r.run_seconds:.1f}s",
+            r.status,
+        )
+        for r in results
+    ]
+    header = ("PROJECT", "BUILD", "RUN", "STATUS")
+    widths = [max(len(row[i]) for row in [header, *rows]) for i in range(3)]
+    lines = []
+    for row in [header, *rows]:
+        cells = [c.ljust(w) for c, w in zip(row, widths)]
+        lines.append("  ".join([*cells, row[3]]))
+    failed = sum(not r.ok for r in results)
+    lines.append(f"{len(results) - failed} succeeded, {failed} failed")
+    return "\n".join(lines)
@@ -0,0 +1,174 @@
+"""Content fingerprints of image builds
+
+Fingerprint covers the build command template, the Dockerfile and every
+file of the build context that isn't excluded by .dockerignore. File
+hashes are cached by (size, mtime), so for unchanged context computing
+fingerprint costs a single stat pass.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import hashlib
+import logging
+import os
+import stat
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .config import Context
+from .env import Env
+from .ignore import dockerignore_rules, walk_files
+
+FINGERPRINT_LABEL = "doh.fingerprint"
+DEFAULT_DOCKERFILE = "Dockerfile"
+# `docker build` flags without a value, every other flag takes one
+BUILD_BOOL_FLAGS = {
+    "--compress",
+    "--disable-content-trust",
+    "--force-rm",
+    "--load",
+    "--no-cache",
+    "--pull",
+    "--push",
+    "--quiet",
+    "-q",
+    "--rm",
+    "--squash",
+}
+
+LOG = logging.getLogger(__name__)
+
+
+class BuildState(BaseModel):
+    fingerprint: str = ""
+    image_id: str = ""
+    # relative path -> (size, mtime_ns, sha256)
+    files: Dict[str, Tuple[int, int, str]] = {}
+
+
+def build_state_path(context: Context) -> Path:
+    return Env.get().cache_path / "build" / f"{context.image_name}.json"
+
+
+def build_lock_path(context: Context) -> Path:
+    return build_state_path(context).with_suffix(".lock")
+
+
+def shared_build_lock_path(fingerprint: str) -> Path:
+    """Lock of a shared image build, taken by all users of the host"""
+    return Env.get().shared_cache_path / "build" / f"{fingerprint}.lock"
+
+
+def load_build_state(context: Context) -> BuildState:
+    path = build_state_path(context)
+    try:
+        return BuildState.parse_file(path)
+    except (OSError, ValueError):
+        return BuildState()
+
+
+def save_build_state(context: Context, state: BuildState) -> None:
+    path = build_state_path(context)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(state.json())
+    tmp_path.replace(path)
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _build_args(build_argv: List[str]) -> Optional[List[str]]:
+    """Arguments of `docker [buildx] build`, None for other commands"""
+    if build_argv[:1] != ["docker"]:
+        return None
+    for i, arg in enumerate(build_argv[1:3], start=1):
+        if arg == "build":
+            return build_argv[i + 1 :]
+    return None
+
+
+def build_context_dir(root: Path, build_argv: List[str]) -> Path:
+    """Local context dir of a build command run in `root`
+
+    `root` itself for commands which aren't `docker build` or build a
+    remote or stdin context.
+    """
+    args = _build_args(build_argv)
+    if args is None:
+        return root
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        # Context from stdin, not a flag
+        if arg == "-":
+            return root
+        if not arg.startswith("-"):
+            if "://" in arg or arg.startswith("git@"):
+                return root
+            return root / arg
+        if "=" not in arg and arg not in BUILD_BOOL_FLAGS:
+            i += 1
+        i += 1
+    return root
+
+
+def dockerfile_path(root: Path, build_argv: List[str]) -> Path:
+    """Dockerfile of a build command run in `root`
+
+    Like docker CLI does, `--file` is relative to the working dir, the
+    default Dockerfile is in the context dir.
+    """
+    for i, arg in enumerate(build_argv):
+        if arg in ("-f", "--file") and i + 1 < len(build_argv):
+            return root / build_argv[i + 1]
+        if arg.startswith("--file="):
+            return root / arg[len("--file=") :]
+    return build_context_dir(root, build_argv) / DEFAULT_DOCKERFILE
+
+
+def compute_fingerprint(
+    context: Context,
+    build_cmd: str,
+    build_argv: List[str],
+    state: Optional[BuildState] = None,
+) -> str:
+    """Fingerprint build inputs, `state.files` is used and updated as hash cache"""
+    dockerfile = dockerfile_path(context.project_dir, build_argv)
+    root = build_context_dir(context.project_dir, build_argv)
+    known = state.files if state is not None else {}
+    files: Dict[str, Tuple[int, int, str]] = {}
+
+    h = hashlib.sha256()
+    h.update(build_cmd.encode())
+    h.update(b"\0")
+
+    if dockerfile.is_file():
+        h.update(file_sha256(dockerfile).encode())
+    h.update(b"\0")
+
+    for rel, st in walk_files(root, [dockerignore_rules(root)]):
+        cached = known.get(rel)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            digest = cached[2]
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(root / rel)
+            digest = hashlib.sha256(target.encode()).hexdigest()
+        elif stat.S_ISREG(st.st_mode):
+            digest = file_sha256(root / rel)
+        else:
+            continue
+        files[rel] = (st.st_size, st.st_mtime_ns, digest)
+        # Executable bit is a part of the image content too
+        h.update(f"{rel}\0{st.st_mode & 0o111:o}\0{digest}\n".encode())
+
+    if state is not None:
+        state.files = files
+
+    return h.hexdigest()
@@ -0,0 +1,145 @@
+"""Disk-budgeted garbage collection of doh images
+
+Every launch touches a usage record of the project image, so its mtime is
+the last use time. With `shared_images` the record is also kept in the
+shared cache dir, so images reused by other users aren't seen as unused.
+
+Collection removes dangling images (left by rebuilds) first, then least
+recently used doh images, until their total size fits the budget. Images
+of existing containers, running or stopped, are never removed.
+
+Sizes are image sizes as reported by docker, layers shared by several
+images are counted for each of them, so the total overestimates the
+actual disk usage.
+"""
+
+from typing import Any, Dict, List, Optional
+
+import contextlib
+import dataclasses
+import logging
+from pathlib import Path
+
+from .config import Context
+from .docker import list_containers, list_images, remove_image
+from .env import Env
+from .fingerprint import FINGERPRINT_LABEL
+from .utils import file_lock, parse_size
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class GCResult:
+    total: int = 0
+    freed: int = 0
+    removed: List[str] = dataclasses.field(default_factory=list)
+
+
+def gc_root() -> Path:
+    return Env.get().cache_path / "gc"
+
+
+def usage_path(image_name: str) -> Path:
+    return gc_root() / "usage" / image_name
+
+
+def shared_usage_path(image_name: str) -> Path:
+    return Env.get().shared_cache_path / "gc" / "usage" / image_name
+
+
+def _usage_paths(image: Dict[str, Any]) -> List[Path]:
+    paths = []
+    for tag in image["RepoTags"]:
+        name = tag.rpartition(":")[0]
+        paths += [usage_path(name), shared_usage_path(name)]
+    return paths
+
+
+def _touch(path: Path) -> None:
+    try:
+        path.touch()
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+
+def record_use(context: Context) -> None:
+    _touch(usage_path(context.image_name))
+    if context.config.shared_images:
+        try:
+            _touch(shared_usage_path(context.image_name))
+        except PermissionError as e:
+            LOG.debug(f"Can't record shared image use: {e}")
+
+
+def last_used(image: Dict[str, Any]) -> float:
+    times = [0.0]
+    for path in _usage_paths(image):
+        try:
+            times.append(path.stat().st_mtime)
+        except OSError:
+            continue
+    return max(times)
+
+
+def _is_doh_image(image: Dict[str, Any]) -> bool:
+    if FINGERPRINT_LABEL in (image.get("Labels") or {}):
+        return True
+    return any(path.exists() for path in _usage_paths(image))
+
+
+def collect_garbage(
+    max_size: int, keep: Optional[str] = None, dry_run: bool = False
+) -> GCResult:
+    """Remove dangling and LRU doh images until they fit `max_size` bytes
+
+    `keep` is an image name which is never removed.
+    """
+    with file_lock(gc_root() / "gc.lock"):
+        dangling = list_images(
+            {"dangling": ["true"], "label": [FINGERPRINT_LABEL]}
+        )
+        dangling_ids = {i["Id"] for i in dangling}
+        images = [
+            i
+            for i in list_images()
+            if i["Id"] not in dangling_ids and _is_doh_image(i)
+        ]
+        in_use = {c["ImageID"] for c in list_containers(include_stopped=True)}
+
+        result = GCResult(total=sum(i["Size"] for i in dangling + images))
+        size = result.total
+        candidates = dangling + sorted(images, key=last_used)
+        for image in candidates:
+            if size <= max_size:
+                break
+            names = image["RepoTags"] or [image["Id"]]
+            if image["Id"] in in_use or keep in names:
+                continue
+            if not dry_run and not all(map(remove_image, names)):
+                continue
+            LOG.debug(f"Removed image {', '.join(names)}")
+            if not dry_run:
+                for path in _usage_paths(image):
+                    with contextlib.suppress(OSError):
+                        path.unlink()
+            result.removed += names
+            result.freed += image["Size"]
+            size -= image["Size"]
+    return result
+
+
+def auto_collect(context: Context) -> None:
+    """Collect before a build if enabled, the project image is kept"""
+    params = context.config.gc
+    if params is None or not params.auto:
+        return
+    result = collect_garbage(
+        parse_size(params.max_size), keep=f"{context.image_name}:latest"
+    )
+    if result.removed:
+        LOG.info(
+            f"Removed {len(result.removed)} images to fit the disk budget,"
+            f" freed {result.freed / 2**30:.1f}GiB"
+        )
@@ -0,0 +1,149 @@
+"""Matching of .dockerignore and .gitignore patterns"""
+
+from typing import Iterator, List, Pattern, Sequence, Tuple
+
+import os
+import re
+from pathlib import Path
+
+DOCKERIGNORE_FILE_NAME = ".dockerignore"
+GITIGNORE_FILE_NAME = ".gitignore"
+
+
+def _translate(pattern: str) -> str:
+    """Translate glob pattern to regex, `*` and `?` never match `/`"""
+    res = ""
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i : i + 2] == "**":
+                if pattern[i + 2 : i + 3] == "/":
+                    res += "(?:.*/)?"
+                    i += 3
+                else:
+                    res += ".*"
+                    i += 2
+                continue
+            res += "[^/]*"
+        elif c == "?":
+            res += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                res += re.escape(c)
+            else:
+                cls = pattern[i + 1 : end]
+                if cls[:1] in ("!", "^"):
+                    cls = "^" + cls[1:]
+                res += f"[{cls}]"
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res += re.escape(pattern[i])
+        else:
+            res += re.escape(c)
+        i += 1
+    return res
+
+
+class IgnoreRules:
+    """Ordered list of ignore patterns, the last matching pattern wins
+
+    Paths are relative to the context root and use `/` as separator.
+    With `gitignore=True` patterns without a slash match at any depth
+    and a trailing slash restricts a pattern to directories, otherwise
+    .dockerignore semantics are used.
+    """
+
+    def __init__(self, patterns: Sequence[str], gitignore: bool = False):
+        self._rules: List[Tuple[Pattern[str], bool, bool]] = []
+        self.has_exceptions = False
+
+        for line in patterns:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:].strip()
+                self.has_exceptions = True
+
+            dir_only = gitignore and line.endswith("/")
+            anchored = "/" in line.rstrip("/")
+            line = line.strip("/")
+            if not gitignore:
+                line = os.path.normpath(line).replace(os.sep, "/")
+            if not line or line == ".":
+                continue
+
+            regex = _translate(line)
+            if gitignore and not anchored:
+                regex = "(?:.*/)?" + regex
+
+            self._rules.append(
+                (re.compile(f"^{regex}(/.*)?$", re.S), negate, dir_only)
+            )
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def is_ignored(self, rel_path: str, is_dir: bool = False) -> bool:
+        ignored = False
+        for regex, negate, dir_only in self._rules:
+            match = regex.match(rel_path)
+            if match is None:
+                continue
+            # Match on the path itself, not on one of its parents
+            if dir_only and match.group(1) is None and not is_dir:
+                continue
+            ignored = not negate
+        return ignored
+
+    @classmethod
+    def from_file(cls, path: Path, gitignore: bool = False) -> "IgnoreRules":
+        if not path.is_file():
+            return cls([], gitignore)
+        return cls(path.read_text().splitlines(), gitignore)
+
+
+def walk_files(
+    root: Path, rules: Sequence[IgnoreRules] = ()
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield (relative path, stat) of not ignored files in stable order
+
+    Symlinks are reported, but not followed.
+    """
+
+    def ignored(rel: str, is_dir: bool) -> bool:
+        return any(r.is_ignored(rel, is_dir) for r in rules)
+
+    # Excluded dirs can't be skipped if some rule may re-include their content
+    can_prune = not any(r.has_exceptions for r in rules)
+
+    def walk(
+        directory: Path, prefix: str
+    ) -> Iterator[Tuple[str, os.stat_result]]:
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            return
+        for entry in entries:
+            rel = prefix + entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_dir:
+                if can_prune and ignored(rel, True):
+                    continue
+                yield from walk(Path(entry.path), rel + "/")
+            elif not ignored(rel, False):
+                yield rel, entry.stat(follow_symlinks=False)
+
+    return walk(root, "")
+
+
+def dockerignore_rules(root: Path) -> IgnoreRules:
+    return IgnoreRules.from_file(root / DOCKERIGNORE_FILE_NAME)
+
+
+def gitignore_rules(root: Path) -> IgnoreRules:
+    return IgnoreRules.from_file(root / GITIGNORE_FILE_NAME, gitignore=True)
@@ -0,0 +1,192 @@
+"""Runs independent pre-launch steps concurrently
+
+Steps declare names of steps they need, a step starts as soon as all of
+them have finished. Output of commands started by a step via `run_command`
+is prefixed with the step name. If a step fails, pending steps are not
+started, commands of running ones are terminated and the error is raised.
+"""
+
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Union,
+)
+
+import contextlib
+import dataclasses
+import logging
+import shlex
+import subprocess
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from . import trace
+
+LOG = logging.getLogger(__name__)
+
+
+class StepCancelled(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Step:
+    name: str
+    fn: Callable[[], Any]
+    needs: Sequence[str] = ()
+
+
+class _Run:
+    def __init__(self) -> None:
+        self.cancelled = threading.Event()
+        self.processes: Set["subprocess.Popen[str]"] = set()
+        self.lock = threading.Lock()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        with self.lock:
+            for proc in self.processes:
+                proc.terminate()
+
+
+_local = threading.local()
+
+
+def current_step() -> Optional[str]:
+    return getattr(_local, "step", None)
+
+
+@contextlib.contextmanager
+def output_prefix(name: str) -> Iterator[None]:
+    """Prefix output of `run_command` calls made by this thread with `name`"""
+    previous = current_step()
+    _local.step = name
+    try:
+        yield
+    finally:
+        _local.step = previous
+
+
+def _forward(stream: IO[str], prefix: str, out: IO[str]) -> None:
+    for line in stream:
+        out.write(f"{prefix}{line}")
+        out.flush()
+
+
+def run_command(
+    argv: Sequence[str], check: bool = False, cwd: Optional[Path] = None
+) -> "subprocess.CompletedProcess[bytes]":
+    """`subprocess.run` which is aware of the pipeline step it runs in"""
+    step = current_step()
+    if step is None:
+        return subprocess.run(argv, check=check, cwd=cwd)
+
+    run: _Run = getattr(_local, "run", None) or _Run()
+    with run.lock:
+        if run.cancelled.is_set():
+            raise StepCancelled(step)
+        proc = subprocess.Popen(
+            argv,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",
+        )
+        run.processes.add(proc)
+    try:
+        prefix = f"[{step}] "
+        err_thread = threading.Thread(
+            target=_forward, args=(proc.stderr, prefix, sys.stderr)
+        )
+        err_thread.start()
+        _forward(proc.stdout, prefix, sys.stdout)  # type: ignore
+        err_thread.join()
+        returncode = proc.wait()
+    finally:
+        with run.lock:
+            run.processes.discard(proc)
+
+    if run.cancelled.is_set():
+        raise StepCancelled(step)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, list(argv))
+    return subprocess.CompletedProcess(list(argv), returncode)
+
+
+def _run_step(run: _Run, step: Step) -> Any:
+    _local.run = run
+    try:
+        with output_prefix(step.name):
+            return step.fn()
+    finally:
+        _local.run = None
+
+
+def run_steps(steps: Sequence[Step]) -> Dict[str, Any]:
+    """Run steps respecting their dependencies, return results by step name"""
+    by_name = {s.name: s for s in steps}
+    for s in steps:
+        missing = set(s.needs) - set(by_name)
+        if missing:
+            raise ValueError(f"Step {s.name} needs unknown steps {missing}")
+
+    run = _Run()
+    results: Dict[str, Any] = {}
+    pending: List[Step] = list(steps)
+    running: Dict["Future[Any]", Step] = {}
+    error: Optional[BaseException] = None
+
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1)) as pool:
+        while pending or running:
+            if error is None:
+                for step in [
+                    s for s in pending if set(s.needs) <= set(results)
+                ]:
+                    pending.remove(step)
+                    LOG.debug(f"Starting step {step.name}")
+                    running[pool.submit(_run_step, run, step)] = step
+            if not running:
+                if pending and error is None:
+                    names = [s.name for s in pending]
+                    raise ValueError(f"Steps {names} have cyclic dependencies")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                exc = future.exception()
+                if exc is None:
+                    results[step.name] = future.result()
+                elif error is None:
+                    LOG.debug(f"Step {step.name} failed, cancelling others")
+                    error = exc
+                    run.cancel()
+
+    if error is not None:
+        raise error
+    return results
+
+
+def command_step(
+    name: str,
+    cmd: Union[str, Sequence[str]],
+    needs: Sequence[str] = (),
+    cwd: Optional[Path] = None,
+) -> Step:
+    argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
+    def fn() -> None:
+        with trace.span(name):
+            run_command(argv, check=True, cwd=cwd)
+
+    return Step(name, fn, needs)
@@ -0,0 +1,140 @@
+"""NUMA aware CPU placement of containers
+
+Host topology is read from sysfs. Every placed container is labelled with
+its cpuset, so the load of a node is the number of its CPUs assigned to
+running doh containers. A launch gets the least loaded nodes: their CPUs
+(or `max_cpus` least used of them) and their memory, so memory bandwidth
+heavy workloads don't run across sockets.
+
+Concurrent launches may pick the same node, placement is a heuristic and
+is corrected by the next launches.
+"""
+
+from typing import Dict, List, Optional
+
+import dataclasses
+import logging
+import re
+from pathlib import Path
+
+from .config import Context, PlacementParameters
+from .docker import list_containers
+
+NODE_ROOT = Path("/sys/devices/system/node")
+CPUS_LABEL = "doh.cpuset-cpus"
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class NumaNode:
+    id: int
+    cpus: List[int]
+
+
+@dataclasses.dataclass
+class Placement:
+    cpus: List[int]
+    # Memory nodes
+    mems: List[int]
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Parse kernel cpu list format, e.g. `0-3,8-11`"""
+    cpus: List[int] = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    ranges: List[List[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}"
+        for first, last in ranges
+    )
+
+
+def read_topology(root: Path = NODE_ROOT) -> List[NumaNode]:
+    """NUMA nodes having CPUs, empty if topology isn't available"""
+    nodes = []
+    try:
+        entries = list(root.iterdir())
+    except OSError:
+        return []
+    for entry in entries:
+        match = re.fullmatch(r"node(\d+)", entry.name)
+        if match is None:
+            continue
+        try:
+            cpus = parse_cpu_list((entry / "cpulist").read_text())
+        except (OSError, ValueError) as e:
+            LOG.debug(f"Can't read cpus of {entry}: {e}")
+            continue
+        # Memory-only nodes can't run anything
+        if cpus:
+            nodes.append(NumaNode(int(match.group(1)), cpus))
+    return sorted(nodes, key=lambda n: n.id)
+
+
+def cpu_usage() -> Dict[int, int]:
+    """Number of running placed containers per CPU"""
+    usage: Dict[int, int] = {}
+    for container in list_containers(filters={"label": [CPUS_LABEL]}):
+        try:
+            cpus = parse_cpu_list(container["Labels"][CPUS_LABEL])
+        except ValueError:
+            continue
+        for cpu in cpus:
+            usage[cpu] = usage.get(cpu, 0) + 1
+    return usage
+
+
+def place(
+    nodes: List[NumaNode],
+    usage: Dict[int, int],
+    params: PlacementParameters,
+) -> Optional[Placement]:
+    """Pick CPUs and memory nodes of the least loaded nodes"""
+    if not nodes:
+        return None
+
+    def load(node: NumaNode) -> float:
+        return sum(usage.get(cpu, 0) for cpu in node.cpus) / len(node.cpus)
+
+    chosen = sorted(nodes, key=lambda n: (load(n), n.id))[: params.max_nodes]
+    cpus = [cpu for node in chosen for cpu in node.cpus]
+    if params.max_cpus is not None:
+        cpus = sorted(cpus, key=lambda c: (usage.get(c, 0), c))
+        cpus = cpus[: params.max_cpus]
+    return Placement(sorted(cpus), sorted(n.id for n in chosen))
+
+
+def placement_args(context: Context, root: Path = NODE_ROOT) -> List[str]:
+    """`docker run` arguments pinning the container to the picked nodes"""
+    host = context.config.hosts.get(context.hostname)
+    if host is None or host.placement is None:
+        return []
+    params = host.placement
+    placement = place(read_topology(root), cpu_usage(), params)
+    if placement is None:
+        LOG.debug(f"No NUMA topology in {root}, container isn't placed")
+        return []
+    cpus = format_cpu_list(placement.cpus)
+    LOG.debug(f"Placing container on cpus {cpus} of nodes {placement.mems}")
+    return [
+        "--cpuset-cpus",
+        cpus,
+        "--cpuset-mems",
+        format_cpu_list(placement.mems),
+        "--label",
+        f"{CPUS_LABEL}={cpus}",
+    ]
@@ -0,0 +1,221 @@
+"""Launch plan: fully resolved `docker run` invocation of a project
+
+Resolving run arguments stats and resolves every bind path and prepares
+fake home on every launch, so resolved arguments are cached together with
+a fingerprint of the config and the filesystem state they depend on.
+"""
+
+from typing import Any, List, Optional, Sequence, Union, cast
+
+import hashlib
+import json
+import logging
+import os
+import shlex
+import stat
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from . import trace
+from .config import Context
+from .docker import build_image, docker_run_args_from_project
+from .env import Env
+from .gc import record_use
+from .pipeline import Step, command_step, run_steps
+from .placement import placement_args
+from .prebuilt import launch_image
+from .snapshot import sync_snapshot
+from .sync import sync_project
+from .volumes import ensure_cache_volumes
+
+LOG = logging.getLogger(__name__)
+
+
+class LaunchPlan(BaseModel):
+    image: str
+    run_args: List[str]
+    cmd: List[str] = []
+    before_command: Optional[str] = None
+    after_command: Optional[str] = None
+
+    @property
+    def argv(self) -> List[str]:
+        return ["docker", "run", *self.run_args, self.image, *self.cmd]
+
+    def json_with_argv(self) -> str:
+        return json.dumps({**self.dict(), "argv": self.argv}, indent=2)
+
+
+class CachedRunArgs(BaseModel):
+    key: str
+    run_args: List[str]
+
+
+def _stat_id(path: Union[str, Path]) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_dev, st.st_ino, stat.S_IFMT(st.st_mode)]
+
+
+def run_args_key(context: Context, request_tty: bool) -> str:
+    """Fingerprint of everything resolved run arguments depend on"""
+    config = context.config
+    home = Path.home()
+    parts: List[Any] = [
+        config.json(),
+        str(context.project_dir),
+        context.hostname,
+        request_tty,
+        os.getuid(),
+        os.getgid(),
+        str(home),
+        os.getcwd(),
+    ]
+
+    if context.hostname in config.hosts:
+        for bind in config.hosts[context.hostname].bind_paths:
+            parts.append(_stat_id(context.project_path(bind.split(":")[0])))
+
+    if config.fake_home is not None:
+        fake_home = context.project_path(config.fake_home.root)
+        parts.append(_stat_id(fake_home))
+        # Snapshot is synced on every launch, it doesn't affect the arguments
+        real_paths = (
+            config.fake_home.real_paths
+            if config.fake_home.mode == "mount"
+            else []
+        )
+        for f in real_paths:
+            parts.append([_stat_id(home / f), _stat_id(fake_home / f)])
+
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def run_args_cache_path(context: Context, request_tty: bool) -> Path:
+    key = f"{context.project_dir}\0{context.hostname}".encode()
+    name = hashlib.sha256(key).hexdigest()[:32]
+    suffix = "tty" if request_tty else "notty"
+    return Env.get().cache_path / "plans" / f"{name}-{suffix}.json"
+
+
+@trace.traced("run_args")
+def resolve_run_args(context: Context, request_tty: bool = True) -> List[str]:
+    """Cached equivalent of `docker_run_args_from_project`"""
+    fake_home = context.config.fake_home
+    key = run_args_key(context, request_tty)
+    cache_path = run_args_cache_path(context, request_tty)
+    try:
+        cached = CachedRunArgs.parse_file(cache_path)
+        if cached.key == key:
+            if fake_home is not None and fake_home.mode == "snapshot":
+                sync_snapshot(
+                    Path.home(),
+                    context.project_path(fake_home.root).resolve(),
+                    fake_home.real_paths,
+                )
+            return list(cached.run_args)
+    except (OSError, ValueError):
+        pass
+
+    LOG.debug("Resolving run arguments")
+    run_args = docker_run_args_from_project(context, request_tty)
+    # Resolution may have created fake home paths, fingerprint the result
+    cached = CachedRunArgs(
+        key=run_args_key(context, request_tty), run_args=run_args
+    )
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(cached.json())
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        LOG.debug(f"Can't save resolved run arguments: {e}")
+    return list(run_args)
+
+
+def prepare_launch(
+    context: Context,
+    build: bool,
+    force_build: bool = False,
+    request_tty: bool = True,
+    extra_steps: Sequence[Step] = (),
+) -> List[str]:
+    """Build image, run before_command and resolve run arguments concurrently
+
+    Returns resolved run arguments. `before_command` may prepare bind paths,
+    so run arguments are resolved after it.
+    """
+    config = context.config
+    record_use(context)
+    steps = list(extra_steps)
+    if config.sync is not None:
+        steps.append(Step("sync", lambda: sync_project(context)))
+    image_step = None
+    if config.image is not None:
+        image_step = "image"
+        steps.append(Step(image_step, lambda: launch_image(context)))
+    elif build:
+        image_step = "build"
+        steps.append(
+            Step("build", lambda: build_image(config, context, force_build))
+        )
+
+    if config.cache_volumes:
+        steps.append(
+            Step(
+                "cache_volumes",
+                lambda: ensure_cache_volumes(context),
+                [image_step] if image_step else [],
+            )
+        )
+
+    run_args_needs = []
+    if config.before_command:
+        needs = (
+            [image_step]
+            if image_step and config.before_command_needs_image
+            else []
+        )
+        steps.append(
+            command_step(
+                "before_command",
+                config.before_command,
+                needs,
+                cwd=context.project_dir,
+            )
+        )
+        run_args_needs.append("before_command")
+
+    steps.append(
+        Step(
+            "run_args",
+            lambda: resolve_run_args(context, request_tty),
+            run_args_needs,
+        )
+    )
+    # Depends on running containers, so it's picked anew for every launch
+    steps.append(Step("placement", lambda: placement_args(context)))
+    results = run_steps(steps)
+    return cast(List[str], results["run_args"] + results["placement"])
+
+
+def launch_plan(
+    context: Context,
+    cmd: Union[List[str], str],
+    request_tty: bool = True,
+    run_args: Optional[List[str]] = None,
+) -> LaunchPlan:
+    """Plan of a launch, `run_args` are the ones `prepare_launch` returned"""
+    config = context.config
+    if run_args is None:
+        run_args = resolve_run_args(context, request_tty)
+    return LaunchPlan(
+        image=launch_image(context),
+        run_args=run_args,
+        cmd=shlex.split(cmd) if isinstance(cmd, str) else list(cmd),
+        before_command=config.before_command,
+        after_command=config.after_command,
+    )
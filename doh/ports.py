@@ -0,0 +1,245 @@
+"""Host-wide registry of SSH ports
+
+`doh ssh` publishes the ssh server on `ssh_port` of the host. On servers
+shared by many users ports of different projects collide, and docker
+reports it only when the container is started, after the image build.
+
+Registry is a JSON file in the shared cache dir, guarded by a lock shared
+by all users. `doh ssh` leases its port for the lifetime of the command,
+a lease of another project or a port taken by something else fails the
+launch before anything is built. Leases of dead processes whose ssh
+container is gone are released, so a crashed `doh ssh` doesn't hold the
+port forever.
+
+Ports picked by `doh init` are assigned to the project dir in the registry,
+so projects initialized before either of them runs `doh ssh` don't get the
+same port. Assignments of removed project dirs are released.
+"""
+
+from typing import Dict, Iterator, Optional, Set
+
+import contextlib
+import errno
+import getpass
+import logging
+import os
+import random
+import socket
+import time
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .config import Context
+from .docker import list_containers
+from .env import Env
+from .utils import shared_file_lock
+
+PORT_LABEL = "doh.ssh-port"
+PORT_RANGE = (22_000, 23_000)
+
+LOG = logging.getLogger(__name__)
+
+
+class PortUnavailableError(Exception):
+    pass
+
+
+class Lease(BaseModel):
+    project: str
+    user: str
+    pid: int
+    since: float
+
+
+class Registry(BaseModel):
+    leases: Dict[int, Lease] = {}
+    # Port -> project dir it's configured for
+    assignments: Dict[int, str] = {}
+
+
+def registry_path() -> Path:
+    return Env.get().shared_cache_path / "ports" / "registry.json"
+
+
+def lock_path() -> Path:
+    return registry_path().with_suffix(".lock")
+
+
+def is_port_free(port: int, host: str = "127.0.0.1") -> bool:
+    """Whether a listener can bind the port right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # Let ports in TIME_WAIT pass, docker can bind them too
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError as e:
+            if e.errno in (errno.EADDRINUSE, errno.EACCES):
+                return False
+            raise
+    return True
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process of another user
+        return True
+    return True
+
+
+def container_ports() -> Set[int]:
+    """Ports of running ssh containers of all projects"""
+    try:
+        containers = list_containers(filters={"label": [PORT_LABEL]})
+    except Exception as e:  # Docker isn't reachable, don't block on that
+        LOG.debug(f"Can't list ssh containers: {e}")
+        return set()
+    return {int(c["Labels"][PORT_LABEL]) for c in containers}
+
+
+def load_registry() -> Registry:
+    try:
+        return Registry.parse_file(registry_path())
+    except (OSError, ValueError):
+        return Registry()
+
+
+def save_registry(registry: Registry) -> None:
+    path = registry_path()
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(registry.json())
+    with contextlib.suppress(PermissionError):
+        os.chmod(tmp_path, 0o666)
+    tmp_path.replace(path)
+
+
+def release_stale(registry: Registry) -> None:
+    dead = [
+        port
+        for port, lease in registry.leases.items()
+        if not _pid_alive(lease.pid)
+    ]
+    if not dead:
+        return
+    alive_containers = container_ports()
+    for port in dead:
+        if port not in alive_containers:
+            LOG.debug(f"Releasing stale lease of port {port}")
+            del registry.leases[port]
+
+
+def _project_exists(project: str) -> bool:
+    try:
+        os.stat(project)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    except OSError:
+        # Not accessible for us, e.g. in a private home of another user
+        return True
+    return True
+
+
+def release_removed(registry: Registry) -> None:
+    for port, project in list(registry.assignments.items()):
+        if not _project_exists(project):
+            LOG.debug(f"Releasing port {port} of removed project {project}")
+            del registry.assignments[port]
+
+
+def _assign(registry: Registry, context: Context, port: int) -> None:
+    project = str(context.project_dir)
+    for assigned, owner in list(registry.assignments.items()):
+        if owner == project:
+            del registry.assignments[assigned]
+    registry.assignments[port] = project
+
+
+def _free_port(registry: Registry, rng: random.Random) -> int:
+    candidates = [
+        p
+        for p in range(*PORT_RANGE)
+        if p not in registry.leases and p not in registry.assignments
+    ]
+    rng.shuffle(candidates)
+    for port in candidates:
+        if is_port_free(port):
+            return port
+    raise PortUnavailableError(f"No free ports in range {PORT_RANGE}")
+
+
+def allocate_port(context: Context, rng: Optional[random.Random] = None) -> int:
+    """Assign the project a port of PORT_RANGE free on this host
+
+    Port already assigned to the project is kept while it's free.
+    """
+    project = str(context.project_dir)
+    with shared_file_lock(lock_path()) as locked:
+        registry = load_registry()
+        release_stale(registry)
+        release_removed(registry)
+        port = next(
+            (
+                p
+                for p, owner in registry.assignments.items()
+                if owner == project
+                and p not in registry.leases
+                and is_port_free(p)
+            ),
+            None,
+        )
+        if port is None:
+            port = _free_port(registry, rng or random.Random())
+        if locked:
+            _assign(registry, context, port)
+            save_registry(registry)
+        return port
+
+
+@contextlib.contextmanager
+def lease_port(context: Context, port: int) -> Iterator[None]:
+    """Reserve port for the block, fails fast if it's taken"""
+    with shared_file_lock(lock_path()) as locked:
+        registry = load_registry()
+        release_stale(registry)
+        release_removed(registry)
+        lease = registry.leases.get(port)
+        if lease is not None:
+            raise PortUnavailableError(
+                f"Port {port} is used by `doh ssh` of {lease.user}"
+                f" (pid {lease.pid}) for {lease.project}. Set another"
+                f" ssh_port, e.g. {_free_port(registry, random.Random())}"
+            )
+        assigned = registry.assignments.get(port, str(context.project_dir))
+        if assigned != str(context.project_dir):
+            raise PortUnavailableError(
+                f"Port {port} is assigned to {assigned}. Set another"
+                f" ssh_port, e.g. {_free_port(registry, random.Random())}"
+            )
+        if not is_port_free(port):
+            raise PortUnavailableError(
+                f"Port {port} is already used on this host. Set another"
+                f" ssh_port, e.g. {_free_port(registry, random.Random())}"
+            )
+        if locked:
+            # Project may have changed ssh_port since `doh init`
+            _assign(registry, context, port)
+            registry.leases[port] = Lease(
+                project=str(context.project_dir),
+                user=getpass.getuser(),
+                pid=os.getpid(),
+                since=time.time(),
+            )
+            save_registry(registry)
+    try:
+        yield
+    finally:
+        with shared_file_lock(lock_path()) as locked:
+            registry = load_registry()
+            lease = registry.leases.get(port)
+            if locked and lease is not None and lease.pid == os.getpid():
+                del registry.leases[port]
+                save_registry(registry)
@@ -0,0 +1,99 @@
+"""Prebuilt image mode
+
+With `image = "repo:tag"` in config nothing is built: the tag is resolved
+to a registry digest once and containers are started by digest, so
+launches don't depend on the tag moving and are identical across hosts.
+Resolved digests are cached per image reference for `image_ttl` seconds,
+`doh pull` re-resolves right away.
+"""
+
+from typing import Optional
+
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .config import Config, Context
+from .docker import inspect_image, pull_image
+from .env import Env
+
+LOG = logging.getLogger(__name__)
+
+
+class PinnedImage(BaseModel):
+    image: str
+    # repo@sha256:... or image id if image has no registry digest
+    digest: str
+    resolved_at: float
+
+
+def pin_path(image: str) -> Path:
+    key = hashlib.sha256(image.encode()).hexdigest()[:32]
+    return Env.get().cache_path / "images" / f"{key}.json"
+
+
+def is_pinned_by_digest(image: str) -> bool:
+    return "@sha256:" in image
+
+
+def load_pin(image: str) -> Optional[PinnedImage]:
+    try:
+        return PinnedImage.parse_file(pin_path(image))
+    except (OSError, ValueError):
+        return None
+
+
+def save_pin(pin: PinnedImage) -> None:
+    path = pin_path(pin.image)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(pin.json())
+    tmp_path.replace(path)
+
+
+def _repo(image: str) -> str:
+    name, _, tag = image.rpartition(":")
+    return name if name and "/" not in tag else image
+
+
+def resolve_image(image: str) -> PinnedImage:
+    """Pull image and pin the digest its tag points to now"""
+    pull_image(image)
+    inspected = inspect_image(image)
+    if inspected is None:
+        raise RuntimeError(f"Image {image} is missing after pull")
+
+    repo = _repo(image)
+    digests = inspected.get("RepoDigests") or []
+    digest = next(
+        (d for d in digests if d.split("@")[0] == repo),
+        digests[0] if digests else inspected["Id"],
+    )
+    LOG.debug(f"Resolved {image} to {digest}")
+    pin = PinnedImage(image=image, digest=digest, resolved_at=time.time())
+    save_pin(pin)
+    return pin
+
+
+def pinned_image(config: Config, refresh: bool = False) -> str:
+    """Digest reference of configured `image`, resolved if TTL expired"""
+    image = config.image
+    assert image is not None
+    if is_pinned_by_digest(image):
+        return image
+    pin = None if refresh else load_pin(image)
+    if pin is None or time.time() - pin.resolved_at > config.image_ttl:
+        pin = resolve_image(image)
+    return pin.digest
+
+
+def launch_image(context: Context) -> str:
+    """Image containers of the project are started from"""
+    config = context.config
+    if config.image is None:
+        return context.image_name
+    return pinned_image(config)
@@ -0,0 +1,142 @@
+"""Fake home snapshot mode
+
+Instead of bind mounting every `fake_home.real_paths` entry, selected home
+files are copied into the fake home, which is then the only mount. Copy is
+incremental: manifest keeps (size, mtime, mode, sha256) of every copied
+file, so for unchanged home sync costs a single stat pass and touched but
+unchanged files aren't copied. Files removed from the real home are removed
+from the snapshot. Sync is one way, changes made in container are
+overwritten once the real file changes.
+"""
+
+from typing import Dict, Iterator, List, Tuple
+
+import dataclasses
+import hashlib
+import logging
+import os
+import shutil
+import stat
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .env import Env
+from .fingerprint import file_sha256
+
+LOG = logging.getLogger(__name__)
+
+
+class SnapshotManifest(BaseModel):
+    # path relative to home -> (size, mtime_ns, mode, sha256)
+    files: Dict[str, Tuple[int, int, int, str]] = {}
+
+
+@dataclasses.dataclass
+class SyncStats:
+    copied: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    missing: List[str] = dataclasses.field(default_factory=list)
+
+
+def manifest_path(fake_home: Path) -> Path:
+    key = hashlib.sha256(str(fake_home).encode()).hexdigest()[:32]
+    return Env.get().cache_path / "home-snapshots" / f"{key}.json"
+
+
+def load_manifest(path: Path) -> SnapshotManifest:
+    try:
+        return SnapshotManifest.parse_file(path)
+    except (OSError, ValueError):
+        return SnapshotManifest()
+
+
+def save_manifest(path: Path, manifest: SnapshotManifest) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(manifest.json())
+    tmp_path.replace(path)
+
+
+def walk_home_paths(
+    home: Path, paths: List[str], missing: List[str]
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """(relative path, lstat) of selected paths, dirs are walked recursively"""
+    for rel in paths:
+        rel = os.path.normpath(rel)
+        try:
+            st = os.lstat(home / rel)
+        except FileNotFoundError:
+            missing.append(rel)
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            yield rel, st
+            continue
+        for dirpath, dirnames, filenames in os.walk(home / rel):
+            dirnames.sort()
+            # Symlinks to dirs are listed in dirnames, but aren't walked into
+            links = [d for d in dirnames if os.path.islink(f"{dirpath}/{d}")]
+            for name in sorted(filenames + links):
+                full = os.path.join(dirpath, name)
+                yield os.path.relpath(full, home), os.lstat(full)
+
+
+def _digest(path: Path, st: os.stat_result) -> str:
+    if stat.S_ISLNK(st.st_mode):
+        return hashlib.sha256(os.readlink(path).encode()).hexdigest()
+    return file_sha256(path)
+
+
+def _copy(src: Path, dst: Path, st: os.stat_result) -> None:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.doh-tmp")
+    if stat.S_ISLNK(st.st_mode):
+        tmp.unlink(missing_ok=True)
+        os.symlink(os.readlink(src), tmp)
+    else:
+        shutil.copy2(src, tmp)
+    if dst.is_dir() and not dst.is_symlink():
+        shutil.rmtree(dst)
+    os.replace(tmp, dst)
+
+
+def sync_snapshot(home: Path, fake_home: Path, paths: List[str]) -> SyncStats:
+    """Incrementally copy selected home paths into the fake home"""
+    path = manifest_path(fake_home)
+    manifest = load_manifest(path)
+    stats = SyncStats()
+    files: Dict[str, Tuple[int, int, int, str]] = {}
+
+    for rel, st in walk_home_paths(home, paths, stats.missing):
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+            continue
+        key = (st.st_size, st.st_mtime_ns, st.st_mode)
+        known = manifest.files.get(rel)
+        if known is not None and known[:3] == key:
+            files[rel] = known
+            stats.unchanged += 1
+            continue
+
+        digest = _digest(home / rel, st)
+        target = fake_home / rel
+        if known is None or known[3] != digest or not os.path.lexists(target):
+            _copy(home / rel, target, st)
+            stats.copied += 1
+        elif known[2] != st.st_mode and not stat.S_ISLNK(st.st_mode):
+            os.chmod(target, stat.S_IMODE(st.st_mode))
+        files[rel] = (*key, digest)
+
+    for rel in manifest.files.keys() - files.keys():
+        # Only files placed by previous syncs are removed
+        target = fake_home / rel
+        if os.path.lexists(target) and not os.path.isdir(target):
+            os.unlink(target)
+            stats.removed += 1
+
+    if files != manifest.files:
+        save_manifest(path, SnapshotManifest(files=files))
+    for rel in stats.missing:
+        LOG.warning(f"{home / rel} doesn't exist, it's not in the fake home")
+    LOG.debug(f"Fake home snapshot synced: {stats}")
+    return stats
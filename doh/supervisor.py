@@ -0,0 +1,58 @@
+"""Minimal parent process of `docker run` for projects with after_command
+
+doh replaces itself with `docker run` so the CLI doesn't stay in memory for
+the container lifetime. after_command has to run once the container exits,
+so then doh is replaced with this script instead. It's run by path with
+`python -S` and imports only a few stdlib modules.
+
+The container runs in the process group of the supervisor: signals sent to
+the group (terminal keys, jupyter interrupts) reach docker directly and are
+ignored here. Signals sent to the supervisor process itself are forwarded.
+
+Usage: python -S supervisor.py AFTER_COMMAND DOCKER_ARGV...
+"""
+
+from typing import List
+
+import shlex
+import signal
+import subprocess
+import sys
+
+FORWARDED_SIGNALS = [
+    signal.SIGTERM,
+    signal.SIGHUP,
+    signal.SIGUSR1,
+    signal.SIGUSR2,
+]
+GROUP_SIGNALS = [signal.SIGINT, signal.SIGQUIT]
+
+
+def supervise(argv: List[str], after_command: str) -> int:
+    """Run `argv` then `after_command`, exit code of the first failed one"""
+    for sig in GROUP_SIGNALS:
+        signal.signal(sig, signal.SIG_IGN)
+    child = subprocess.Popen(argv, preexec_fn=_default_group_signals)
+
+    def forward(signum: int, _frame: object) -> None:
+        child.send_signal(signum)
+
+    for sig in FORWARDED_SIGNALS:
+        signal.signal(sig, forward)
+    returncode = child.wait()
+    for sig in FORWARDED_SIGNALS + GROUP_SIGNALS:
+        signal.signal(sig, signal.SIG_DFL)
+
+    after = subprocess.run(shlex.split(after_command))
+    if after.returncode != 0:
+        return after.returncode
+    return 128 - returncode if returncode < 0 else returncode
+
+
+def _default_group_signals() -> None:
+    for sig in GROUP_SIGNALS:
+        signal.signal(sig, signal.SIG_DFL)
+
+
+if __name__ == "__main__":
+    sys.exit(supervise(sys.argv[2:], sys.argv[1]))
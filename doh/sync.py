@@ -0,0 +1,361 @@
+"""Delta sync of the project to the docker host
+
+When the docker daemon runs on another machine, bind mounts refer to
+paths on that machine. With `sync.target` configured, the project is
+mirrored there before launch and the mirror is mounted instead of the
+local project dir.
+
+Unchanged files are skipped by a persisted (size, mtime, mode) manifest,
+so a sync of an unchanged repo costs a stat pass. Changed files are sent
+as deltas against the remote version: the remote side reports weak and
+strong checksums of its blocks, the sender finds matching blocks at any
+offset with a rolling checksum and sends only the data between them.
+Files excluded by .dockerignore or .gitignore are not synced.
+"""
+
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+import abc
+import dataclasses
+import hashlib
+import logging
+import os
+import shlex
+import stat
+import subprocess
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+from pydantic import BaseModel
+
+from . import sync_agent
+from .config import Context
+from .env import Env
+from .ignore import dockerignore_rules, gitignore_rules, walk_files
+from .sync_agent import (
+    Receiver,
+    read_frame,
+    strong_checksum,
+    weak_checksum,
+    write_frame,
+)
+
+ADLER_MOD = 65521
+READ_SIZE = 4 << 20
+# Payload size of a single delta message
+CHUNK_SIZE = 4 << 20
+# Matches are searched at every offset within two blocks after the last
+# match (finds blocks shifted by an insertion of up to a block), then
+# SKIP_BLOCKS blocks are sent as literals without search. Rolling is done
+# in python, this bounds the cost for completely changed files.
+SKIP_BLOCKS = 8
+
+LOG = logging.getLogger(__name__)
+
+
+class SyncError(Exception):
+    pass
+
+
+class Transport(abc.ABC):
+    """Connection to a receiver of the mirror"""
+
+    @abc.abstractmethod
+    def call(self, header: Dict[str, Any], payload: bytes = b"") -> Any:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class LocalTransport(Transport):
+    """Mirror in a local dir, e.g. NFS mount shared with the docker host"""
+
+    def __init__(self, root: Path):
+        self.receiver = Receiver(str(root))
+
+    def call(self, header: Dict[str, Any], payload: bytes = b"") -> Any:
+        return self.receiver.handle(dict(header), payload)
+
+
+class SshTransport(Transport):
+    """Mirror on a remote host, receiver is run with remote `python3`"""
+
+    def __init__(self, host: str, root: str):
+        source = Path(sync_agent.__file__).read_text()
+        remote_cmd = shlex.join(["python3", "-c", source, root])
+        self.proc = subprocess.Popen(
+            ["ssh", "-T", host, remote_cmd],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def call(self, header: Dict[str, Any], payload: bytes = b"") -> Any:
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        write_frame(self.proc.stdin, header, payload)
+        frame = read_frame(self.proc.stdout)
+        if frame is None:
+            raise SyncError(f"Sync receiver exited with {self.proc.wait()}")
+        return frame[0]
+
+    def close(self) -> None:
+        assert self.proc.stdin is not None
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def transport_for(target: str) -> Transport:
+    """`/path` or `ssh://[user@]host/path`"""
+    url = urlparse(target)
+    if url.scheme == "ssh":
+        host = (
+            f"{url.username}@{url.hostname}" if url.username else url.hostname
+        )
+        return SshTransport(str(host), url.path)
+    return LocalTransport(Path(target))
+
+
+def target_path(target: str) -> str:
+    """Path of the mirror on the docker host"""
+    return urlparse(target).path if target.startswith("ssh://") else target
+
+
+class SyncManifest(BaseModel):
+    # relative path -> (size, mtime_ns, mode) of the synced version
+    files: Dict[str, Tuple[int, int, int]] = {}
+
+
+@dataclasses.dataclass
+class SyncStats:
+    files: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    literal_bytes: int = 0
+    matched_bytes: int = 0
+
+
+def manifest_path(root: Path, target: str) -> Path:
+    key = hashlib.sha256(f"{root}\0{target}".encode()).hexdigest()[:32]
+    return Env.get().cache_path / "sync" / f"{key}.json"
+
+
+def save_manifest(path: Path, files: Dict[str, Tuple[int, int, int]]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(SyncManifest(files=files).json())
+    tmp_path.replace(path)
+
+
+def roll(checksum: int, out: int, inp: int, block_size: int) -> int:
+    """Slide adler32 of a window by one byte"""
+    a = checksum & 0xFFFF
+    b = checksum >> 16
+    a = (a - out + inp) % ADLER_MOD
+    b = (b - block_size * out + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+def compute_delta(
+    f: IO[bytes], blocks: List[Tuple[int, str]], block_size: int
+) -> Iterator[Tuple[int, Any]]:
+    """(0, block index) and (1, literal bytes) ops reproducing `f`"""
+    if not blocks:
+        for data in iter(lambda: f.read(CHUNK_SIZE), b""):
+            yield 1, data
+        return
+
+    table: Dict[int, Dict[str, int]] = {}
+    for i, (block_weak, block_strong) in enumerate(blocks):
+        table.setdefault(block_weak, {}).setdefault(block_strong, i)
+
+    buf = bytearray()
+    pos = 0
+    eof = False
+    literal = bytearray()
+    weak: Optional[int] = None
+    rolled = 0
+
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            del buf[:pos]
+            pos = 0
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf += data
+            continue
+        if len(buf) - pos < block_size:
+            # Only the last block of the remote version can be shorter
+            tail = buf[pos:]
+            strong = strong_checksum(tail)
+            last = len(blocks) - 1
+            if tail and blocks[last] == (weak_checksum(tail), strong):
+                if literal:
+                    yield 1, bytes(literal)
+                    literal.clear()
+                yield 0, last
+            else:
+                literal += tail
+            break
+
+        if weak is None:
+            weak = weak_checksum(buf[pos : pos + block_size])
+        match = None
+        if weak in table:
+            strong = strong_checksum(buf[pos : pos + block_size])
+            match = table[weak].get(strong)
+
+        if match is not None:
+            if literal:
+                yield 1, bytes(literal)
+                literal.clear()
+            yield 0, match
+            pos += block_size
+            weak = None
+            rolled = 0
+        elif rolled < 2 * block_size and pos + block_size < len(buf):
+            out = buf[pos]
+            weak = roll(weak, out, buf[pos + block_size], block_size)
+            literal.append(out)
+            pos += 1
+            rolled += 1
+        else:
+            skip = min(block_size * SKIP_BLOCKS, len(buf) - pos - block_size)
+            literal += buf[pos : pos + max(skip, 1)]
+            pos += max(skip, 1)
+            weak = None
+            rolled = 0
+
+        if len(literal) >= CHUNK_SIZE:
+            yield 1, bytes(literal)
+            literal.clear()
+
+    if literal:
+        yield 1, bytes(literal)
+
+
+def send_file(
+    transport: Transport, root: Path, rel: str, st: os.stat_result
+) -> Tuple[int, int]:
+    """Send changed file as delta, returns (literal, matched) byte counts"""
+    signatures = transport.call({"op": "signatures", "path": rel})
+    block_size = signatures["block_size"]
+    blocks = [tuple(b) for b in signatures["blocks"]]
+
+    literal_bytes = matched_bytes = 0
+    transport.call({"op": "begin", "path": rel, "block_size": block_size})
+    ops: List[List[int]] = []
+    payload = bytearray()
+
+    def flush() -> None:
+        transport.call({"op": "chunk", "ops": ops}, bytes(payload))
+        ops.clear()
+        payload.clear()
+
+    with open(root / rel, "rb") as f:
+        for kind, value in compute_delta(f, blocks, block_size):
+            if kind == 0:
+                ops.append([0, value])
+                matched_bytes += block_size
+            else:
+                ops.append([1, len(value)])
+                payload.extend(value)
+                literal_bytes += len(value)
+            if len(payload) >= CHUNK_SIZE or len(ops) >= 65536:
+                flush()
+    flush()
+    transport.call(
+        {"op": "end", "mode": st.st_mode, "mtime_ns": st.st_mtime_ns}
+    )
+    return literal_bytes, matched_bytes
+
+
+def _check(reply: Any) -> Any:
+    if isinstance(reply, dict) and "error" in reply:
+        raise SyncError(reply["error"])
+    return reply
+
+
+class _CheckedTransport(Transport):
+    def __init__(self, transport: Transport):
+        self.transport = transport
+
+    def call(self, header: Dict[str, Any], payload: bytes = b"") -> Any:
+        return _check(self.transport.call(header, payload))
+
+
+def sync_tree(
+    root: Path, transport: Transport, manifest_file: Path, full: bool = False
+) -> SyncStats:
+    """Mirror not ignored files of `root`, `full` ignores the manifest"""
+    transport = _CheckedTransport(transport)
+    try:
+        manifest = SyncManifest.parse_file(manifest_file)
+    except (OSError, ValueError):
+        manifest = SyncManifest()
+    known = {} if full else manifest.files
+
+    stats = SyncStats()
+    # Only successfully sent files are recorded, interrupted sync resumes
+    files: Dict[str, Tuple[int, int, int]] = {}
+    seen = set()
+    rules = [dockerignore_rules(root), gitignore_rules(root)]
+    try:
+        for rel, st in walk_files(root, rules):
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            seen.add(rel)
+            key = (st.st_size, st.st_mtime_ns, st.st_mode)
+            if known.get(rel) == key:
+                files[rel] = key
+                stats.unchanged += 1
+                continue
+
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(root / rel)
+                transport.call({"op": "symlink", "path": rel, "target": target})
+            else:
+                literal, matched = send_file(transport, root, rel, st)
+                stats.literal_bytes += literal
+                stats.matched_bytes += matched
+            files[rel] = key
+            stats.files += 1
+
+        for rel in manifest.files.keys() - seen:
+            transport.call({"op": "remove", "path": rel})
+            stats.removed += 1
+    except BaseException:
+        save_manifest(manifest_file, {**manifest.files, **files})
+        raise
+    save_manifest(manifest_file, files)
+    return stats
+
+
+def sync_project(context: Context, full: bool = False) -> SyncStats:
+    config = context.config
+    assert config.sync is not None
+    target = config.sync.target
+    transport = transport_for(target)
+    try:
+        stats = sync_tree(
+            context.project_dir,
+            transport,
+            manifest_path(context.project_dir, target),
+            full,
+        )
+    finally:
+        transport.close()
+    LOG.debug(f"Synced {context.project_dir} to {target}: {stats}")
+    return stats
+
+
+def watch(context: Context, interval: float = 1.0) -> None:
+    """Sync whenever the project changes, until interrupted"""
+    while True:
+        stats = sync_project(context)
+        if stats.files or stats.removed:
+            LOG.info(
+                f"Synced {stats.files} files, removed {stats.removed},"
+                f" sent {stats.literal_bytes} bytes"
+            )
+        time.sleep(interval)
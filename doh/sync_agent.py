@@ -0,0 +1,170 @@
+"""Receiving side of the project sync
+
+Keeps a mirror dir up to date from deltas computed by `doh.sync`: for a
+changed file the receiver reports checksums of the blocks of its current
+version, the sender answers with a sequence of "copy block N" and literal
+data ops. Files are assembled in a temp file and renamed into place.
+
+Only stdlib is used: `SshTransport` runs the source of this module with
+the remote python, the protocol is length-prefixed JSON frames with an
+optional binary payload over stdin/stdout.
+"""
+
+from typing import IO, Any, Dict, List, Optional, Tuple, Union, cast
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 1 << 20
+TARGET_BLOCKS = 10_000
+
+_HEADER = struct.Struct(">IQ")
+
+
+def block_size_for(size: int) -> int:
+    """Block size giving at most ~TARGET_BLOCKS blocks, power of two"""
+    block = MIN_BLOCK_SIZE
+    while block < MAX_BLOCK_SIZE and size // block > TARGET_BLOCKS:
+        block *= 2
+    return block
+
+
+def weak_checksum(data: Union[bytes, bytearray]) -> int:
+    return zlib.adler32(data)
+
+
+def strong_checksum(data: Union[bytes, bytearray]) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_signatures(path: str, block_size: int) -> List[Tuple[int, str]]:
+    res = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            res.append((weak_checksum(block), strong_checksum(block)))
+    return res
+
+
+def write_frame(
+    stream: IO[bytes], header: Dict[str, Any], payload: bytes = b""
+) -> None:
+    data = json.dumps(header).encode()
+    stream.write(_HEADER.pack(len(data), len(payload)) + data + payload)
+    stream.flush()
+
+
+def read_frame(stream: IO[bytes]) -> Optional[Tuple[Dict[str, Any], bytes]]:
+    prefix = stream.read(_HEADER.size)
+    if len(prefix) < _HEADER.size:
+        return None
+    header_size, payload_size = _HEADER.unpack(prefix)
+    header = json.loads(stream.read(header_size))
+    return header, stream.read(payload_size)
+
+
+class Receiver:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._base: Optional[IO[bytes]] = None
+        self._out: Optional[IO[bytes]] = None
+        self._path = ""
+        self._tmp = ""
+        self._block_size = 0
+
+    def _full(self, rel: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, rel))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Path {rel} is outside of the sync root")
+        return path
+
+    def signatures(self, path: str) -> Dict[str, Any]:
+        full = self._full(path)
+        if not os.path.isfile(full) or os.path.islink(full):
+            return {"block_size": 0, "blocks": []}
+        block_size = block_size_for(os.path.getsize(full))
+        return {
+            "block_size": block_size,
+            "blocks": file_signatures(full, block_size),
+        }
+
+    def begin(self, path: str, block_size: int) -> Dict[str, Any]:
+        full = self._full(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        self._path = full
+        self._block_size = block_size
+        self._base = open(full, "rb") if block_size else None
+        fd, tmp = tempfile.mkstemp(
+            prefix=f".{os.path.basename(full)}.", dir=os.path.dirname(full)
+        )
+        self._out = os.fdopen(fd, "wb")
+        self._tmp = tmp
+        return {}
+
+    def chunk(self, ops: List[List[int]], payload: bytes) -> Dict[str, Any]:
+        assert self._out is not None
+        offset = 0
+        for kind, value in ops:
+            if kind == 0:  # Copy block `value` of the current version
+                assert self._base is not None
+                self._base.seek(value * self._block_size)
+                self._out.write(self._base.read(self._block_size))
+            else:  # Literal data of length `value`
+                self._out.write(payload[offset : offset + value])
+                offset += value
+        return {}
+
+    def end(self, mode: int, mtime_ns: int) -> Dict[str, Any]:
+        assert self._out is not None
+        self._out.close()
+        if self._base is not None:
+            self._base.close()
+        self._base = self._out = None
+        os.chmod(self._tmp, mode & 0o7777)
+        os.utime(self._tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(self._tmp, self._path)
+        return {}
+
+    def symlink(self, path: str, target: str) -> Dict[str, Any]:
+        full = self._full(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.doh-sync-tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(target, tmp)
+        os.replace(tmp, full)
+        return {}
+
+    def remove(self, path: str) -> Dict[str, Any]:
+        full = self._full(path)
+        if os.path.lexists(full) and not os.path.isdir(full):
+            os.unlink(full)
+        return {}
+
+    def handle(self, header: Dict[str, Any], payload: bytes) -> Dict[str, Any]:
+        op = header.pop("op")
+        if op == "chunk":
+            return self.chunk(header["ops"], payload)
+        return cast(Dict[str, Any], getattr(self, op)(**header))
+
+
+def serve(root: str, stdin: IO[bytes], stdout: IO[bytes]) -> None:
+    receiver = Receiver(root)
+    while True:
+        frame = read_frame(stdin)
+        if frame is None:
+            return
+        try:
+            reply = receiver.handle(*frame)
+        except Exception as e:
+            reply = {"error": f"{type(e).__name__}: {e}"}
+        write_frame(stdout, reply)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], sys.stdin.buffer, sys.stdout.buffer)
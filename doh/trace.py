@@ -0,0 +1,248 @@
+"""Phase-level tracing of doh commands
+
+Every command records spans of its phases (config load, build, hooks,
+agent provisioning, run arguments resolution...) and the moment container
+process is launched. Summary of each command is appended to a JSONL history
+in the cache dir, `doh stats` aggregates it. `doh --trace out.json <cmd>`
+additionally writes spans in Chrome trace event format, open it in
+chrome://tracing or https://ui.perfetto.dev.
+
+Only stdlib is imported here: the module is imported by `kernel-run`.
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+HISTORY_FILE_NAME = "history.jsonl"
+HISTORY_MAX_BYTES = 4 * 1024 * 1024
+
+# Approximates process start: imported first thing by `doh.__main__`
+PROCESS_START_NS = time.perf_counter_ns()
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Tracer:
+    def __init__(
+        self,
+        command: str,
+        start_ns: int = PROCESS_START_NS,
+        trace_path: Optional[Path] = None,
+    ):
+        self.command = command
+        self.trace_path = trace_path
+        self.start_ns = start_ns
+        self.launch_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _us(self, ns: int) -> float:
+        return (ns - self.start_ns) / 1000
+
+    def add_span(
+        self, name: str, start_ns: int, end_ns: int, args: Dict[str, Any]
+    ) -> None:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": self._us(start_ns),
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def mark_launched(self) -> None:
+        if self.launch_ns is None:
+            self.launch_ns = time.perf_counter_ns()
+            self.events.append(
+                {
+                    "name": "launch",
+                    "ph": "i",
+                    "s": "p",
+                    "ts": self._us(self.launch_ns),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+    def phases_ms(self) -> Dict[str, float]:
+        """Total duration of spans by name"""
+        res: Dict[str, float] = {}
+        for e in self.events:
+            if e["ph"] == "X":
+                res[e["name"]] = res.get(e["name"], 0) + e["dur"] / 1000
+        return {k: round(v, 3) for k, v in res.items()}
+
+    def summary(self, end_ns: int, status: str) -> Dict[str, Any]:
+        return {
+            "time": time.time(),
+            "command": self.command,
+            **self.attributes,
+            "status": status,
+            "total_ms": round((end_ns - self.start_ns) / 1e6, 3),
+            "launch_ms": (
+                round((self.launch_ns - self.start_ns) / 1e6, 3)
+                if self.launch_ns is not None
+                else None
+            ),
+            "phases": self.phases_ms(),
+        }
+
+    def chrome_trace(self, end_ns: int) -> Dict[str, Any]:
+        root = {
+            "name": self.command,
+            "ph": "X",
+            "ts": 0,
+            "dur": self._us(end_ns),
+            "pid": os.getpid(),
+            "tid": threading.main_thread().ident,
+            "args": self.attributes,
+        }
+        return {"traceEvents": [root, *self.events], "displayTimeUnit": "ms"}
+
+
+_tracer: Optional[Tracer] = None
+
+
+def start(command: str, trace_path: Optional[Path] = None) -> Tracer:
+    """Start tracing, Chrome trace is written to `trace_path` on finish"""
+    global _tracer
+    _tracer = Tracer(command, trace_path=trace_path)
+    return _tracer
+
+
+def current() -> Optional[Tracer]:
+    return _tracer
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tracer.add_span(name, start_ns, time.perf_counter_ns(), args)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator recording every call of the function as a span"""
+
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def annotate(**attributes: Any) -> None:
+    """Attach attributes (e.g. project) to the current command"""
+    if _tracer is not None:
+        _tracer.attributes.update(attributes)
+
+
+def mark_launched() -> None:
+    """Record the moment container process is about to start"""
+    if _tracer is not None:
+        _tracer.mark_launched()
+
+
+def history_path() -> Path:
+    from .env import Env
+
+    return Env.get().cache_path / "trace" / HISTORY_FILE_NAME
+
+
+def append_history(entry: Dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = json.dumps(entry) + "\n"
+    # Single O_APPEND write, concurrent doh processes don't interleave lines
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+    if path.stat().st_size > HISTORY_MAX_BYTES:
+        lines = path.read_bytes().splitlines(keepends=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(b"".join(lines[len(lines) // 2 :]))
+        tmp_path.replace(path)
+
+
+def finish(status: str, trace_path: Optional[Path] = None) -> None:
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    end_ns = time.perf_counter_ns()
+    trace_path = trace_path or tracer.trace_path
+
+    if trace_path is not None:
+        trace_path.write_text(json.dumps(tracer.chrome_trace(end_ns)))
+    try:
+        append_history(tracer.summary(end_ns, status), history_path())
+    except OSError:
+        pass
+
+
+def load_history(path: Path) -> List[Dict[str, Any]]:
+    entries = []
+    try:
+        with path.open() as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # Line cut by history truncation
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def launch_stats(
+    entries: List[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """p50/p95 of launch latency grouped by command and project"""
+    groups: Dict[Any, List[float]] = {}
+    for e in entries:
+        if e.get("launch_ms") is None:
+            continue
+        key = (e["command"], e.get("project", ""))
+        groups.setdefault(key, []).append(e["launch_ms"])
+
+    return [
+        {
+            "command": command,
+            "project": project,
+            "runs": len(values),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+        }
+        for (command, project), values in sorted(groups.items())
+    ]
@@ -1,13 +1,128 @@
+from typing import Any, Iterator, Optional
+
+import contextlib
+import fcntl
 import logging
 import os
+import re
+import sys
+import time
+from pathlib import Path
+
+_SIZE_RE = re.compile(r"^\s*([0-9.]+)\s*([kmgtp]?)(i?b?)\s*$", re.IGNORECASE)
+_SIZE_UNITS = "kmgtp"
+
 
-from rich.logging import RichHandler
+@contextlib.contextmanager
+def rich_hidden() -> Iterator[None]:
+    """Make `import rich` fail inside the block unless rich is already loaded
+
+    typer formats help and errors with rich whenever it's importable, which
+    adds ~100ms of imports to every doh start.
+    """
+    if "rich" in sys.modules:
+        yield
+        return
+    sys.modules["rich"] = None  # type: ignore
+    try:
+        yield
+    finally:
+        del sys.modules["rich"]
 
 
 def setup_logging():
     lvl = logging.DEBUG if "DEBUG" in os.environ else logging.INFO
 
     FORMAT = "%(message)s"
+    if sys.stderr.isatty():
+        from rich.logging import RichHandler
+
+        handler: logging.Handler = RichHandler()
+    else:
+        handler = logging.StreamHandler()
+        FORMAT = "%(asctime)s %(levelname)s %(message)s"
     logging.basicConfig(
-        level=lvl, format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+        level=lvl, format=FORMAT, datefmt="[%X]", handlers=[handler]
     )
+
+
+def parse_size(size: str) -> int:
+    """Parse docker-style size (`512m`, `8g`, `1.5GiB`) to bytes, units are binary"""
+    match = _SIZE_RE.match(size)
+    if match is None:
+        raise ValueError(f"Invalid size: {size!r}")
+    number, unit, _ = match.groups()
+    multiplier = 1024 ** (_SIZE_UNITS.index(unit.lower()) + 1) if unit else 1
+    return int(float(number) * multiplier)
+
+
+def _flock(fd: Any, timeout: Optional[float]) -> bool:
+    if timeout is None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return True
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def file_lock(path: Path, timeout: Optional[float] = None) -> Iterator[bool]:
+    """Exclusive advisory lock, released by OS if the process dies
+
+    With `timeout` waits at most that many seconds, then yields False
+    without locking.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as f:
+        locked = _flock(f, timeout)
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_shared_dir(path: Path) -> None:
+    """Create dir and its missing parents writable by all users of the host
+
+    Created dirs are sticky like /tmp, so users can add files but can't
+    remove or replace the files of others.
+    """
+    missing = []
+    parent = path
+    while not parent.exists():
+        missing.append(parent)
+        parent = parent.parent
+    path.mkdir(parents=True, exist_ok=True)
+    for created in reversed(missing):
+        with contextlib.suppress(PermissionError):
+            created.chmod(0o1777)
+
+
+@contextlib.contextmanager
+def shared_file_lock(
+    path: Path, timeout: Optional[float] = None
+) -> Iterator[bool]:
+    """`file_lock` on a file shared by all users of the host
+
+    Yields False without locking when the lock file isn't writable for us.
+    """
+    try:
+        make_shared_dir(path.parent)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    except PermissionError:
+        yield False
+        return
+    try:
+        with contextlib.suppress(PermissionError):
+            os.fchmod(fd, 0o666)
+        locked = _flock(fd, timeout)
+        yield locked
+    finally:
+        os.close(fd)
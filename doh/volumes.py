@@ -0,0 +1,134 @@
+"""Persistent cache volumes
+
+`cache_volumes` entries are docker named volumes mounted over cache dirs of
+package managers, so caches survive `--rm` containers without landing in
+the project tree. Docker creates missing volumes owned by root, so before
+the first use a volume is handed to the container user: project volumes
+are chowned to it, shared ones are made world writable with sticky bit.
+Ready marker keeps creation time of the prepared volume, so a volume
+removed and recreated outside of doh is prepared again.
+"""
+
+from typing import Any, Dict, List
+
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+from .config import CacheVolumeParameters, Context
+from .docker import (
+    CACHE_LABEL,
+    CACHE_SCOPE_LABEL,
+    cache_volume_labels,
+    cache_volume_mount,
+    cache_volume_name,
+    engine_client,
+    inspect_image,
+    inspect_volume,
+    list_volumes,
+    remove_volume,
+)
+from .env import Env
+from .pipeline import run_command
+from .prebuilt import launch_image
+
+LOG = logging.getLogger(__name__)
+
+
+def ready_marker(volume: str) -> Path:
+    return Env.get().cache_path / "volumes" / f"{volume}.ready"
+
+
+def prepare_volume(
+    volume: str, name: str, params: CacheVolumeParameters, image: str
+) -> None:
+    """Create volume and make it writable for the container user"""
+    if params.scope == "shared":
+        cmd = ["chmod", "1777", "/volume"]
+    else:
+        cmd = ["chown", f"{os.getuid()}:{os.getgid()}", "/volume"]
+    LOG.debug(f"Preparing cache volume {volume}")
+    client = engine_client()
+    if client is not None and inspect_image(image) is not None:
+        mount = {
+            "Type": "volume",
+            "Source": volume,
+            "Target": "/volume",
+            "VolumeOptions": {"Labels": cache_volume_labels(name, params)},
+        }
+        exit_code = client.run_container(
+            {
+                "Image": image,
+                "User": "0:0",
+                "Entrypoint": cmd[:1],
+                "Cmd": cmd[1:],
+                "HostConfig": {"Mounts": [mount]},
+            }
+        )
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, cmd)
+        return
+
+    # CLI pulls the image if it's missing, Engine API doesn't
+    argv = [
+        "docker",
+        "run",
+        "--rm",
+        "--user",
+        "0:0",
+        "--mount",
+        cache_volume_mount(volume, "/volume", name, params),
+        "--entrypoint",
+        cmd[0],
+        image,
+        *cmd[1:],
+    ]
+    run_command(argv, check=True)
+
+
+def ensure_cache_volumes(context: Context) -> None:
+    config = context.config
+    for name, params in config.cache_volumes.items():
+        volume = cache_volume_name(context, name, params)
+        marker = ready_marker(volume)
+        try:
+            prepared_at = marker.read_text()
+        except OSError:
+            prepared_at = None
+        inspected = inspect_volume(volume)
+        if inspected is not None and inspected["CreatedAt"] == prepared_at:
+            continue
+        prepare_volume(volume, name, params, launch_image(context))
+        inspected = inspect_volume(volume)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.write_text(inspected["CreatedAt"] if inspected else "")
+
+
+def cache_volumes() -> List[Dict[str, Any]]:
+    return sorted(list_volumes(CACHE_LABEL), key=lambda v: v["Name"])
+
+
+def prune_cache_volumes(
+    context: Context, shared: bool = False, all_projects: bool = False
+) -> List[str]:
+    """Remove unused cache volumes of the project, returns removed names"""
+    if all_projects:
+        names = None
+    else:
+        names = {
+            cache_volume_name(context, name, params)
+            for name, params in context.config.cache_volumes.items()
+            if params.scope == "project"
+        }
+    removed = []
+    for volume in cache_volumes():
+        is_shared = volume["Labels"].get(CACHE_SCOPE_LABEL) == "shared"
+        if is_shared and not shared:
+            continue
+        if not is_shared and names is not None and volume["Name"] not in names:
+            continue
+        if remove_volume(volume["Name"]):
+            ready_marker(volume["Name"]).unlink(missing_ok=True)
+            removed.append(volume["Name"])
+    return removed
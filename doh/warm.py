@@ -0,0 +1,185 @@
+"""Warm mode: a long-lived container per environment driven by `docker exec`
+
+Warm container runs a tiny idle loop as its main process. The loop watches
+mtime of a stamp file mounted from the host, doh touches the stamp on every
+command and periodically while it runs, so the container exits (and is
+removed, it's started with --rm) after `warm.idle_timeout` seconds without
+commands. Container is recreated whenever the image or resolved run
+arguments change.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import contextlib
+import hashlib
+import json
+import logging
+import shlex
+import subprocess
+import threading
+from pathlib import Path
+
+from . import trace
+from .config import Context
+from .docker import (
+    container_name,
+    inspect_container,
+    inspect_image,
+    remove_container,
+    run_docker_cli,
+)
+from .env import Env
+from .placement import placement_args
+from .plan import resolve_run_args
+from .prebuilt import launch_image
+
+WARM_LABEL = "doh.warm"
+RUN_ARGS_HASH_LABEL = "doh.run-args-hash"
+STAMP_CONTAINER_PATH = "/.doh-warm-stamp"
+IDLE_POLL_INTERVAL = 5
+
+LOG = logging.getLogger(__name__)
+
+
+def warm_container_name(context: Context) -> str:
+    return container_name("warm", context)
+
+
+def stamp_path(context: Context) -> Path:
+    return (
+        Env.get().cache_path / "warm" / f"{warm_container_name(context)}.stamp"
+    )
+
+
+def touch_stamp(context: Context) -> Path:
+    path = stamp_path(context)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    return path
+
+
+@contextlib.contextmanager
+def keep_warm(context: Context) -> Iterator[None]:
+    """Keep touching the stamp while a command runs in the warm container
+
+    Otherwise idle loop stops the container under commands running longer
+    than the idle timeout.
+    """
+    assert context.config.warm is not None
+    interval = context.config.warm.idle_timeout / 2
+    stop = threading.Event()
+
+    def touch_until_stopped() -> None:
+        while not stop.wait(interval):
+            touch_stamp(context)
+
+    thread = threading.Thread(target=touch_until_stopped, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        touch_stamp(context)
+
+
+def idle_loop_cmd(idle_timeout: int) -> List[str]:
+    script = (
+        f"while [ $(( $(date +%s) - $(stat -c %Y {STAMP_CONTAINER_PATH}) ))"
+        f" -lt {idle_timeout} ]; do sleep {IDLE_POLL_INTERVAL}; done"
+    )
+    return ["sh", "-c", script]
+
+
+def run_args_hash(image_id: str, run_args: List[str], idle_timeout: int) -> str:
+    key = json.dumps([image_id, run_args, idle_timeout])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def recreate_reason(
+    container: Optional[Dict[str, Any]], args_hash: str
+) -> Optional[str]:
+    if container is None:
+        return "no warm container"
+    if not container["State"]["Running"]:
+        return "warm container is not running"
+    labels = container["Config"].get("Labels") or {}
+    if labels.get(RUN_ARGS_HASH_LABEL) != args_hash:
+        return "image or run arguments changed"
+    return None
+
+
+def start_warm_container(
+    context: Context, run_args: List[str], args_hash: str
+) -> None:
+    config = context.config
+    assert config.warm is not None
+    name = warm_container_name(context)
+
+    # Placement isn't a part of the hash, it's picked when container starts
+    run_args = [
+        *run_args,
+        *placement_args(context),
+        "--detach",
+        "--name",
+        name,
+        "--label",
+        f"{WARM_LABEL}={context.environment_id}",
+        "--label",
+        f"{RUN_ARGS_HASH_LABEL}={args_hash}",
+        "--volume",
+        f"{touch_stamp(context)}:{STAMP_CONTAINER_PATH}:ro",
+    ]
+    argv = [
+        "docker",
+        "run",
+        *run_args,
+        launch_image(context),
+        *idle_loop_cmd(config.warm.idle_timeout),
+    ]
+    LOG.debug(shlex.join(argv))
+    res = subprocess.run(argv, stdout=subprocess.DEVNULL)
+
+    if res.returncode != 0:
+        # Concurrent doh invocation may have started the same container
+        if recreate_reason(inspect_container(name), args_hash) is not None:
+            raise subprocess.CalledProcessError(res.returncode, argv)
+
+
+@trace.traced("warm_container")
+def ensure_warm_container(context: Context) -> str:
+    config = context.config
+    assert config.warm is not None
+    name = warm_container_name(context)
+
+    image = inspect_image(launch_image(context))
+    image_id = image["Id"] if image is not None else ""
+    run_args = resolve_run_args(context, request_tty=False)
+    args_hash = run_args_hash(image_id, run_args, config.warm.idle_timeout)
+
+    touch_stamp(context)
+    container = inspect_container(name)
+    reason = recreate_reason(container, args_hash)
+    if reason is not None:
+        LOG.debug(f"Starting warm container {name}: {reason}")
+        if container is not None:
+            stop_warm_container(context)
+        start_warm_container(context, run_args, args_hash)
+
+    return name
+
+
+def run_warm(
+    context: Context, cmd: Union[List[str], str], request_tty: bool = True
+) -> None:
+    name = ensure_warm_container(context)
+
+    cmd = shlex.join(map(str, cmd)) if not isinstance(cmd, str) else cmd
+    exec_args = "--tty --interactive " if request_tty else ""
+    trace.mark_launched()
+    with keep_warm(context), trace.span("container"):
+        run_docker_cli(f"exec {exec_args}{name} {cmd}")
+
+
+def stop_warm_container(context: Context) -> None:
+    remove_container(warm_container_name(context))
@@ -1,23 +1,119 @@
-from doh.agent import build_cache_key_path, ensure_agent_present
+from typing import Dict, List
+
+import contextlib
+import io
+import json
+import os
+import tarfile
+import threading
+
+import pytest
+from doh import agent
 from doh.env import Env
 
+BINARY_PATH = agent.SSH_SERVER_EXECUTABLE_PATH.lstrip("/")
+
+
+def make_tar(files: Dict[str, bytes], compression: str = "") -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=f"w:{compression}") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def image_tarball(layers: List[Dict[str, bytes]], oci: bool = False) -> bytes:
+    files = {}
+    names = []
+    for i, layer in enumerate(layers):
+        name = f"blobs/sha256/{i}" if oci else f"{i}/layer.tar"
+        files[name] = make_tar(layer, "gz" if oci else "")
+        names.append(name)
+    if oci:
+        files["blobs/sha256/config"] = b'{"architecture": "amd64"}'
+    # docker puts manifest after the layers
+    files["manifest.json"] = json.dumps([{"Layers": names}]).encode()
+    return make_tar(files)
+
+
+@pytest.mark.parametrize("oci", [False, True])
+def test_extract_topmost_version(oci: bool) -> None:
+    tarball = image_tarball(
+        [{BINARY_PATH: b"v1", "etc/passwd": b""}, {BINARY_PATH: b"v2"}, {}],
+        oci,
+    )
+    out = io.BytesIO()
+    agent.extract_from_image_tarball(
+        io.BytesIO(tarball), f"/{BINARY_PATH}", out
+    )
+    assert out.getvalue() == b"v2"
+
+
+def test_extract_deleted_file() -> None:
+    whiteout = os.path.join(
+        os.path.dirname(BINARY_PATH), ".wh." + os.path.basename(BINARY_PATH)
+    )
+    tarball = image_tarball([{BINARY_PATH: b"v1"}, {whiteout: b""}])
+    with pytest.raises(FileNotFoundError):
+        agent.extract_from_image_tarball(
+            io.BytesIO(tarball), BINARY_PATH, io.BytesIO()
+        )
+
+
+@pytest.fixture
+def fake_image(monkeypatch) -> List[int]:
+    exports = []
+    tarball = image_tarball([{BINARY_PATH: b"server"}])
+
+    @contextlib.contextmanager
+    def fake_tarball(image_name):
+        exports.append(1)
+        yield io.BytesIO(tarball)
+
+    monkeypatch.setattr(agent, "image_tarball", fake_tarball)
+    monkeypatch.setattr(agent, "inspect_image", lambda n: {"Id": "sha256:1"})
+    return exports
+
+
+def test_ssh_cache(test_env: Env, fake_image: List[int]) -> None:
+    path = agent.ensure_agent_present()
+
+    assert (path / "ssh-server").read_bytes() == b"server"
+    assert os.access(path / "ssh-server", os.X_OK)
+    assert os.listdir(path) == ["ssh-server"]
+    assert agent.ensure_agent_present() == path
+    assert len(fake_image) == 1
 
-def test_ssh_cache(test_env: Env):
-    ensure_agent_present()
+    # Broken store is repaired
+    (path / "ssh-server").unlink()
+    assert agent.ensure_agent_present() == path
+    assert len(fake_image) == 2
 
-    cache_key = build_cache_key_path()
-    assert cache_key.exists()
-    assert (cache_key.parent / "ssh-server").exists()
 
+def test_concurrent_extraction(test_env: Env, fake_image: List[int]) -> None:
+    paths = []
+    threads = [
+        threading.Thread(
+            target=lambda: paths.append(agent.ensure_agent_present())
+        )
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
 
-def test_cache_invalidation(test_env: Env):
-    agent_path = test_env.cache_path / "agent"
-    agent_path.mkdir(parents=True)
+    assert len(set(paths)) == 1
+    assert len(fake_image) == 1
 
-    server_path = agent_path / "ssh-server"
-    OLD_VERSION_BIN = b"OLD"
-    server_path.write_bytes(OLD_VERSION_BIN)
 
-    ensure_agent_present()
+def test_shared_store(tmp_path, monkeypatch, fake_image: List[int]) -> None:
+    monkeypatch.setenv("DOH_SHARED_CACHE_DIR", str(tmp_path / "shared"))
 
-    assert server_path.read_bytes() != OLD_VERSION_BIN
+    path = agent.ensure_agent_present()
+    assert str(path).startswith(str(tmp_path / "shared"))
+    # Other users of the host can add objects and tags
+    for name in ["agent", "agent/objects", "agent/tags", "agent/locks"]:
+        assert (tmp_path / "shared" / name).stat().st_mode & 0o7777 == 0o1777
@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+
+import pytest
+from doh import buildcache
+from doh.config import BuildCacheParameters, Context
+
+PARAMS = BuildCacheParameters(builder="test", max_size="1m")
+
+
+def test_base_images(tmp_path: Path) -> None:
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text(
+        "FROM --platform=linux/amd64 python:3.10 AS build\n"
+        "RUN pip wheel .\n"
+        "from build as test\n"
+        "FROM debian:12\n"
+    )
+    assert buildcache.base_images(dockerfile) == ["python:3.10", "debian:12"]
+
+
+def test_buildx_argv() -> None:
+    assert buildcache.buildx_argv(["docker", "build", "."], ["--load"]) == [
+        "docker",
+        "buildx",
+        "build",
+        "--load",
+        ".",
+    ]
+    assert buildcache.buildx_argv(["podman", "build", "."], []) is None
+
+
+def test_cache_saved_and_shared(tmp_path: Path) -> None:
+    a = Context.create_for_path(tmp_path / "a")
+    b = Context.create_for_path(tmp_path / "b")
+    for context in (a, b):
+        context.project_dir.mkdir()
+        (context.project_dir / "Dockerfile").write_text("FROM python:3.10")
+
+    argv = ["docker", "build", "-t", "a", "."]
+    with buildcache.local_build_cache(PARAMS, a, argv) as build_argv:
+        assert "--cache-from" not in build_argv
+        dest = build_argv[build_argv.index("--cache-to") + 1]
+        new_cache = Path(dest.split("dest=")[1].split(",")[0])
+        (new_cache / "index.json").write_text("{}")
+
+    cache = buildcache.cache_dir(a)
+    assert (cache / "index.json").is_file()
+    assert not new_cache.exists()
+
+    with buildcache.local_build_cache(PARAMS, b, argv) as build_argv:
+        assert f"type=local,src={cache}" in build_argv
+
+    # Failed build keeps the previous cache
+    with pytest.raises(RuntimeError):
+        with buildcache.local_build_cache(PARAMS, a, argv):
+            raise RuntimeError()
+    assert (cache / "index.json").is_file()
+    assert [p.name for p in cache.parent.iterdir() if p.name[0] == "."] == []
+
+
+def test_prune_lru() -> None:
+    root = buildcache.cache_root()
+    for i, name in enumerate(["old", "recent", "current"]):
+        cache = root / name
+        cache.mkdir(parents=True)
+        (cache / "blob").write_bytes(b"0" * 600)
+        buildcache.meta_path(cache).write_text("{}")
+        os.utime(buildcache.meta_path(cache), (i, i))
+
+    buildcache.prune_caches(1300, keep=root / "current")
+    assert sorted(p.name for p in root.iterdir() if p.is_dir()) == [
+        "current",
+        "recent",
+    ]
+
+    buildcache.prune_caches(100, keep=root / "current")
+    assert [p.name for p in root.iterdir() if p.is_dir()] == ["current"]
@@ -0,0 +1,62 @@
+from typing import Any, Dict, List, NoReturn, Optional, Union
+
+from pathlib import Path
+
+import pytest
+from doh import docker, placement, plan
+from doh.__main__ import app
+from typer.testing import CliRunner
+
+
+@pytest.fixture()
+def launched(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Dict[str, Any]:
+    project = tmp_path / "project"
+    project.mkdir()
+    monkeypatch.chdir(project)
+    launch: Dict[str, Any] = {"resolved": 0}
+    resolve = plan.resolve_run_args
+
+    def counting_resolve(context, request_tty=True):
+        launch["resolved"] += 1
+        return resolve(context, request_tty)
+
+    def fake_handoff(
+        run_args: List[str],
+        image: str,
+        cmd: Union[List[str], str],
+        after_command: Optional[str] = None,
+    ) -> NoReturn:
+        launch["argv"] = docker.docker_run_argv(run_args, image, cmd)
+        raise SystemExit(0)
+
+    monkeypatch.setattr(plan, "resolve_run_args", counting_resolve)
+    monkeypatch.setattr(docker, "handoff_docker_run", fake_handoff)
+    return launch
+
+
+def test_exec_resolves_run_args_once(launched: Dict[str, Any]) -> None:
+    result = CliRunner().invoke(app, ["exec", "--no-build", "true"])
+    assert result.exit_code == 0, result.output
+    assert launched["resolved"] == 1
+    assert launched["argv"][:2] == ["docker", "run"]
+    assert launched["argv"][-1] == "true"
+
+
+def test_exec_applies_placement(
+    launched: Dict[str, Any], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    Path("dohrc.toml").write_text("[hosts.all.placement]\nmax_nodes = 1\n")
+    nodes = [placement.NumaNode(0, [0, 1]), placement.NumaNode(1, [2, 3])]
+    monkeypatch.setattr(placement, "read_topology", lambda root: nodes)
+    monkeypatch.setattr(
+        placement,
+        "list_containers",
+        lambda filters: [{"Labels": {placement.CPUS_LABEL: "0-1"}}],
+    )
+
+    result = CliRunner().invoke(app, ["exec", "--no-build", "true"])
+    assert result.exit_code == 0, result.output
+    argv = launched["argv"]
+    assert argv[argv.index("--cpuset-cpus") + 1] == "2-3"
+    assert argv[argv.index("--cpuset-mems") + 1] == "1"
+    assert f"{placement.CPUS_LABEL}=2-3" in argv
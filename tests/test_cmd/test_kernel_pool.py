@@ -0,0 +1,118 @@
+from typing import Any, Dict, List
+
+import itertools
+import json
+import os
+from pathlib import Path
+
+import pytest
+from doh.commands.kernel import pool
+from doh.config import Context, KernelPoolParameters
+from doh.docker import container_name
+
+
+@pytest.fixture
+def fake_pool(
+    context: Context, monkeypatch: pytest.MonkeyPatch
+) -> Dict[str, Dict[str, Any]]:
+    context.config.kernel_pool = KernelPoolParameters(size=2)
+    containers: Dict[str, Dict[str, Any]] = {}
+    counter = itertools.count()
+
+    def fake_start(context, run_args, args_hash):
+        name = f"{container_name('kernel', context)}-{next(counter)}"
+        slot = pool.pool_dir(context) / name
+        slot.mkdir(parents=True)
+        (slot / pool.READY_MARKER).touch()
+        containers[name] = {
+            "Names": [f"/{name}"],
+            "Labels": {pool.RUN_ARGS_HASH_LABEL: args_hash},
+        }
+
+    monkeypatch.setattr(pool, "start_pool_container", fake_start)
+    monkeypatch.setattr(
+        pool, "list_containers", lambda filters: list(containers.values())
+    )
+    monkeypatch.setattr(pool, "remove_container", containers.pop)
+    monkeypatch.setattr(pool, "inspect_image", lambda name: {"Id": "sha256:1"})
+    monkeypatch.setattr(pool, "container_memory_usage", lambda name: 2**30)
+    monkeypatch.setattr(pool, "spawn_pool_fill", lambda context: None)
+    return containers
+
+
+def test_pool_fill_and_claim(
+    context: Context, fake_pool: Dict[str, Dict[str, Any]], tmp_path: Path
+) -> None:
+    pool.fill_pool(context)
+    assert len(fake_pool) == 2
+    pool.fill_pool(context)
+    assert len(fake_pool) == 2
+
+    conn_spec = tmp_path / "kernel.json"
+    conn_spec.write_text(json.dumps({"ip": "127.0.0.1", "shell_port": 1}))
+
+    slot = pool.claim_slot(context)
+    assert slot is not None
+    assert (slot / pool.CLAIMED_DIR / pool.OWNER_FILE).read_text() == str(
+        os.getpid()
+    )
+    pool.hand_connection_file(slot, conn_spec)
+    assert json.loads((slot / pool.CONNECTION_FILE).read_text()) == {
+        "ip": "127.0.0.1",
+        "shell_port": 1,
+    }
+
+    # The other container is still ready, claimed one is not handed twice
+    other = pool.claim_slot(context)
+    assert other is not None and other != slot
+    assert pool.claim_slot(context) is None
+
+
+def test_pool_kernel_run(
+    context: Context,
+    fake_pool: Dict[str, Dict[str, Any]],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    attached: List[str] = []
+    monkeypatch.setattr(pool, "run_docker_cli", attached.append)
+    conn_spec = tmp_path / "kernel.json"
+    conn_spec.write_text(json.dumps({"ip": "127.0.0.1", "shell_port": 1}))
+
+    assert not pool.run_pooled_kernel(context, conn_spec)
+
+    pool.fill_pool(context)
+    assert pool.run_pooled_kernel(context, conn_spec)
+    assert attached[0].startswith("attach --no-stdin doh-kernel-")
+    assert len(fake_pool) == 1
+
+
+def test_pool_replaces_stale_containers(
+    context: Context, fake_pool: Dict[str, Dict[str, Any]]
+) -> None:
+    pool.fill_pool(context)
+    names = set(fake_pool)
+
+    context.config.environment["FOO"] = "BAR"
+    pool.fill_pool(context)
+    assert len(fake_pool) == 2
+    assert not names & set(fake_pool)
+
+    # Kernel process which claimed the container is gone
+    slot = pool.claim_slot(context)
+    assert slot is not None
+    (slot / pool.CLAIMED_DIR / pool.OWNER_FILE).write_text("999999999")
+    pool.fill_pool(context)
+    assert slot.name not in fake_pool
+    assert not slot.exists()
+    assert len(fake_pool) == 2
+
+
+def test_pool_memory_cap(
+    context: Context, fake_pool: Dict[str, Dict[str, Any]]
+) -> None:
+    context.config.kernel_pool = KernelPoolParameters(size=5, memory_cap="3g")
+    pool.fill_pool(context)
+    assert len(fake_pool) == 1
+    pool.fill_pool(context)
+    assert len(fake_pool) == 3
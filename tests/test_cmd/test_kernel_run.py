@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+
+import pytest
+from doh.commands.kernel import pool, run
+from doh.commands.kernel.run import docker_run_args_for_kernel
+from doh.config import Context, KernelPoolParameters
+
+
+def _conn_spec(path: Path) -> Path:
+    path.write_text(
+        json.dumps(
+            {
+                "ip": "127.0.0.1",
+                "transport": "tcp",
+                "shell_port": 5000,
+                "iopub_port": 5001,
+                "stdin_port": 5002,
+                "control_port": 5010,
+                "hb_port": 4990,
+            }
+        )
+    )
+    return path
+
+
+def test_publish_merges_ranges(tmp_path: Path) -> None:
+    args = docker_run_args_for_kernel(_conn_spec(tmp_path / "k.json"), "p")
+    assert [a for a in args if "127.0.0.1" in a] == [
+        "127.0.0.1:4990:4990",
+        "127.0.0.1:5000-5002:5000-5002",
+        "127.0.0.1:5010:5010",
+    ]
+
+
+def test_host_network(tmp_path: Path) -> None:
+    args = docker_run_args_for_kernel(
+        _conn_spec(tmp_path / "k.json"), "p", "host"
+    )
+    assert args[:2] == ["--network", "host"]
+    assert "--publish" not in args
+
+
+def test_after_command_of_pooled_kernel(
+    context: Context, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(context.project_dir)
+    marker = context.project_dir / "after-ran"
+    context.config.after_command = f"touch {marker}"
+    context.config.kernel_pool = KernelPoolParameters()
+    monkeypatch.setattr(run, "prepare_launch", lambda *args, **kwargs: [])
+    monkeypatch.setattr(pool, "run_pooled_kernel", lambda *args: True)
+
+    spec = _conn_spec(context.project_dir / "k.json")
+    run.run_kernel(context, spec, build=False)
+    assert marker.exists()
@@ -1,3 +1,4 @@
+import time
 from pathlib import Path
 
 from doh.config import (
@@ -5,9 +6,15 @@ from doh.config import (
     ConfigType,
     Context,
     FakeHomeParameters,
+    _compiled_configs,
+    dict_merge,
+    explain_config,
     load_config,
+    load_final_config,
+    resolve_config,
     save_config,
 )
+from doh.env import Env
 
 
 def test_save_load_cycle(context: Context) -> None:
@@ -25,3 +32,118 @@ def test_save_load_cycle(context: Context) -> None:
 
     assert loaded_config == test_config
     assert loaded_config != Config()
+
+
+def test_final_config_cache(context: Context, monkeypatch) -> None:
+    conf_path = context.project_dir / "dohrc.toml"
+    conf_path.write_text('sh_cmd = "$DOH_TEST_SHELL"')
+    monkeypatch.setenv("DOH_TEST_SHELL", "zsh")
+
+    config = load_final_config(context)
+    assert config.sh_cmd == "zsh"
+    assert load_final_config(context) is config
+    assert context.config is config
+
+    # Compiled config is reused by other processes
+    _compiled_configs.clear()
+    assert load_final_config(context) == config
+
+    monkeypatch.setenv("DOH_TEST_SHELL", "fish")
+    assert load_final_config(context).sh_cmd == "fish"
+
+    conf_path.write_text('sh_cmd = "sh"\nssh_port = 2222')
+    assert load_final_config(context).ssh_port == 2222
+
+
+def test_config_layers(context: Context, test_env: Env, monkeypatch) -> None:
+    test_env.config_path.mkdir(parents=True)
+    (test_env.config_path / "dohrc.toml").write_text(
+        'sh_cmd = "zsh"\nrun_extra_args = ["--gpus=all"]\n'
+        '[hosts.all]\nbind_paths = ["/data:/data"]'
+    )
+    (context.project_dir / "dohrc.toml").write_text(
+        'run_extra_args = ["--init", "--gpus=all"]\nuse_local_config = true\n'
+        f'[hosts.{context.hostname}]\nbind_paths = ["/scratch:/scratch"]'
+    )
+    (context.project_dir / "dohrc.local.toml").write_text("ssh_port = 1")
+    monkeypatch.setenv("DOH_SSH_PORT", "2222")
+
+    resolved = resolve_config(context)
+    config = resolved.config
+
+    assert config.sh_cmd == "zsh"
+    assert config.ssh_port == 2222
+    # Argv lists are concatenated, repeated flags are meaningful there
+    assert config.run_extra_args == ["--gpus=all", "--init", "--gpus=all"]
+    assert config.hosts[context.hostname].bind_paths == [
+        "/data:/data",
+        "/scratch:/scratch",
+    ]
+
+    explained = {p: layer for p, _, layer in explain_config(context, resolved)}
+    assert explained["sh_cmd"] == "user"
+    assert explained["ssh_port"] == "env"
+    assert explained["run_extra_args[1]"] == "project"
+    assert explained["hosts.all.bind_paths[1]"] == f"host:{context.hostname}"
+    assert explained["workdir_from_host"] == "default"
+
+
+def test_lists_kept_as_written(context: Context, monkeypatch) -> None:
+    (context.project_dir / "dohrc.toml").write_text(
+        'run_extra_args = ["--cap-add", "SYS_PTRACE", "--cap-add", "NET_ADMIN"]\n'
+        '[hosts.all]\nbind_paths = ["/a:/a", "/a:/a"]\n'
+        f'[hosts.{context.hostname}]\nbind_paths = ["/a:/a", "/b:/b"]'
+    )
+    monkeypatch.setenv("DOH_RUN_EXTRA_ARGS", '["--cap-add", "SYS_ADMIN"]')
+
+    config = resolve_config(context).config
+    assert config.run_extra_args == [
+        "--cap-add",
+        "SYS_PTRACE",
+        "--cap-add",
+        "NET_ADMIN",
+        "--cap-add",
+        "SYS_ADMIN",
+    ]
+    assert config.hosts["all"].bind_paths == ["/a:/a", "/a:/a", "/b:/b"]
+
+
+def test_env_overrides_host_section(context: Context, monkeypatch) -> None:
+    (context.project_dir / "dohrc.toml").write_text(
+        f'[hosts.{context.hostname}]\nbind_paths = ["/host:/host"]\n'
+        f"[hosts.{context.hostname}.placement]\nmax_nodes = 2"
+    )
+    monkeypatch.setenv("DOH_HOSTS__ALL__PLACEMENT__MAX_NODES", "3")
+    monkeypatch.setenv(
+        f"DOH_HOSTS__{context.hostname}__BIND_PATHS", '["/env:/env"]'
+    )
+
+    resolved = resolve_config(context)
+    host = resolved.config.hosts[context.hostname]
+    assert host.placement is not None and host.placement.max_nodes == 3
+    assert host.bind_paths == ["/host:/host", "/env:/env"]
+    assert resolved.sources["hosts.all.placement.max_nodes"] == "env"
+
+
+def test_env_overrides_mixed_case_host(context: Context, monkeypatch) -> None:
+    context = Context(
+        context.project_name, context.project_dir, hostname="MyHost"
+    )
+    monkeypatch.setenv("DOH_HOSTS__MYHOST__BIND_PATHS", '["/env:/env"]')
+
+    config = resolve_config(context).config
+    assert config.hosts["MyHost"].bind_paths == ["/env:/env"]
+
+
+def test_dict_merge_is_linear() -> None:
+    size = 50_000
+    base = {"bind_paths": [f"/a{i}:/a{i}" for i in range(size)]}
+    update = {"bind_paths": [f"/b{i}:/b{i}" for i in range(size)]}
+
+    started = time.perf_counter()
+    merged = dict_merge(base, update, update)
+    elapsed = time.perf_counter() - started
+
+    assert len(merged["bind_paths"]) == 2 * size
+    assert len(base["bind_paths"]) == size
+    assert elapsed < 1
@@ -0,0 +1,149 @@
+from typing import Iterator, List, Tuple
+
+import json
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+
+import pytest
+from doh.engine import EngineClient, EngineError
+
+CONTAINER_ID = "c0ffee"
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeDockerServer"
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _reply(self, status: int, payload=None) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.server.requests.append(("GET", self.path))
+        if self.path == "/_ping":
+            self._reply(200, "OK")
+        elif self.path == "/images/foo%3Alatest/json":
+            self._reply(200, {"Id": "sha256:foo"})
+        elif self.path.startswith("/containers/json"):
+            self._reply(200, [{"Id": CONTAINER_ID, "Labels": {"a": "b"}}])
+        else:
+            self._reply(404, {"message": "No such object"})
+
+    def do_POST(self) -> None:
+        self.server.requests.append(("POST", self.path))
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if self.path.startswith("/containers/create"):
+            assert json.loads(body)["Image"] == "foo"
+            self._reply(201, {"Id": CONTAINER_ID, "Warnings": []})
+        elif self.path == f"/containers/{CONTAINER_ID}/start":
+            self._reply(204)
+        elif self.path.endswith("/wait"):
+            self._reply(200, {"StatusCode": 3})
+        elif "/attach" in self.path:
+            self.send_response(101)
+            self.send_header(
+                "Content-Type", "application/vnd.docker.raw-stream"
+            )
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Upgrade", "tcp")
+            self.end_headers()
+            for fd, data in [(1, b"out\n"), (2, b"err\n")]:
+                self.wfile.write(struct.pack(">BxxxL", fd, len(data)) + data)
+            self.close_connection = True
+        else:
+            self._reply(404, {"message": "not found"})
+
+    def do_DELETE(self) -> None:
+        self.server.requests.append(("DELETE", self.path))
+        self._reply(204)
+
+
+class FakeDockerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, FakeDockerHandler)
+        self.connections = 0
+        self.requests: List[Tuple[str, str]] = []
+
+
+@pytest.fixture
+def fake_docker(tmp_path: Path) -> Iterator[FakeDockerServer]:
+    server = FakeDockerServer(str(tmp_path / "docker.sock"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_queries_share_connection(fake_docker: FakeDockerServer) -> None:
+    client = EngineClient(fake_docker.server_address)  # type: ignore
+
+    assert client.ping()
+    assert client.inspect_image("foo:latest") == {"Id": "sha256:foo"}
+    assert client.inspect_image("missing") is None
+    containers = client.list_containers(filters={"label": ["a=b"]})
+    assert containers[0]["Id"] == CONTAINER_ID
+
+    assert fake_docker.connections == 1
+    assert "filters=%7B%22label%22%3A+%5B%22a%3Db%22%5D%7D" in (
+        fake_docker.requests[-1][1]
+    )
+
+
+def test_threads_use_own_connections(fake_docker: FakeDockerServer) -> None:
+    client = EngineClient(fake_docker.server_address)  # type: ignore
+    errors: List[BaseException] = []
+
+    def query() -> None:
+        try:
+            for _ in range(50):
+                assert client.inspect_image("foo:latest") is not None
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+
+    assert errors == []
+    assert fake_docker.connections == 4
+
+
+def test_run_container(fake_docker: FakeDockerServer, capfd) -> None:
+    client = EngineClient(fake_docker.server_address)  # type: ignore
+
+    assert client.run_container({"Image": "foo", "Cmd": ["true"]}) == 3
+
+    out, err = capfd.readouterr()
+    assert out == "out\n"
+    assert err == "err\n"
+    assert ("DELETE", f"/containers/{CONTAINER_ID}?force=1&v=1") in (
+        fake_docker.requests
+    )
+
+
+def test_errors(fake_docker: FakeDockerServer) -> None:
+    client = EngineClient(fake_docker.server_address)  # type: ignore
+
+    with pytest.raises(EngineError, match="not found"):
+        client.start_container("missing")
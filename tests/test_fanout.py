@@ -0,0 +1,68 @@
+from typing import List
+
+import subprocess
+from pathlib import Path
+
+from doh import fanout, gc
+from doh.commands.init import init
+from doh.config import Context
+from doh.fingerprint import BuildState, save_build_state
+
+
+def make_project(root: Path, name: str, dockerfile: str) -> Path:
+    path = root / name
+    path.mkdir(parents=True)
+    (path / "Dockerfile").write_text(dockerfile)
+    # Configs differ by ssh port, they aren't a part of the image
+    (path / ".dockerignore").write_text("dohrc*")
+    init(Context.create_for_path(path))
+    return path
+
+
+def test_fan_out(tmp_path: Path, monkeypatch) -> None:
+    root = tmp_path / "repos"
+    make_project(root, "a", "FROM python")
+    make_project(root, "b", "FROM python")
+    make_project(root, "c", "FROM rust")
+    (root / "not-a-project").mkdir()
+    monkeypatch.chdir(root)
+
+    built: List[str] = []
+    adopted: List[str] = []
+
+    def fake_build(config, context, force=False):
+        built.append(context.project_dir.name)
+        fingerprint = fanout.build_fingerprint(config, context)
+        save_build_state(context, BuildState(fingerprint=fingerprint))
+
+    run_dirs: List[str] = []
+
+    def fake_run(argv, check=False, cwd=None):
+        run_dirs.append(cwd.name)
+        returncode = 1 if "/c:" in " ".join(argv) else 0
+        return subprocess.CompletedProcess(argv, returncode)
+
+    monkeypatch.setattr(fanout, "build_image", fake_build)
+    monkeypatch.setattr(
+        fanout,
+        "adopt_image",
+        lambda context, *args, **kwargs: adopted.append(
+            context.project_dir.name
+        ),
+    )
+    monkeypatch.setattr(fanout, "run_command", fake_run)
+
+    results = fanout.fan_out("*", ["pytest"], jobs=2)
+
+    assert [r.context.project_dir.name for r in results] == ["a", "b", "c"]
+    assert sorted(built + adopted) == ["a", "b", "c"]
+    assert len(adopted) == 1
+    assert [r.ok for r in results] == [True, True, False]
+    assert sorted(run_dirs) == ["a", "b", "c"]
+    # Launches are prepared like single project ones
+    assert all(gc.usage_path(r.context.image_name).exists() for r in results)
+
+    summary = fanout.format_summary(results, root).splitlines()
+    assert summary[0].split() == ["PROJECT", "BUILD", "RUN", "STATUS"]
+    assert summary[3].endswith("exit 1")
+    assert summary[-1] == "2 succeeded, 1 failed"
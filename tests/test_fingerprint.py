@@ -0,0 +1,223 @@
+from typing import List
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from doh import docker
+from doh.config import Config, Context
+from doh.fingerprint import (
+    BuildState,
+    build_context_dir,
+    build_lock_path,
+    compute_fingerprint,
+    dockerfile_path,
+    save_build_state,
+    shared_build_lock_path,
+)
+from doh.ignore import IgnoreRules
+from doh.utils import file_lock
+
+
+def test_dockerignore_rules() -> None:
+    rules = IgnoreRules(["# comment", "data", "*.log", "!keep.log", "**/tmp"])
+
+    assert rules.is_ignored("data")
+    assert rules.is_ignored("data/big.bin")
+    assert rules.is_ignored("debug.log")
+    assert not rules.is_ignored("keep.log")
+    assert not rules.is_ignored("src/debug.log")
+    assert rules.is_ignored("src/deep/tmp/x")
+    assert not rules.is_ignored("src/main.py")
+
+
+def test_gitignore_rules() -> None:
+    rules = IgnoreRules(["*.pyc", "build/", "/top"], gitignore=True)
+
+    assert rules.is_ignored("a/b/c.pyc")
+    assert rules.is_ignored("pkg/build", is_dir=True)
+    assert rules.is_ignored("pkg/build/out.o")
+    assert not rules.is_ignored("pkg/build")
+    assert rules.is_ignored("top")
+    assert not rules.is_ignored("a/top")
+
+
+def test_fingerprint_follows_context(context: Context) -> None:
+    root = context.project_dir
+    (root / "Dockerfile").write_text("FROM scratch")
+    (root / ".dockerignore").write_text("data\n")
+    (root / "data").mkdir()
+    (root / "main.py").write_text("print(1)")
+
+    state = BuildState()
+    cmd = "docker build . -t foo"
+    fp = compute_fingerprint(context, cmd, cmd.split(), state)
+    assert set(state.files) == {".dockerignore", "Dockerfile", "main.py"}
+
+    (root / "data" / "big.bin").write_bytes(b"0" * 1024)
+    assert compute_fingerprint(context, cmd, cmd.split(), state) == fp
+
+    (root / "main.py").write_text("print(2)")
+    assert compute_fingerprint(context, cmd, cmd.split(), state) != fp
+
+    other_cmd = "docker build . -t bar"
+    assert compute_fingerprint(context, other_cmd, other_cmd.split()) != fp
+
+
+def test_fingerprint_of_parent_context(tmp_path: Path) -> None:
+    parent = tmp_path / "repo"
+    context = Context.create_for_path(parent / "project")
+    (context.project_dir / "docker").mkdir(parents=True)
+    (context.project_dir / "docker" / "Dockerfile").write_text("FROM scratch")
+    (parent / ".dockerignore").write_text("ignored\n")
+    (parent / "ignored").mkdir()
+    (parent / "lib.py").write_text("print(1)")
+    cmd = "docker build --pull --build-arg A=1 .. -f docker/Dockerfile"
+
+    state = BuildState()
+    fp = compute_fingerprint(context, cmd, cmd.split(), state)
+    assert "lib.py" in state.files
+    assert "project/docker/Dockerfile" in state.files
+
+    (parent / "ignored" / "big.bin").write_bytes(b"0" * 1024)
+    assert compute_fingerprint(context, cmd, cmd.split(), state) == fp
+    (parent / "lib.py").write_text("print(2)")
+    assert compute_fingerprint(context, cmd, cmd.split(), state) != fp
+
+
+def test_build_context_dir(tmp_path: Path) -> None:
+    def context_dir(cmd: str) -> Path:
+        return build_context_dir(tmp_path, cmd.split())
+
+    assert context_dir("docker build . -t {image_name}") == tmp_path
+    assert (
+        context_dir("docker build -t x -f d/Dockerfile ctx") == tmp_path / "ctx"
+    )
+    assert (
+        context_dir("docker buildx build --load --tag=x ..") == tmp_path / ".."
+    )
+    assert context_dir("docker build https://host/repo.git") == tmp_path
+    assert context_dir("docker build - < Dockerfile") == tmp_path
+    assert context_dir("docker build - -t x") == tmp_path
+    assert context_dir("make image") == tmp_path
+    assert dockerfile_path(tmp_path, "docker build ctx".split()) == (
+        tmp_path / "ctx" / "Dockerfile"
+    )
+
+
+def test_with_build_label() -> None:
+    assert docker.with_build_label(["docker", "build", "."], "k", "v") == [
+        "docker",
+        "build",
+        "--label",
+        "k=v",
+        ".",
+    ]
+    assert docker.with_build_label(["make", "build"], "k", "v") == [
+        "make",
+        "build",
+    ]
+
+
+def test_build_skipped_when_fingerprint_matches(context, monkeypatch) -> None:
+    (context.project_dir / "Dockerfile").write_text("FROM scratch")
+    # Test HOME (and so doh cache) is inside of the project dir
+    (context.project_dir / ".dockerignore").write_text(".cache")
+    builds: List[List[str]] = []
+    labels = {}
+
+    def fake_run(argv, check=False, cwd=None):
+        builds.append(argv)
+        labels.update([argv[argv.index("--label") + 1].split("=")])
+
+    monkeypatch.setattr(docker.subprocess, "run", fake_run)
+    monkeypatch.setattr(
+        docker,
+        "inspect_image",
+        lambda name: {"Id": "sha256:1", "Config": {"Labels": labels}},
+    )
+    config = Config()
+
+    docker.build_image(config, context)
+    docker.build_image(config, context)
+    assert len(builds) == 1
+
+    docker.build_image(config, context, force=True)
+    assert len(builds) == 2
+
+    (context.project_dir / "Dockerfile").write_text("FROM alpine")
+    docker.build_image(config, context)
+    assert len(builds) == 3
+
+
+def test_shared_image_serves_other_users(context, monkeypatch) -> None:
+    (context.project_dir / "Dockerfile").write_text("FROM scratch")
+    (context.project_dir / ".dockerignore").write_text(".cache")
+    images = {}
+    builds: List[List[str]] = []
+
+    def fake_run(argv, check=False, cwd=None):
+        builds.append(argv)
+        images[argv[argv.index("-t") + 1]] = {"Id": "sha256:1"}
+
+    monkeypatch.setattr(docker.subprocess, "run", fake_run)
+    monkeypatch.setattr(docker, "inspect_image", images.get)
+    monkeypatch.setattr(
+        docker,
+        "tag_image",
+        lambda source, target: images.update({target: images[source]}),
+    )
+    config = Config(shared_images=True)
+    other = Context(context.project_name, context.project_dir, username="bob")
+
+    docker.build_image(config, context)
+    docker.build_image(config, other)
+    assert len(builds) == 1
+    shared = builds[0][builds[0].index("-t") + 1]
+    assert shared.startswith(f"{docker.SHARED_IMAGE_REPO}:")
+    assert images[f"{context.image_name}:latest"] == images[shared]
+    assert images[f"{other.image_name}:latest"] == images[shared]
+    # Builds of the shared image are serialized across users
+    fingerprint = shared.split(":")[-1]
+    lock = shared_build_lock_path(fingerprint)
+    assert lock.stat().st_mode & 0o777 == 0o666
+    assert not build_lock_path(context).exists()
+
+
+def test_waiter_reuses_concurrent_build(context, monkeypatch) -> None:
+    (context.project_dir / "Dockerfile").write_text("FROM scratch")
+    (context.project_dir / ".dockerignore").write_text(".cache")
+    builds: List[List[str]] = []
+    monkeypatch.setattr(
+        docker.subprocess, "run", lambda argv, **kwargs: builds.append(argv)
+    )
+    monkeypatch.setattr(docker, "inspect_image", lambda name: {"Id": "1"})
+    config = Config()
+    fingerprint = docker.build_fingerprint(config, context)
+    real_lock = docker.file_lock
+
+    @contextmanager
+    def lock_after_other_build(path, timeout=None):
+        # Another process finishes the build while we wait for the lock
+        save_build_state(
+            context, BuildState(fingerprint=fingerprint, image_id="1")
+        )
+        with real_lock(path, timeout) as locked:
+            yield locked
+
+    monkeypatch.setattr(docker, "file_lock", lock_after_other_build)
+    docker.build_image(config, context)
+    assert builds == []
+
+
+def test_stale_build_lock_is_ignored(context, monkeypatch) -> None:
+    (context.project_dir / "Dockerfile").write_text("FROM scratch")
+    (context.project_dir / ".dockerignore").write_text(".cache")
+    builds: List[List[str]] = []
+    monkeypatch.setattr(
+        docker.subprocess, "run", lambda argv, **kwargs: builds.append(argv)
+    )
+    monkeypatch.setattr(docker, "inspect_image", lambda name: {"Id": "1"})
+
+    with file_lock(build_lock_path(context)):
+        docker.build_image(Config(build_lock_timeout=0), context)
+    assert len(builds) == 1
@@ -0,0 +1,75 @@
+from typing import Any, Dict, List
+
+import os
+
+import pytest
+from doh import gc
+from doh.fingerprint import FINGERPRINT_LABEL
+
+MB = 1 << 20
+
+
+def _image(id: str, tags: List[str], size: int, doh: bool = True):
+    labels = {FINGERPRINT_LABEL: "f"} if doh else {}
+    return {"Id": id, "RepoTags": tags, "Size": size * MB, "Labels": labels}
+
+
+@pytest.fixture()
+def docker(monkeypatch) -> Dict[str, Any]:
+    state: Dict[str, Any] = {
+        "images": [
+            _image("dangling", [], 100),
+            _image("foreign", [], 500, doh=False),
+            _image("old", ["old-u:latest"], 300),
+            _image("used", ["used-u:latest"], 300),
+            _image("recent", ["recent-u:latest"], 300),
+            _image("other", ["postgres:15"], 1000, doh=False),
+        ],
+        "containers": [{"ImageID": "used"}],
+        "removed": [],
+    }
+
+    def list_images(filters=None):
+        if filters:
+            return [
+                i
+                for i in state["images"]
+                if not i["RepoTags"]
+                and all(label in i["Labels"] for label in filters["label"])
+            ]
+        return state["images"]
+
+    monkeypatch.setattr(gc, "list_images", list_images)
+    monkeypatch.setattr(
+        gc, "list_containers", lambda include_stopped: state["containers"]
+    )
+    monkeypatch.setattr(
+        gc, "remove_image", lambda name: state["removed"].append(name) or True
+    )
+    for i, name in enumerate(["old-u", "used-u", "recent-u"]):
+        gc.usage_path(name).parent.mkdir(parents=True, exist_ok=True)
+        gc.usage_path(name).touch()
+        os.utime(gc.usage_path(name), (i, i))
+    return state
+
+
+def test_lru_eviction(docker: Dict[str, Any]) -> None:
+    result = gc.collect_garbage(600 * MB)
+
+    assert docker["removed"] == ["dangling", "old-u:latest"]
+    assert result.total == 1000 * MB
+    assert result.freed == 400 * MB
+    assert not gc.usage_path("old-u").exists()
+
+
+def test_running_and_kept_images_stay(docker: Dict[str, Any]) -> None:
+    result = gc.collect_garbage(0, keep="recent-u:latest")
+    assert docker["removed"] == ["dangling", "old-u:latest"]
+    assert result.removed == docker["removed"]
+
+
+def test_dry_run(docker: Dict[str, Any]) -> None:
+    result = gc.collect_garbage(0, dry_run=True)
+    assert docker["removed"] == []
+    assert result.removed == ["dangling", "old-u:latest", "recent-u:latest"]
+    assert gc.usage_path("old-u").exists()
@@ -0,0 +1,51 @@
+from typing import Dict
+
+import subprocess
+import sys
+
+# Cumulative import time of the CLI module, doh itself should add only a few
+# ms on top of typer/click
+IMPORT_TIME_BUDGET_US = 150_000
+# Failed `import rich` attempts are listed by -X importtime too, so check for
+# its submodule instead
+HEAVY_MODULES = {"rich.console", "pydantic", "envtoml", "toml", "doh.config"}
+
+
+def import_times(statement: str) -> Dict[str, int]:
+    """Cumulative import time in us by module, as reported by -X importtime"""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_budget() -> None:
+    import_times("import doh.__main__")  # warm up bytecode cache
+    runs = [import_times("import doh.__main__") for _ in range(3)]
+
+    assert not HEAVY_MODULES & set(runs[0])
+    assert min(r["doh.__main__"] for r in runs) < IMPORT_TIME_BUDGET_US
+
+
+def test_kernel_run_imports_no_rich() -> None:
+    times = import_times("import doh.__main__, doh.commands.kernel.run")
+
+    assert "rich.console" not in times
+
+
+def test_help() -> None:
+    res = subprocess.run(
+        [sys.executable, "-m", "doh", "--help"], capture_output=True, text=True
+    )
+
+    assert res.returncode == 0
+    assert "kernel-run" in res.stdout
@@ -0,0 +1,66 @@
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from doh.pipeline import Step, command_step, run_steps
+
+
+def test_dependencies_and_concurrency() -> None:
+    both_started = threading.Barrier(2, timeout=5)
+    order = []
+
+    def independent(name):
+        def fn():
+            both_started.wait()
+            order.append(name)
+            return name
+
+        return fn
+
+    results = run_steps(
+        [
+            Step("last", lambda: order.append("last"), ["a", "b"]),
+            Step("a", independent("a")),
+            Step("b", independent("b")),
+        ]
+    )
+
+    assert results["a"] == "a"
+    assert order[-1] == "last"
+
+
+def test_failure_cancels_running_commands() -> None:
+    started = time.monotonic()
+
+    def fail():
+        time.sleep(0.2)
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        run_steps(
+            [
+                Step("fail", fail),
+                command_step("slow", "sleep 30"),
+                Step("never", lambda: pytest.fail("started"), ["slow"]),
+            ]
+        )
+    assert time.monotonic() - started < 10
+
+
+def test_output_prefixed(capfd) -> None:
+    code = "import sys; print('out'); print('err', file=sys.stderr)"
+    run_steps([command_step("hook", [sys.executable, "-c", code])])
+
+    out, err = capfd.readouterr()
+    assert out == "[hook] out\n"
+    assert err == "[hook] err\n"
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_steps([command_step("hook", "false")])
+
+
+def test_unknown_dependency() -> None:
+    with pytest.raises(ValueError):
+        run_steps([Step("a", lambda: None, ["b"])])
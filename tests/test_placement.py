@@ -0,0 +1,83 @@
+from typing import Dict, List
+
+from pathlib import Path
+
+import pytest
+from doh import placement
+from doh.config import Config, Context, Parameters, PlacementParameters
+
+
+@pytest.fixture()
+def sysfs(tmp_path: Path) -> Path:
+    root = tmp_path / "node"
+    for node, cpus in [(0, "0-3"), (1, "4-7"), (2, "")]:
+        (root / f"node{node}").mkdir(parents=True)
+        (root / f"node{node}" / "cpulist").write_text(f"{cpus}\n")
+    (root / "possible").write_text("0-2\n")
+    return root
+
+
+@pytest.fixture()
+def containers(monkeypatch) -> List[str]:
+    cpusets: List[str] = []
+    monkeypatch.setattr(
+        placement,
+        "list_containers",
+        lambda filters: [
+            {"Labels": {placement.CPUS_LABEL: c}} for c in cpusets
+        ],
+    )
+    return cpusets
+
+
+def test_cpu_list_format() -> None:
+    assert placement.parse_cpu_list("0-2,5,8-9\n") == [0, 1, 2, 5, 8, 9]
+    assert placement.parse_cpu_list("") == []
+    assert placement.format_cpu_list([9, 0, 1, 2, 5, 8]) == "0-2,5,8-9"
+
+
+def test_read_topology(sysfs: Path, tmp_path: Path) -> None:
+    nodes = placement.read_topology(sysfs)
+    # Memory-only node2 is skipped
+    assert [(n.id, n.cpus) for n in nodes] == [
+        (0, [0, 1, 2, 3]),
+        (1, [4, 5, 6, 7]),
+    ]
+    assert placement.read_topology(tmp_path / "missing") == []
+
+
+def test_least_loaded_node(sysfs: Path, containers: List[str]) -> None:
+    nodes = placement.read_topology(sysfs)
+    params = PlacementParameters()
+    containers += ["0-3"]
+    assert placement.place(nodes, placement.cpu_usage(), params) == (
+        placement.Placement(cpus=[4, 5, 6, 7], mems=[1])
+    )
+
+    usage: Dict[int, int] = {4: 1, 5: 1, 0: 1}
+    capped = placement.place(nodes, usage, PlacementParameters(max_cpus=2))
+    assert capped == placement.Placement(cpus=[1, 2], mems=[0])
+
+    both = placement.place(nodes, {}, PlacementParameters(max_nodes=2))
+    assert both is not None and both.mems == [0, 1]
+
+
+def test_placement_args(
+    context: Context, sysfs: Path, containers: List[str]
+) -> None:
+    host = Parameters(placement=PlacementParameters(max_cpus=2))
+    context.config = Config(hosts={context.hostname: host})
+    containers += ["0-1"]
+
+    args = placement.placement_args(context, sysfs)
+    assert args == [
+        "--cpuset-cpus",
+        "4-5",
+        "--cpuset-mems",
+        "1",
+        "--label",
+        f"{placement.CPUS_LABEL}=4-5",
+    ]
+
+    context.config = Config()
+    assert placement.placement_args(context, sysfs) == []
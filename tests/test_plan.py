@@ -0,0 +1,81 @@
+import json
+
+from doh import plan
+from doh.config import Context
+
+
+def test_run_args_cached(context: Context, monkeypatch) -> None:
+    calls = []
+    resolve = plan.docker_run_args_from_project
+
+    def counting_resolve(context, request_tty=True):
+        calls.append(request_tty)
+        return resolve(context, request_tty)
+
+    monkeypatch.setattr(plan, "docker_run_args_from_project", counting_resolve)
+    bind_source = context.project_dir / "data"
+    bind_source.mkdir()
+    context.config.hosts[context.hostname].bind_paths = [f"{bind_source}:/data"]
+
+    args = plan.resolve_run_args(context)
+    assert plan.resolve_run_args(context) == args
+    assert len(calls) == 1
+
+    plan.resolve_run_args(context, request_tty=False)
+    assert len(calls) == 2
+
+    bind_source.rmdir()
+    bind_source.write_text("now a file")
+    plan.resolve_run_args(context)
+    assert len(calls) == 3
+
+    context.config.environment["FOO"] = "BAR"
+    assert "FOO=BAR" in plan.resolve_run_args(context)
+    assert len(calls) == 4
+
+
+def test_launch_plan_json(context: Context) -> None:
+    context.config.before_command = "echo hi"
+    launch = plan.launch_plan(context, "python -c 'print(1)'", False)
+
+    dumped = json.loads(launch.json_with_argv())
+    assert dumped["cmd"] == ["python", "-c", "print(1)"]
+    assert dumped["before_command"] == "echo hi"
+    assert dumped["argv"][:2] == ["docker", "run"]
+    assert dumped["argv"][-4] == context.image_name
+
+
+def test_prepare_launch(context: Context, monkeypatch) -> None:
+    marker = context.project_dir / "hook-ran"
+    built = []
+
+    def fake_build(config, context, force=False):
+        # Image is built before the hook unless the hook opts out
+        built.append(marker.exists())
+
+    monkeypatch.setattr(plan, "build_image", fake_build)
+    context.config.before_command = f"touch {marker}"
+
+    run_args = plan.prepare_launch(context, build=True, request_tty=False)
+    assert built == [False]
+    assert "--tty" not in run_args
+
+    marker.unlink()
+    context.config.before_command_needs_image = False
+    plan.prepare_launch(context, build=False)
+    assert marker.exists()
+    assert len(built) == 1
+
+
+def test_paths_relative_to_project(
+    context: Context, tmp_path, monkeypatch
+) -> None:
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+    (context.project_dir / "data").mkdir()
+    context.config.hosts[context.hostname].bind_paths = ["data:/data"]
+
+    args = plan.resolve_run_args(context)
+    assert f"{context.project_dir / 'data'}:/data" in args
+    assert f"{context.project_dir / '.doh' / 'home'}:{tmp_path}" in args
@@ -0,0 +1,89 @@
+import random
+import socket
+import subprocess
+
+import pytest
+from doh import ports
+from doh.config import Context
+
+
+@pytest.fixture(autouse=True)
+def no_containers(monkeypatch) -> None:
+    monkeypatch.setattr(ports, "container_ports", lambda: set())
+
+
+def _listen() -> socket.socket:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    return sock
+
+
+def test_is_port_free() -> None:
+    with _listen() as sock:
+        port = sock.getsockname()[1]
+        assert not ports.is_port_free(port)
+    assert ports.is_port_free(port)
+
+
+def test_lease_fails_fast(context: Context, tmp_path) -> None:
+    other = Context.create_for_path(tmp_path / "other")
+    port = ports.allocate_port(context, random.Random(0))
+
+    with ports.lease_port(context, port):
+        with pytest.raises(ports.PortUnavailableError, match="doh ssh"):
+            with ports.lease_port(other, port):
+                pass
+        assert ports.allocate_port(other, random.Random(0)) != port
+    assert ports.load_registry().leases == {}
+
+    with _listen() as sock:
+        busy = sock.getsockname()[1]
+        with pytest.raises(ports.PortUnavailableError, match="already used"):
+            with ports.lease_port(context, busy):
+                pass
+
+
+def test_stale_lease_released(context: Context, monkeypatch) -> None:
+    port = ports.allocate_port(context)
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    registry = ports.Registry(
+        leases={
+            port: ports.Lease(
+                project="/gone", user="someone", pid=dead.pid, since=0
+            )
+        }
+    )
+    ports.registry_path().parent.mkdir(parents=True, exist_ok=True)
+    ports.save_registry(registry)
+
+    # Container of the dead process is still running
+    monkeypatch.setattr(ports, "container_ports", lambda: {port})
+    with pytest.raises(ports.PortUnavailableError):
+        with ports.lease_port(context, port):
+            pass
+
+    monkeypatch.setattr(ports, "container_ports", lambda: set())
+    with ports.lease_port(context, port):
+        assert ports.load_registry().leases[port].project == str(
+            context.project_dir
+        )
+
+
+def test_init_assigns_port(context: Context, tmp_path) -> None:
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    other = Context.create_for_path(other_dir)
+
+    port = ports.allocate_port(context, random.Random(0))
+    assert ports.allocate_port(context, random.Random(1)) == port
+    assert ports.allocate_port(other, random.Random(0)) != port
+    with pytest.raises(ports.PortUnavailableError, match="assigned to"):
+        with ports.lease_port(other, port):
+            pass
+
+    other_dir.rmdir()
+    with ports.lease_port(context, port):
+        pass
+    assert ports.load_registry().assignments == {port: str(context.project_dir)}
@@ -0,0 +1,55 @@
+from typing import List
+
+import time
+
+import pytest
+from doh import plan, prebuilt
+from doh.config import Context
+
+DIGEST = "team/base@sha256:" + "a" * 64
+
+
+@pytest.fixture()
+def pulls(monkeypatch) -> List[str]:
+    pulled: List[str] = []
+    monkeypatch.setattr(prebuilt, "pull_image", pulled.append)
+    monkeypatch.setattr(
+        prebuilt,
+        "inspect_image",
+        lambda name: {"Id": "sha256:b", "RepoDigests": [DIGEST]},
+    )
+    return pulled
+
+
+def test_digest_pinned_with_ttl(context: Context, pulls: List[str]) -> None:
+    context.config.image = "team/base:1.2"
+
+    assert prebuilt.launch_image(context) == DIGEST
+    assert prebuilt.launch_image(context) == DIGEST
+    assert pulls == ["team/base:1.2"]
+
+    prebuilt.pinned_image(context.config, refresh=True)
+    assert len(pulls) == 2
+
+    pin = prebuilt.load_pin("team/base:1.2")
+    pin.resolved_at = time.time() - context.config.image_ttl - 1
+    prebuilt.save_pin(pin)
+    prebuilt.launch_image(context)
+    assert len(pulls) == 3
+
+
+def test_digest_reference_used_as_is(context: Context, pulls) -> None:
+    context.config.image = DIGEST
+    assert prebuilt.launch_image(context) == DIGEST
+    assert pulls == []
+
+
+def test_no_build_step(context: Context, pulls, monkeypatch) -> None:
+    def fail_build(*args, **kwargs):
+        raise AssertionError("prebuilt image must not be built")
+
+    monkeypatch.setattr(plan, "build_image", fail_build)
+    context.config.image = "team/base:1.2"
+
+    plan.prepare_launch(context, build=True, request_tty=False)
+    assert plan.launch_plan(context, ["true"]).image == DIGEST
@@ -0,0 +1,49 @@
+import os
+from pathlib import Path
+
+from doh.config import Context, FakeHomeParameters
+from doh.docker import prepare_home_args
+from doh.snapshot import sync_snapshot
+
+
+def test_incremental_sync(tmp_path: Path) -> None:
+    home = tmp_path / "real"
+    fake = tmp_path / "fake"
+    (home / ".config/tool").mkdir(parents=True)
+    (home / ".gitconfig").write_text("[user]")
+    (home / ".config/tool/a.toml").write_text("a = 1")
+    (home / ".config/tool/link").symlink_to("a.toml")
+    paths = [".gitconfig", ".config/tool", ".missing"]
+
+    stats = sync_snapshot(home, fake, paths)
+    assert (stats.copied, stats.missing) == (3, [".missing"])
+    assert (fake / ".config/tool/a.toml").read_text() == "a = 1"
+    assert os.readlink(fake / ".config/tool/link") == "a.toml"
+
+    stats = sync_snapshot(home, fake, paths)
+    assert (stats.copied, stats.unchanged) == (0, 3)
+
+    # Touched, but not changed
+    os.utime(home / ".gitconfig", ns=(1, 1))
+    assert sync_snapshot(home, fake, paths).copied == 0
+
+    (home / ".gitconfig").write_text("[core]")
+    (home / ".config/tool/a.toml").unlink()
+    stats = sync_snapshot(home, fake, paths)
+    assert (stats.copied, stats.removed) == (1, 1)
+    assert (fake / ".gitconfig").read_text() == "[core]"
+    assert not (fake / ".config/tool/a.toml").exists()
+
+
+def test_snapshot_single_mount(context: Context, monkeypatch) -> None:
+    monkeypatch.chdir(context.project_dir)
+    (Path.home() / ".bashrc").write_text("export A=1")
+    context.config.fake_home = FakeHomeParameters(
+        real_paths=[".bashrc", ".netrc"], mode="snapshot"
+    )
+
+    args = prepare_home_args(context.config, context)
+
+    assert args.count("--volume") == 1
+    fake_home = context.config.fake_home.root.resolve()
+    assert (fake_home / ".bashrc").read_text() == "export A=1"
@@ -0,0 +1,71 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from doh import docker, trace
+from doh.supervisor import supervise
+
+
+def test_after_command_and_exit_code(tmp_path: Path) -> None:
+    marker = tmp_path / "after"
+    assert supervise(["sh", "-c", "exit 3"], f"touch {marker}") == 3
+    assert marker.exists()
+
+    assert supervise(["true"], "false") == 1
+
+
+def test_signal_forwarded(tmp_path: Path) -> None:
+    ready = tmp_path / "ready"
+    child = f"trap 'exit 7' TERM; touch {ready}; while :; do sleep 0.05; done"
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-S",
+            docker.SUPERVISOR_PATH,
+            f"touch {tmp_path / 'after'}",
+            "sh",
+            "-c",
+            child,
+        ]
+    )
+    deadline = time.monotonic() + 10
+    while not ready.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait(timeout=10) == 7
+    assert (tmp_path / "after").exists()
+
+
+def test_handoff(monkeypatch) -> None:
+    calls = []
+
+    def fake_exec(path, argv):
+        calls.append(argv)
+        raise SystemExit()
+
+    monkeypatch.setattr(os, "execvp", fake_exec)
+    monkeypatch.setattr(os, "execv", fake_exec)
+    trace.start("exec")
+
+    with pytest.raises(SystemExit):
+        docker.handoff_docker_run(["--rm"], "img", "python -c 'print(1)'")
+    assert calls[-1] == [
+        "docker",
+        "run",
+        "--rm",
+        "img",
+        "python",
+        "-c",
+        "print(1)",
+    ]
+    assert trace.current() is None
+    assert trace.load_history(trace.history_path())[-1]["command"] == "exec"
+
+    with pytest.raises(SystemExit):
+        docker.handoff_docker_run(["--rm"], "img", ["true"], "echo done")
+    assert calls[-1][2:5] == [docker.SUPERVISOR_PATH, "echo done", "docker"]
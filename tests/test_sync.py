@@ -0,0 +1,87 @@
+import os
+import random
+from pathlib import Path
+
+from doh.config import Context, SyncParameters
+from doh.docker import volume_args
+from doh.sync import LocalTransport, manifest_path, roll, sync_tree
+from doh.sync_agent import weak_checksum
+
+
+def _sync(src: Path, dst: Path, full: bool = False):
+    return sync_tree(
+        src, LocalTransport(dst), manifest_path(src, str(dst)), full
+    )
+
+
+def _tree(root: Path):
+    return {
+        str(p.relative_to(root)): p.read_bytes()
+        for p in root.rglob("*")
+        if p.is_file()
+    }
+
+
+def _random_bytes(size: int) -> bytes:
+    return random.Random(0).getrandbits(size * 8).to_bytes(size, "little")
+
+
+def test_roll() -> None:
+    data = _random_bytes(100)
+    checksum = weak_checksum(data[:16])
+    for i in range(1, 80):
+        checksum = roll(checksum, data[i - 1], data[i + 15], 16)
+        assert checksum == weak_checksum(data[i : i + 16])
+
+
+def test_sync_tree(tmp_path: Path) -> None:
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg/a.py").write_text("print(1)")
+    (src / "pkg/link.py").symlink_to("a.py")
+    (src / "notes.log").write_text("log")
+    (src / ".gitignore").write_text("*.log\n")
+
+    stats = _sync(src, dst)
+    assert stats.files == 3
+    assert os.readlink(dst / "pkg/link.py") == "a.py"
+    assert not (dst / "notes.log").exists()
+    expected = _tree(src)
+    del expected["notes.log"]
+    assert _tree(dst) == expected
+
+    assert _sync(src, dst).files == 0
+
+    (src / "pkg/a.py").unlink()
+    (src / "pkg/b.py").write_text("print(2)")
+    stats = _sync(src, dst)
+    assert (stats.files, stats.removed) == (1, 1)
+    assert not (dst / "pkg/a.py").exists()
+    assert (dst / "pkg/b.py").read_text() == "print(2)"
+
+
+def test_delta_sends_only_changes(tmp_path: Path) -> None:
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    data = _random_bytes(1 << 20)
+    (src / "data.bin").write_bytes(data)
+    assert _sync(src, dst).literal_bytes == len(data)
+
+    # Insertion shifts everything after it
+    changed = data[:1000] + b"inserted" + data[1000:] + b"appended"
+    (src / "data.bin").write_bytes(changed)
+    stats = _sync(src, dst)
+    assert (dst / "data.bin").read_bytes() == changed
+    assert stats.literal_bytes < 3 * 4096
+
+    # Manifest is ignored, content is already there
+    assert _sync(src, dst, full=True).literal_bytes == 0
+    assert (dst / "data.bin").read_bytes() == changed
+
+
+def test_sync_target_mounted(context: Context) -> None:
+    context.config.sync = SyncParameters(target="ssh://user@builder/srv/p")
+    args = volume_args(context.config, context)
+    assert f"/srv/p:{context.project_dir}" in args
@@ -0,0 +1,71 @@
+import json
+import threading
+from pathlib import Path
+
+from doh import trace
+from doh.__main__ import app
+from doh.env import Env
+from typer.testing import CliRunner
+
+
+def test_spans_and_history(tmp_path: Path) -> None:
+    trace.start("exec")
+    trace.annotate(project="/p")
+    with trace.span("build_image"):
+        pass
+
+    worker = threading.Thread(target=trace.traced("agent")(lambda: None))
+    worker.start()
+    worker.join()
+    trace.mark_launched()
+    trace.finish("ok", tmp_path / "trace.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [e["name"] for e in events] == [
+        "exec",
+        "build_image",
+        "agent",
+        "launch",
+    ]
+    assert events[1]["tid"] != events[2]["tid"]
+    assert trace.current() is None
+
+    (entry,) = trace.load_history(trace.history_path())
+    assert entry["command"] == "exec"
+    assert entry["project"] == "/p"
+    assert entry["launch_ms"] > 0
+    assert set(entry["phases"]) == {"build_image", "agent"}
+
+    # Spans outside of a traced command are no-ops
+    with trace.span("config"):
+        pass
+
+
+def test_launch_stats() -> None:
+    entries = [
+        {"command": "exec", "project": "a", "launch_ms": float(ms)}
+        for ms in range(1, 101)
+    ]
+    entries.append({"command": "plan", "project": "a", "launch_ms": None})
+
+    (row,) = trace.launch_stats(entries)
+    assert row["runs"] == 100
+    assert row["p50_ms"] == 50
+    assert row["p95_ms"] == 95
+
+
+def test_trace_option(context, tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.chdir(context.project_dir)
+    out = tmp_path / "out.json"
+
+    res = CliRunner().invoke(app, ["--trace", str(out), "plan", "ls"])
+    assert res.exit_code == 0, res.output
+
+    names = {e["name"] for e in json.loads(out.read_text())["traceEvents"]}
+    assert {"plan", "config", "run_args"} <= names
+    history = Env.get().cache_path / "trace" / trace.HISTORY_FILE_NAME
+    assert trace.load_history(history)[-1]["command"] == "plan"
+
+    res = CliRunner().invoke(app, ["stats"])
+    assert res.exit_code == 0
+    assert "No launches recorded yet" in res.output
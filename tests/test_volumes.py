@@ -0,0 +1,127 @@
+from typing import Any, Dict, List
+
+import os
+from pathlib import Path
+
+import pytest
+from click.exceptions import Exit
+from doh import volumes
+from doh.config import CacheVolumeParameters, Context
+from doh.docker import (
+    CACHE_LABEL,
+    CACHE_SCOPE_LABEL,
+    docker_run_args_from_project,
+)
+
+
+def test_run_args(context: Context, monkeypatch) -> None:
+    monkeypatch.chdir(context.project_dir)
+    config = context.config
+    config.cache_volumes = {
+        "pip": CacheVolumeParameters(),
+        "models": CacheVolumeParameters(path="/models", scope="shared"),
+    }
+    config.tmpfs = {"/tmp": "1g"}
+
+    args = docker_run_args_from_project(context)
+    mounts = [args[i + 1] for i, a in enumerate(args) if a == "--mount"]
+
+    assert mounts[0].startswith("type=volume,source=doh-cache-models,")
+    owner = context.image_name
+    assert mounts[1].startswith(
+        f"type=volume,source=doh-cache-{owner}-pip,"
+        f"target={Path.home()}/.cache/pip,"
+    )
+    assert f"volume-label={CACHE_SCOPE_LABEL}=project" in mounts[1]
+    assert mounts[2] == (
+        f"type=tmpfs,destination=/tmp,tmpfs-size={1 << 30},tmpfs-mode=1777"
+    )
+
+    config.cache_volumes = {"unknown": CacheVolumeParameters()}
+    with pytest.raises(Exit):
+        docker_run_args_from_project(context)
+
+
+def test_volume_prepared_once(context: Context, monkeypatch) -> None:
+    commands: List[List[str]] = []
+    existing: Dict[str, Dict[str, Any]] = {}
+
+    def fake_run(argv, check):
+        commands.append(argv)
+        volume = argv[argv.index("--mount") + 1].split(",")[1].split("=")[1]
+        existing.setdefault(volume, {"CreatedAt": str(len(commands))})
+
+    monkeypatch.setattr(volumes, "run_command", fake_run)
+    monkeypatch.setattr(volumes, "inspect_volume", existing.get)
+    monkeypatch.setattr(volumes, "engine_client", lambda: None)
+    monkeypatch.setattr(volumes, "launch_image", lambda context: "img")
+    context.config.cache_volumes = {"pip": CacheVolumeParameters()}
+
+    volumes.ensure_cache_volumes(context)
+    volumes.ensure_cache_volumes(context)
+    assert len(commands) == 1
+
+    # Removed outside of doh, docker recreates it owned by root
+    existing.clear()
+    volumes.ensure_cache_volumes(context)
+    assert len(commands) == 2
+    owner = f"{os.getuid()}:{os.getgid()}"
+    assert commands[0][-5:] == [
+        "--entrypoint",
+        "chown",
+        "img",
+        owner,
+        "/volume",
+    ]
+
+
+def test_volume_prepared_via_engine_api(context: Context, monkeypatch) -> None:
+    configs: List[Dict[str, Any]] = []
+
+    class FakeClient:
+        def run_container(self, config: Dict[str, Any]) -> int:
+            configs.append(config)
+            return 0
+
+    monkeypatch.setattr(volumes, "engine_client", FakeClient)
+    monkeypatch.setattr(volumes, "inspect_image", lambda name: {"Id": "1"})
+    monkeypatch.setattr(volumes, "inspect_volume", lambda name: None)
+    monkeypatch.setattr(volumes, "launch_image", lambda context: "img")
+    context.config.cache_volumes = {
+        "npm": CacheVolumeParameters(scope="shared")
+    }
+
+    volumes.ensure_cache_volumes(context)
+
+    assert configs[0]["Image"] == "img"
+    assert configs[0]["Entrypoint"] + configs[0]["Cmd"] == [
+        "chmod",
+        "1777",
+        "/volume",
+    ]
+    mount = configs[0]["HostConfig"]["Mounts"][0]
+    assert mount["Source"] == "doh-cache-npm"
+    assert mount["VolumeOptions"]["Labels"][CACHE_SCOPE_LABEL] == "shared"
+
+
+def test_prune(context: Context, monkeypatch) -> None:
+    context.config.cache_volumes = {"pip": CacheVolumeParameters()}
+    own = f"doh-cache-{context.image_name}-pip"
+
+    def volume(name: str, scope: str):
+        labels = {CACHE_LABEL: "pip", CACHE_SCOPE_LABEL: scope}
+        return {"Name": name, "Labels": labels, "Size": 1, "RefCount": 0}
+
+    monkeypatch.setattr(
+        volumes,
+        "list_volumes",
+        lambda label: [
+            volume(own, "project"),
+            volume("doh-cache-other-u-pip", "project"),
+            volume("doh-cache-pip", "shared"),
+        ],
+    )
+    monkeypatch.setattr(volumes, "remove_volume", lambda name: True)
+
+    assert volumes.prune_cache_volumes(context) == [own]
+    assert len(volumes.prune_cache_volumes(context, True, True)) == 3
@@ -0,0 +1,59 @@
+from typing import List
+
+import os
+import time
+
+from doh import warm
+from doh.config import Context, WarmParameters
+
+
+def test_warm_container_reused(context: Context, monkeypatch) -> None:
+    context.config.warm = WarmParameters(idle_timeout=60)
+    containers = {}
+    started: List[List[str]] = []
+    executed: List[str] = []
+
+    def fake_start(context, run_args, args_hash):
+        started.append(run_args)
+        containers["current"] = {
+            "State": {"Running": True},
+            "Config": {"Labels": {warm.RUN_ARGS_HASH_LABEL: args_hash}},
+        }
+
+    monkeypatch.setattr(warm, "start_warm_container", fake_start)
+    monkeypatch.setattr(warm, "stop_warm_container", lambda c: None)
+    monkeypatch.setattr(
+        warm, "inspect_container", lambda name: containers.get("current")
+    )
+    monkeypatch.setattr(warm, "inspect_image", lambda name: {"Id": "sha256:1"})
+    monkeypatch.setattr(warm, "run_docker_cli", executed.append)
+
+    warm.run_warm(context, ["ls", "-la"])
+    warm.run_warm(context, ["true"])
+    assert len(started) == 1
+    assert executed[-1].endswith(f"{warm.warm_container_name(context)} true")
+    assert warm.stamp_path(context).is_file()
+
+    context.config.environment["FOO"] = "BAR"
+    warm.run_warm(context, ["true"])
+    assert len(started) == 2
+
+    containers["current"]["State"]["Running"] = False
+    warm.run_warm(context, ["true"])
+    assert len(started) == 3
+
+
+def test_long_command_keeps_container(context: Context, monkeypatch) -> None:
+    context.config.warm = WarmParameters(idle_timeout=1)
+    monkeypatch.setattr(warm, "ensure_warm_container", lambda c: "warm")
+    mtimes: List[float] = []
+
+    def long_exec(args: str) -> None:
+        os.utime(warm.stamp_path(context), (0, 0))
+        time.sleep(0.8)
+        mtimes.append(warm.stamp_path(context).stat().st_mtime)
+
+    warm.touch_stamp(context)
+    monkeypatch.setattr(warm, "run_docker_cli", long_exec)
+    warm.run_warm(context, ["sleep", "infinity"])
+    assert mtimes[0] > 0